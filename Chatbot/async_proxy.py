@@ -0,0 +1,486 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+import aiohttp
+from aiohttp import web
+
+import metrics
+from Chatbot.cache import ResponseCache, SemanticCache, request_cache_key
+from Chatbot.scheduler import GenerationScheduler, QueueFull
+from Chatbot.streaming import SSEStream, StreamError, sse_event
+from Chatbot.warm_cache import AnswerStore
+
+
+"""
+Asyncio version of the chat endpoints of app.py.
+Every open SSE stream is a coroutine instead of a server thread, so one
+process holds thousands of slow generations without starving /api/detect.
+Same routes, payloads, SSE events (type queue/chunk/done/error), caches
+and admission control as app.py, configured by the same environment
+variables; route /api/chat/* here from the reverse proxy:
+    python -m Chatbot.async_proxy --port 3001
+CHAT_CACHE_PATH may be the file app.py uses, answers are then shared with it;
+with the CHAT_SLOT_DIR of serve.py, CHAT_MAX_CONCURRENT caps both servers together.
+"""
+
+OLLAMA_BASE_URL = os.environ.get('OLLAMA_BASE_URL', "http://localhost:11434")
+DEFAULT_MODEL = os.environ.get('OLLAMA_MODEL', "LeafEye-Mistral7b")
+
+# The chat settings of app.py, see there
+CONFIG = {
+    'CHAT_CACHE_MAX_MB': float(os.environ.get('CHAT_CACHE_MAX_MB', 64)),
+    'CHAT_CACHE_PATH': os.environ.get('CHAT_CACHE_PATH') or None,
+    'CHAT_ANSWER_STORE': os.environ.get('CHAT_ANSWER_STORE') or None,
+    'CHAT_SEMANTIC_CACHE': os.environ.get('CHAT_SEMANTIC_CACHE', '0') == '1',
+    'CHAT_EMBED_MODEL': os.environ.get('CHAT_EMBED_MODEL', 'nomic-embed-text'),
+    'CHAT_SEMANTIC_THRESHOLD': float(os.environ.get('CHAT_SEMANTIC_THRESHOLD', 0.92)),
+    'CHAT_SEMANTIC_CACHE_SIZE': int(os.environ.get('CHAT_SEMANTIC_CACHE_SIZE', 5000)),
+    'CHAT_STREAM_WINDOW_MS': float(os.environ.get('CHAT_STREAM_WINDOW_MS', 50)),
+    'CHAT_STREAM_MAX_CHARS': int(os.environ.get('CHAT_STREAM_MAX_CHARS', 512)),
+    'CHAT_DONE_FULL_TEXT': os.environ.get('CHAT_DONE_FULL_TEXT', '1') == '1',
+    'CHAT_MAX_CONCURRENT': int(os.environ.get('CHAT_MAX_CONCURRENT', 4)),
+    'CHAT_SLOT_DIR': os.environ.get('CHAT_SLOT_DIR') or None,
+    'CHAT_MAX_QUEUE': int(os.environ.get('CHAT_MAX_QUEUE', 32)),
+    'CHAT_MAX_QUEUED_PER_CLIENT': int(os.environ.get('CHAT_MAX_QUEUED_PER_CLIENT', 4)),
+    'CHAT_QUEUE_TIMEOUT': float(os.environ.get('CHAT_QUEUE_TIMEOUT', 60))
+}
+
+# Queued requests check for their slot this often, the scheduler's events are for threads
+QUEUE_POLL_SECONDS = 0.05
+
+SSE_HEADERS = {
+    'Content-Type': 'text/plain; charset=utf-8',
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'X-Accel-Buffering': 'no'
+}
+
+ollama_ttft = metrics.REGISTRY.histogram(
+    'leafeye_ollama_time_to_first_token_seconds', "Time until Ollama streams the first token", ('model',))
+ollama_token_rate = metrics.REGISTRY.histogram(
+    'leafeye_ollama_tokens_per_second', "Ollama streaming rate after the first token", ('model',),
+    buckets=metrics.RATE_BUCKETS)
+open_streams = metrics.REGISTRY.gauge('leafeye_chat_open_streams', "Chat responses currently streaming")
+http_requests = metrics.REGISTRY.counter(
+    'leafeye_http_requests_total', "HTTP requests by endpoint and status", ('endpoint', 'method', 'status'))
+generations = metrics.REGISTRY.gauge('leafeye_ollama_generations', "Generations running and waiting for a slot",
+                                     ('state',))
+generation_queue_wait = metrics.REGISTRY.histogram(
+    'leafeye_ollama_queue_wait_seconds', "Time a generation waited for a slot")
+generation_rejected = metrics.REGISTRY.counter(
+    'leafeye_ollama_rejected_total', "Generations refused by admission control", ('reason',))
+
+
+class AsyncOllamaStreamer:
+    def __init__(self, session, base_url=OLLAMA_BASE_URL):
+        """
+        Non-blocking Ollama client, mirrors OllamaStreamer
+
+        Parameters:
+        -----------
+        session : aiohttp.ClientSession
+            Shared session, its connector pools the connections to Ollama
+        base_url : str, optional
+            Ollama server. Default is OLLAMA_BASE_URL
+        """
+        self.session = session
+        self.base_url = base_url
+
+    async def _stream(self, path, payload, extract):
+        done = False
+        try:
+            async with self.session.post(f"{self.base_url}{path}", json=payload) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        chunk = json.loads(line.decode('utf-8'))
+                    except json.JSONDecodeError as e:
+                        logging.error(f"JSON decode error: {e}")
+                        continue
+                    content = extract(chunk)
+                    if content:  # Only yield non-empty content
+                        yield content
+                    # Check if streaming is done
+                    if chunk.get('done', False):
+                        done = True
+                        break
+            if not done:
+                raise aiohttp.ClientPayloadError("Ollama closed the stream before it was done")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Request error: {e}")
+            yield StreamError(f"Error: {str(e) or type(e).__name__}")
+
+    def generate_text(self, model, prompt, temperature=0.7, max_tokens=None):
+        """Async generator of text chunks from /api/generate"""
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": True,
+            "options": {
+                "temperature": temperature,
+            }
+        }
+        if max_tokens:
+            payload["options"]["num_predict"] = max_tokens
+        return self._stream('/api/generate', payload, lambda chunk: chunk.get('response'))
+
+    def stream_chat(self, model, messages, temperature=0.7, max_tokens=None):
+        """Async generator of text chunks from /api/chat"""
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": True,
+            "options": {
+                "temperature": temperature,
+            }
+        }
+        if max_tokens:
+            payload["options"]["num_predict"] = max_tokens
+        return self._stream('/api/chat', payload, lambda chunk: (chunk.get('message') or {}).get('content'))
+
+    async def embed(self, model, text):
+        """Embedding of text from /api/embed, raises aiohttp.ClientError on failure"""
+        async with self.session.post(f"{self.base_url}/api/embed", json={"model": model, "input": text}) as response:
+            response.raise_for_status()
+            return (await response.json())['embeddings'][0]
+
+
+def sse(event):
+    return sse_event(event).encode('utf-8')
+
+
+async def replay(chunks):
+    """A cached answer as an async iterator of its chunks"""
+    for chunk in chunks:
+        yield chunk
+
+
+async def read_prompt(request):
+    """Parsed request body and prompt, or an error response"""
+    try:
+        data = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        data = None
+    if not data:
+        return None, web.json_response({"error": "No JSON data provided"}, status=400)
+    return data, None
+
+
+def endpoint(request):
+    """Route pattern of the request, a fixed label for unmatched paths so scanners cannot add label values"""
+    route = request.match_info.route
+    return route.resource.canonical if route.resource is not None else 'unmatched'
+
+
+@web.middleware
+async def count_requests(request, handler):
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        http_requests.labels(endpoint(request), request.method, e.status).inc()
+        raise
+    http_requests.labels(endpoint(request), request.method, response.status).inc()
+    return response
+
+
+async def cached_answer(app, model, prompt, temperature, max_tokens, cache_key, use_store=True):
+    """
+    Chunks of an answer from the answer store, the chat cache or the semantic cache, see app.py
+
+    Returns:
+    --------
+    tuple
+        (chunks or None, prompt embedding to store the generated answer under or None)
+    """
+    store = app['answer_store'] if use_store else None
+    # sqlite reads the file, keep it off the event loop
+    cached = await asyncio.to_thread(store.get, model, prompt, temperature, max_tokens) if store else None
+    if cached is None and cache_key:
+        cached = app['chat_cache'].get(cache_key)
+    embedding = None
+    if cached is None and cache_key and app['semantic_cache'] is not None:
+        try:
+            embedding = await app['ollama'].embed(app['config']['CHAT_EMBED_MODEL'], prompt)
+            cached, _ = app['semantic_cache'].lookup(model, temperature, max_tokens, embedding)
+        except Exception as e:
+            # Without an embedding the request is simply not semantically cached
+            logging.error(f"Prompt embedding failed: {e}")
+    return cached, embedding
+
+
+async def generate_answer(app, model, prompt, temperature, max_tokens, cache_key, embedding=None):
+    """Chunks streamed from Ollama, cached once complete"""
+    chunks = []
+    async for chunk in metrics.timed_astream(app['ollama'].generate_text(model, prompt, temperature, max_tokens),
+                                             ollama_ttft.labels(model), ollama_token_rate.labels(model)):
+        chunks.append(chunk)
+        yield chunk
+    if cache_key and chunks and not isinstance(chunks[-1], StreamError):
+        app['chat_cache'].put(cache_key, chunks)
+        if embedding is not None:
+            app['semantic_cache'].add(model, temperature, max_tokens, embedding, chunks)
+
+
+def admit_generation(request):
+    """
+    Ticket for a generation slot, fair across the X-Client-Id header (or remote address)
+
+    Returns:
+    --------
+    tuple
+        (ticket, None), or (None, error response) with a Retry-After header when the queue is full
+    """
+    client = request.headers.get('X-Client-Id') or request.remote
+    try:
+        return request.app['scheduler'].enter(client), None
+    except QueueFull as e:
+        generation_rejected.labels(str(e.status)).inc()
+        return None, web.json_response({"success": False, "error": str(e), "retry_after": e.retry_after},
+                                       status=e.status, headers={'Retry-After': str(e.retry_after)})
+
+
+async def queue_events(app, ticket):
+    """SSE queue events with the ticket's position until it gets a slot, TimeoutError after CHAT_QUEUE_TIMEOUT"""
+    scheduler = app['scheduler']
+    deadline = ticket.enqueued_at + app['config']['CHAT_QUEUE_TIMEOUT']
+    position = None
+    while True:
+        # Takes slots freed by other processes sharing CHAT_SLOT_DIR
+        scheduler.poll()
+        if ticket.granted.is_set():
+            break
+        current = scheduler.position(ticket)
+        if current != position:
+            position = current
+            yield sse({'type': 'queue', 'position': position})
+        if time.perf_counter() > deadline:
+            generation_rejected.labels('timeout').inc()
+            raise TimeoutError("Timed out waiting for a generation slot")
+        await asyncio.sleep(QUEUE_POLL_SECONDS)
+    generation_queue_wait.observe(ticket.started_at - ticket.enqueued_at)
+
+
+async def simple_chat(request):
+    """
+    Streamed text generation, same payload and SSE events as app.py /api/chat/simple
+    """
+    data, error = await read_prompt(request)
+    if error is not None:
+        return error
+    prompt = data.get('prompt', '').strip()
+    if not prompt:
+        return web.json_response({"error": "Messages is required"}, status=400)
+
+    app = request.app
+    model = data.get('model', DEFAULT_MODEL)
+    temperature = data.get('temperature', 0.7)
+    max_tokens = data.get('max_tokens', 1000)
+    cache_key = request_cache_key(data, model, prompt, temperature, max_tokens)
+    use_store = data.get('cache') is not False
+    stream = SSEStream(
+        window_ms=app['config']['CHAT_STREAM_WINDOW_MS'],
+        max_chars=app['config']['CHAT_STREAM_MAX_CHARS'],
+        full_text=data.get('full_text', app['config']['CHAT_DONE_FULL_TEXT'])
+    )
+    cached, embedding = await cached_answer(app, model, prompt, temperature, max_tokens, cache_key, use_store)
+    ticket = None
+    if cached is None:
+        ticket, rejection = admit_generation(request)
+        if rejection is not None:
+            return rejection
+
+    app['streams'] += 1
+    try:
+        response = web.StreamResponse(headers=SSE_HEADERS)
+        await response.prepare(request)
+        try:
+            chunks = replay(cached) if cached is not None else None
+            if ticket is not None:
+                async for event in queue_events(app, ticket):
+                    await response.write(event)
+                chunks = generate_answer(app, model, prompt, temperature, max_tokens, cache_key, embedding)
+            # Coalesced chunk events, then the completion signal
+            async for event in stream.aevents(chunks):
+                await response.write(event.encode('utf-8'))
+        except ConnectionResetError:
+            # Client went away, leaving the async with block also closes the Ollama request
+            logging.info("Client disconnected during chat stream")
+        except Exception as e:
+            logging.error(f"Error in simple generate function: {e}")
+            await response.write(sse({'error': str(e), 'type': 'error'}))
+    finally:
+        app['streams'] -= 1
+        # Also reached when the client is gone and the handler is cancelled
+        if ticket is not None:
+            app['scheduler'].release(ticket)
+    return response
+
+
+async def generate_chat(request):
+    """
+    Complete (non-streamed) generation, same payload and response as app.py /api/chat/generate
+    """
+    data, error = await read_prompt(request)
+    if error is not None:
+        return error
+    prompt = data.get('prompt', '').strip()
+    if not prompt:
+        return web.json_response({"error": "Prompt is required"}, status=400)
+
+    app = request.app
+    model = data.get('model', DEFAULT_MODEL)
+    temperature = data.get('temperature', 0.7)
+    max_tokens = data.get('max_tokens', 1000)
+    cache_key = request_cache_key(data, model, prompt, temperature, max_tokens)
+    use_store = data.get('cache') is not False
+    cached, embedding = await cached_answer(app, model, prompt, temperature, max_tokens, cache_key, use_store)
+    ticket = None
+    if cached is None:
+        ticket, rejection = admit_generation(request)
+        if rejection is not None:
+            return rejection
+
+    try:
+        parts = cached
+        if ticket is not None:
+            try:
+                async for _ in queue_events(app, ticket):
+                    pass
+            except TimeoutError as e:
+                retry_after = app['scheduler'].retry_after()
+                return web.json_response({"success": False, "error": str(e), "retry_after": retry_after},
+                                         status=503, headers={'Retry-After': str(retry_after)})
+            parts = [chunk async for chunk in
+                     generate_answer(app, model, prompt, temperature, max_tokens, cache_key, embedding)]
+        return web.json_response({
+            "success": True,
+            "response": "".join(parts),
+            "model": model,
+            "prompt": prompt
+        })
+    except Exception as e:
+        logging.error(f"Error generating text: {e}")
+        return web.json_response({
+            "success": False,
+            "error": f"Error generating text: {str(e)}"
+        }, status=500)
+    finally:
+        if ticket is not None:
+            app['scheduler'].release(ticket)
+
+
+async def health_check(request):
+    try:
+        async with request.app['client'].get(f"{request.app['ollama'].base_url}/api/tags",
+                                             timeout=aiohttp.ClientTimeout(total=5)) as response:
+            if response.status == 200:
+                app = request.app
+                return web.json_response({
+                    "status": "healthy",
+                    "ollama": "connected",
+                    "open_streams": app['streams'],
+                    "generations": app['scheduler'].stats(),
+                    "chat_cache": app['chat_cache'].stats(),
+                    "semantic_cache": app['semantic_cache'].stats() if app['semantic_cache'] else None,
+                    "answer_store": app['answer_store'].stats() if app['answer_store'] else None
+                })
+            return web.json_response({"status": "unhealthy", "ollama": "disconnected"}, status=503)
+    except Exception as e:
+        return web.json_response({"status": "unhealthy", "error": str(e)}, status=503)
+
+
+async def prometheus_metrics(request):
+    return web.Response(body=metrics.REGISTRY.expose().encode('utf-8'),
+                        headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+def create_app(base_url=OLLAMA_BASE_URL, max_connections=16, read_timeout=60, connect_timeout=10, config=None):
+    """
+    aiohttp application serving the chat endpoints
+
+    Parameters:
+    -----------
+    base_url : str, optional
+        Ollama server. Default is OLLAMA_BASE_URL
+    max_connections : int, optional
+        Concurrent connections to Ollama, further requests wait for one. Keep it above
+        CHAT_MAX_CONCURRENT to leave room for embeddings and health checks. Default is 16
+    read_timeout : float, optional
+        Seconds without a new token before a stream is abandoned. Default is 60
+    connect_timeout : float, optional
+        Default is 10
+    config : dict, optional
+        Overrides of CONFIG, e.g. {'CHAT_MAX_CONCURRENT': 2}
+    """
+    if max_connections < 1:
+        raise ValueError("max_connections must be at least 1, aiohttp treats 0 as unlimited")
+    config = dict(CONFIG, **(config or {}))
+    app = web.Application(middlewares=[count_requests])
+    app['config'] = config
+    app['streams'] = 0
+    app['scheduler'] = GenerationScheduler(
+        max_concurrent=config['CHAT_MAX_CONCURRENT'],
+        max_queue=config['CHAT_MAX_QUEUE'],
+        max_per_client=config['CHAT_MAX_QUEUED_PER_CLIENT'],
+        slot_dir=config['CHAT_SLOT_DIR']
+    )
+    app['chat_cache'] = ResponseCache(
+        max_bytes=config['CHAT_CACHE_MAX_MB'] * 1024 * 1024,
+        path=config['CHAT_CACHE_PATH']
+    )
+    app['semantic_cache'] = None
+    if config['CHAT_SEMANTIC_CACHE']:
+        app['semantic_cache'] = SemanticCache(
+            capacity=config['CHAT_SEMANTIC_CACHE_SIZE'],
+            threshold=config['CHAT_SEMANTIC_THRESHOLD']
+        )
+    app['answer_store'] = None
+    if config['CHAT_ANSWER_STORE']:
+        if os.path.exists(config['CHAT_ANSWER_STORE']):
+            app['answer_store'] = AnswerStore(config['CHAT_ANSWER_STORE'], readonly=True)
+        else:
+            logging.warning(f"Answer store {config['CHAT_ANSWER_STORE']} not found, run `python -m Chatbot.warm_cache`")
+
+    async def client_session(app):
+        timeout = aiohttp.ClientTimeout(total=None, connect=connect_timeout, sock_read=read_timeout)
+        app['client'] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_connections),
+                                              timeout=timeout)
+        app['ollama'] = AsyncOllamaStreamer(app['client'], base_url)
+        yield
+        await app['client'].close()
+
+    app.cleanup_ctx.append(client_session)
+    open_streams.set_function(lambda: app['streams'])
+    for state in ('active', 'queued'):
+        generations.set_function(lambda state=state: app['scheduler'].stats()[state], state)
+    app.router.add_post('/api/chat/simple', simple_chat)
+    app.router.add_post('/api/chat/generate', generate_chat)
+    app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', prometheus_metrics)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Asyncio chat proxy to Ollama")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('CHAT_PORT', 3001)))
+    parser.add_argument('--ollama-url', default=OLLAMA_BASE_URL)
+    parser.add_argument('--max-connections', type=int, default=int(os.environ.get('OLLAMA_MAX_CONNECTIONS', 16)),
+                        help="Connections to Ollama at once. Default is 16")
+    parser.add_argument('--read-timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(args.ollama_url, args.max_connections, args.read_timeout),
+                host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
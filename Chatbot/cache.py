@@ -0,0 +1,305 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+"""
+Cache of complete LLM answers.
+Answers are keyed by model, normalized prompt and sampling options and kept
+as the original list of streamed chunks, so a hit replays the same SSE chunk
+events the client would have received from Ollama. Only deterministic
+requests (temperature 0) or requests that opt in should be cached.
+SemanticCache matches rephrased prompts by the cosine similarity of their
+embeddings, among answers generated with the same model and sampling options.
+With a path, ResponseCache writes answers through to SQLite, which serializes
+the writers, so every worker process can share one file.
+"""
+
+
+def normalize_prompt(prompt):
+    """Case and whitespace insensitive form of a prompt"""
+    return ' '.join(prompt.split()).casefold()
+
+
+def response_key(model, prompt, temperature, max_tokens):
+    """SHA-256 over (model, normalized prompt, temperature, max_tokens)"""
+    fields = [model, normalize_prompt(prompt), float(temperature), max_tokens]
+    return hashlib.sha256(json.dumps(fields).encode('utf-8')).hexdigest()
+
+
+def request_cache_key(data, model, prompt, temperature, max_tokens):
+    """Cache key for deterministic requests (temperature 0) or those sending "cache": true, else None"""
+    use_cache = data.get('cache')
+    if use_cache is None:
+        use_cache = temperature == 0
+    return response_key(model, prompt, temperature, max_tokens) if use_cache else None
+
+
+def _size(chunks):
+    return sys.getsizeof(chunks) + sum(sys.getsizeof(chunk) for chunk in chunks)
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, path=None):
+        """
+        LRU cache of streamed answers bounded by memory
+
+        Parameters:
+        -----------
+        max_bytes : int, optional
+            Memory budget of the stored chunks, least recently used answers are
+            evicted beyond it. Default is 64 MB
+        path : str, optional
+            SQLite file the answers are written through to and misses are looked up in.
+            Every process opening the same path (gunicorn workers, the async proxy) shares
+            it; rows beyond max_bytes of compressed answers are pruned from the shared table,
+            least recently written first. None keeps the cache in memory only
+        """
+        self.max_bytes = max(1, int(max_bytes))
+        self.path = path
+        self.bytes = 0
+        self.hits = 0
+        self.file_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # sqlite3 connections belong to one thread, opened lazily like AnswerStore's
+        self._local = threading.local()
+        if path:
+            try:
+                with self._connection() as connection:
+                    connection.execute("""
+                        CREATE TABLE IF NOT EXISTS responses (
+                            key TEXT PRIMARY KEY,
+                            chunks BLOB NOT NULL,
+                            bytes INTEGER NOT NULL,
+                            written REAL NOT NULL
+                        )""")
+            except sqlite3.Error as e:
+                logging.error(f"Chat cache {path} is unusable, keeping answers in memory only: {e}")
+                self.path = None
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Writers wait briefly for each other, a request never waits long for the cache
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _read(self, key):
+        try:
+            row = self._connection().execute("SELECT chunks FROM responses WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Chat cache lookup failed: {e}")
+            return None
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+    def _write(self, key, chunks):
+        blob = zlib.compress(json.dumps(chunks).encode('utf-8'))
+        with self._lock:
+            self._puts += 1
+            prune = self._puts % 100 == 0
+        try:
+            with self._connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, chunks, bytes, written) VALUES (?, ?, ?, ?)",
+                    (key, blob, len(blob), time.time()))
+                if prune:
+                    # Decided on the shared table, so no process drops answers only another one holds
+                    connection.execute("""
+                        DELETE FROM responses WHERE key IN (
+                            SELECT key FROM (
+                                SELECT key, SUM(bytes) OVER (ORDER BY written DESC, key) AS total FROM responses
+                            ) WHERE total > ?
+                        )""", (self.max_bytes,))
+        except sqlite3.Error as e:
+            logging.error(f"Could not persist chat answer: {e}")
+
+    def _store(self, key, chunks):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.bytes -= _size(previous)
+        self._entries[key] = chunks
+        self.bytes += _size(chunks)
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= _size(evicted)
+            self.evictions += 1
+
+    def get(self, key):
+        """
+        Returns:
+        --------
+        list
+            The cached chunks, or None
+        """
+        with self._lock:
+            chunks = self._entries.get(key)
+            if chunks is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return chunks
+        # Answers written by other processes, or by this one before a restart
+        chunks = self._read(key) if self.path else None
+        with self._lock:
+            if chunks is None:
+                self.misses += 1
+                return None
+            self._store(key, chunks)
+            self.hits += 1
+            self.file_hits += 1
+            return chunks
+
+    def put(self, key, chunks):
+        """Cache a finished answer, callers must not pass streams that ended in an error"""
+        chunks = list(chunks)
+        with self._lock:
+            self._store(key, chunks)
+        if self.path:
+            self._write(key, chunks)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "file_hits": self.file_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+class _Partition:
+    """Unit vectors and answers of one (model, temperature, max_tokens), grown by doubling up to the capacity"""
+
+    def __init__(self, dim, capacity):
+        allocated = min(16, capacity)
+        self.capacity = capacity
+        self.vectors = np.zeros((allocated, dim), dtype=np.float32)
+        self.last_used = np.zeros(allocated, dtype=np.int64)
+        self.values = [None] * allocated
+        self.size = 0
+
+    def slot(self):
+        """Index for a new entry, evicting the least recently used one once full"""
+        if self.size < len(self.values):
+            self.size += 1
+            return self.size - 1
+        if self.size < self.capacity:
+            grown = min(self.capacity, 2 * self.size)
+            self.vectors = np.resize(self.vectors, (grown, self.vectors.shape[1]))
+            self.last_used = np.resize(self.last_used, grown)
+            self.values.extend([None] * (grown - self.size))
+            self.size += 1
+            return self.size - 1
+        return int(np.argmin(self.last_used[:self.size]))
+
+
+class SemanticCache:
+    def __init__(self, capacity=5000, threshold=0.92):
+        """
+        Answers looked up by prompt embedding, so rephrased questions hit
+
+        Every (model, temperature, max_tokens) has its own partition: a matrix of unit
+        vectors searched with one matrix-vector product per lookup, so an answer is
+        only reused for requests with the options it was generated with.
+
+        Parameters:
+        -----------
+        capacity : int, optional
+            Answers kept per partition before the least recently used one is replaced. Default is 5000
+        threshold : float, optional
+            Smallest cosine similarity that counts as the same question. Default is 0.92
+        """
+        self.capacity = max(1, int(capacity))
+        self.threshold = float(threshold)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._partitions = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    @staticmethod
+    def _key(model, temperature, max_tokens):
+        return model, float(temperature), max_tokens
+
+    def lookup(self, model, temperature, max_tokens, vector):
+        """
+        Returns:
+        --------
+        tuple
+            (chunks, similarity) of the closest prompt stored with the same model and options above
+            the threshold, or (None, best similarity)
+        """
+        vector = self._unit(vector)
+        with self._lock:
+            partition = self._partitions.get(self._key(model, temperature, max_tokens))
+            if partition is None or partition.size == 0 or partition.vectors.shape[1] != vector.size:
+                self.misses += 1
+                return None, None
+            similarities = partition.vectors[:partition.size] @ vector
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                self.misses += 1
+                return None, similarity
+            self._clock += 1
+            partition.last_used[best] = self._clock
+            self.hits += 1
+            return partition.values[best], similarity
+
+    def add(self, model, temperature, max_tokens, vector, chunks):
+        vector = self._unit(vector)
+        key = self._key(model, temperature, max_tokens)
+        with self._lock:
+            partition = self._partitions.get(key)
+            if partition is None or partition.vectors.shape[1] != vector.size:
+                # A new (or changed) embedding model starts an empty partition
+                partition = self._partitions[key] = _Partition(vector.size, self.capacity)
+            full = partition.size == self.capacity
+            index = partition.slot()
+            if full:
+                self.evictions += 1
+            self._clock += 1
+            partition.vectors[index] = vector
+            partition.last_used[index] = self._clock
+            partition.values[index] = list(chunks)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "partitions": [
+                    {"model": model, "temperature": temperature, "max_tokens": max_tokens, "entries": partition.size}
+                    for (model, temperature, max_tokens), partition in self._partitions.items()
+                ],
+                "capacity": self.capacity,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -1,8 +1,17 @@
 from flask import Flask, request, Response, jsonify
 from flask_cors import CORS
 import json
+import os
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+try:
+    from Chatbot.streaming import SSEStream, StreamError
+except ModuleNotFoundError:
+    # Run as a script (python Chatbot/chatbot.py): only the Chatbot folder is on sys.path
+    from streaming import SSEStream, StreamError
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
@@ -16,69 +25,123 @@ DEFAULT_MODEL = "llama2"  # Change to your preferred model
 
 
 class OllamaStreamer:
-    def __init__(self, base_url=OLLAMA_BASE_URL):
-        self.base_url = base_url
-
-    def stream_chat(self, model, messages, temperature=0.7, max_tokens=None):
+    def __init__(self, base_url=OLLAMA_BASE_URL, pool_size=10, connect_timeout=5, read_timeout=60,
+                 retries=2, backoff=0.25):
         """
-        Stream chat responses from Ollama
+        Ollama client on a pool of keep-alive connections
+
+        Parameters:
+        -----------
+        base_url : str, optional
+            Ollama server. Default is OLLAMA_BASE_URL
+        pool_size : int, optional
+            Idle connections kept open, streams beyond it use a throwaway connection. Default is 10
+        connect_timeout : float, optional
+            Seconds to establish a connection. Default is 5
+        read_timeout : float, optional
+            Seconds without a new token before a stream is abandoned. Default is 60
+        retries : int, optional
+            Attempts after a connection error, only while no response has arrived
+            so nothing is generated twice. Default is 2
+        backoff : float, optional
+            Delay before the first retry in seconds, doubled for every further one. Default is 0.25
         """
-        url = f"{self.base_url}/api/chat"
-
-        payload = {
-            "model": model,
-            "messages": messages,
-            "stream": True,
-            "options": {
-                "temperature": temperature,
-            }
-        }
-
-        if max_tokens:
-            payload["options"]["num_predict"] = max_tokens
-
-        try:
-            response = requests.post(
-                url,
-                json=payload,
-                stream=True,
-                timeout=60
-            )
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.retried = 0
+        self.failed = 0
+        self.streaming = 0
+        self._lock = threading.Lock()
+        self._open_session()
+        # Pooled sockets must not be shared with forked server workers
+        os.register_at_fork(after_in_child=self._open_session)
+
+    def _open_session(self):
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+
+    def get(self, path, timeout=5):
+        """GET on a pooled connection, e.g. get('/api/tags') for health checks"""
+        return self.session.get(f"{self.base_url}{path}", timeout=timeout)
+
+    def _post(self, path, payload, stream=True):
+        """POST that waits for the response headers, retrying connection errors with backoff"""
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(f"{self.base_url}{path}", json=payload, stream=stream,
+                                             timeout=self.timeout)
+            except requests.exceptions.ConnectionError as e:
+                # Refused, reset or a stale keep-alive connection: the request never produced a token
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logging.warning(f"Connection to Ollama failed ({e}), retrying in {delay:.2f}s")
+                with self._lock:
+                    self.retried += 1
+                time.sleep(delay)
+                continue
+            if not response.ok:
+                response.close()
             response.raise_for_status()
+            return response
 
+    def _stream(self, path, payload, extract):
+        with self._lock:
+            self.streaming += 1
+        response = None
+        done = False
+        try:
+            response = self._post(path, payload)
             for line in response.iter_lines():
                 if line:
                     try:
                         chunk = json.loads(line.decode('utf-8'))
-                        if 'message' in chunk and 'content' in chunk['message']:
-                            content = chunk['message']['content']
-                            if content:  # Only yield non-empty content
-                                yield content
+                        content = extract(chunk)
+                        if content:  # Only yield non-empty content
+                            yield content
 
                         # Check if streaming is done
                         if chunk.get('done', False):
+                            done = True
+                            # Read the end of the chunked body so the connection returns to the pool
+                            response.raw.drain_conn()
                             break
 
                     except json.JSONDecodeError as e:
                         logging.error(f"JSON decode error: {e}")
                         continue
+            if not done:
+                raise requests.exceptions.ChunkedEncodingError("Ollama closed the stream before it was done")
 
         except requests.exceptions.RequestException as e:
             logging.error(f"Request error: {e}")
-            yield f"Error: {str(e)}"
+            with self._lock:
+                self.failed += 1
+            yield StreamError(f"Error: {str(e)}")
         except Exception as e:
             logging.error(f"Unexpected error: {e}")
-            yield f"Error: {str(e)}"
+            with self._lock:
+                self.failed += 1
+            yield StreamError(f"Error: {str(e)}")
+        finally:
+            # Unfinished streams (client gone) close their connection, which stops the generation
+            if response is not None:
+                response.close()
+            with self._lock:
+                self.streaming -= 1
 
-    def generate_text(self, model, prompt, temperature=0.7, max_tokens=None):
+    def stream_chat(self, model, messages, temperature=0.7, max_tokens=None):
         """
-        Stream text generation from Ollama (alternative method)
+        Stream chat responses from Ollama
         """
-        url = f"{self.base_url}/api/generate"
-
         payload = {
             "model": model,
-            "prompt": prompt,
+            "messages": messages,
             "stream": True,
             "options": {
                 "temperature": temperature,
@@ -88,38 +151,60 @@ class OllamaStreamer:
         if max_tokens:
             payload["options"]["num_predict"] = max_tokens
 
-        try:
-            response = requests.post(
-                url,
-                json=payload,
-                stream=True,
-                timeout=60
-            )
-            response.raise_for_status()
+        return self._stream('/api/chat', payload, lambda chunk: (chunk.get('message') or {}).get('content'))
 
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        chunk = json.loads(line.decode('utf-8'))
-                        if 'response' in chunk:
-                            content = chunk['response']
-                            if content:  # Only yield non-empty content
-                                yield content
+    def generate_text(self, model, prompt, temperature=0.7, max_tokens=None):
+        """
+        Stream text generation from Ollama (alternative method)
+        """
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": True,
+            "options": {
+                "temperature": temperature,
+            }
+        }
 
-                        # Check if streaming is done
-                        if chunk.get('done', False):
-                            break
+        if max_tokens:
+            payload["options"]["num_predict"] = max_tokens
 
-                    except json.JSONDecodeError as e:
-                        logging.error(f"JSON decode error: {e}")
-                        continue
+        return self._stream('/api/generate', payload, lambda chunk: chunk.get('response'))
 
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Request error: {e}")
-            yield f"Error: {str(e)}"
-        except Exception as e:
-            logging.error(f"Unexpected error: {e}")
-            yield f"Error: {str(e)}"
+    def embed(self, model, text):
+        """
+        Embedding of text from /api/embed
+
+        Parameters:
+        -----------
+        model : str
+            An embedding model, e.g. nomic-embed-text
+        text : str
+
+        Returns:
+        --------
+        list
+            The embedding vector. Raises requests.exceptions.RequestException on failure
+        """
+        response = self._post('/api/embed', {"model": model, "input": text}, stream=False)
+        return response.json()['embeddings'][0]
+
+    def pool_stats(self):
+        """Connections opened so far, idle ones in the pool, requests sent over them and stream counters"""
+        stats = {"pool_size": self.pool_size, "connections_opened": 0, "idle": 0, "requests": 0,
+                 "streaming": self.streaming, "retried": self.retried, "failed": self.failed}
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            stats["connections_opened"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+            if pool.pool is not None:
+                # The queue holds a None placeholder for every slot without an idle connection
+                stats["idle"] += sum(conn is not None for conn in list(pool.pool.queue))
+        return stats
 
 
 # Initialize Ollama streamer
@@ -134,7 +219,7 @@ def health_check():
     """Health check endpoint"""
     try:
         # Test Ollama connection
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
+        response = ollama.get('/api/tags')
         if response.status_code == 200:
             return jsonify({"status": "healthy", "ollama": "connected"})
         else:
@@ -168,7 +253,8 @@ def chat():
         "model": "optional_model_name",
         "temperature": 0.7,
         "max_tokens": 1000,
-        "system_prompt": "optional_system_prompt"
+        "system_prompt": "optional_system_prompt",
+        "full_text": true
     }
     """
     try:
@@ -204,29 +290,27 @@ def chat():
             "content": user_message
         })
 
+        # Tokens are coalesced into fewer events, "full_text": false leaves the answer out of the done event
+        stream = SSEStream(full_text=data.get('full_text', True), done_key='full_message')
+
         def generate():
             try:
-                assistant_message = ""
-
-                # Stream the response
-                for chunk in ollama.stream_chat(
+                # Stream the response as Server-Sent Events
+                yield from stream.chunk_events(ollama.stream_chat(
                         model=model,
                         messages=conversations[conversation_id],
                         temperature=temperature,
                         max_tokens=max_tokens
-                ):
-                    assistant_message += chunk
-                    # Send chunk as Server-Sent Event
-                    yield f"data: {json.dumps({'content': chunk, 'type': 'chunk'})}\n\n"
+                ))
 
                 # Add assistant message to conversation history
                 conversations[conversation_id].append({
                     "role": "assistant",
-                    "content": assistant_message
+                    "content": stream.text
                 })
 
                 # Send completion signal
-                yield f"data: {json.dumps({'type': 'done', 'full_message': assistant_message})}\n\n"
+                yield stream.done_event()
 
             except Exception as e:
                 logging.error(f"Error in generate function: {e}")
@@ -326,7 +410,7 @@ def internal_error(error):
 if __name__ == '__main__':
     # Check if Ollama is running
     try:
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
+        response = ollama.get('/api/tags')
         if response.status_code == 200:
             print("✅ Ollama is running and accessible")
             models = response.json().get('models', [])
@@ -0,0 +1,268 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+"""
+Admission control for generations sent to a single Ollama server.
+At most max_concurrent generations run at once; further requests wait in a
+bounded queue that is served round-robin across clients, so one client with
+many requests cannot starve the others. When the queue (or a client's share
+of it) is full, requests are rejected at once with a Retry-After estimate
+instead of piling up on Ollama until every server thread is stuck.
+The cap is per process unless the processes (gunicorn workers, the async
+proxy) share a slot directory: a slot is then an flock'd file in it, so
+max_concurrent holds for all of them and a crashed process frees its slots.
+"""
+
+
+class QueueFull(Exception):
+    def __init__(self, message, status, retry_after):
+        """
+        Raised by GenerationScheduler.enter
+
+        Parameters:
+        -----------
+        message : str
+        status : int
+            429 when the client already has its share of the queue, 503 when the queue is full
+        retry_after : int
+            Seconds until a retry is likely to be admitted
+        """
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A request's place in the scheduler, granted once it may start generating"""
+
+    def __init__(self, client):
+        self.client = client
+        self.granted = threading.Event()
+        self.enqueued_at = time.perf_counter()
+        self.started_at = None
+        self.released = False
+        self.slot = None
+
+
+class SlotFiles:
+    def __init__(self, directory, count):
+        """
+        Generation slots shared by every process using the same directory
+
+        Parameters:
+        -----------
+        directory : str
+            Created if missing, holds one lock file per slot
+        count : int
+            Slots, i.e. generations at once over all processes
+        """
+        # fcntl is POSIX only, like the multi-process metrics
+        import fcntl
+        self._fcntl = fcntl
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, f"generation-slot-{index}.lock") for index in range(count)]
+
+    def acquire(self):
+        """File descriptor of a free slot, held until release(), or None when all are taken"""
+        for path in self.paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                # Separate open() calls conflict under flock even within one process
+                self._fcntl.flock(fd, self._fcntl.LOCK_EX | self._fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                os.close(fd)
+        return None
+
+    def release(self, fd):
+        # Closing the descriptor drops the lock, as does the process exiting
+        os.close(fd)
+
+
+class GenerationScheduler:
+    def __init__(self, max_concurrent=4, max_queue=32, max_per_client=4, expected_seconds=10.0, slot_dir=None,
+                 poll_interval=0.05):
+        """
+        Concurrency cap with a fair, bounded wait queue
+
+        Parameters:
+        -----------
+        max_concurrent : int, optional
+            Generations running at once, match OLLAMA_NUM_PARALLEL. Default is 4
+        max_queue : int, optional
+            Requests waiting for a slot, further ones get a 503. Default is 32
+        max_per_client : int, optional
+            Requests one client may have waiting, further ones get a 429. Default is 4
+        expected_seconds : float, optional
+            Initial estimate of a generation's duration for Retry-After, replaced by
+            a moving average of the observed durations. Default is 10
+        slot_dir : str, optional
+            Directory of slot files shared with the other processes, max_concurrent then
+            caps their generations together. None caps this process only
+        poll_interval : float, optional
+            Seconds between checks for slots freed by other processes while requests
+            wait. Default is 0.05
+        """
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_queue = max(0, int(max_queue))
+        self.max_per_client = max(1, int(max_per_client))
+        self.average_seconds = float(expected_seconds)
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.slot_dir = slot_dir
+        self.poll_interval = poll_interval
+        self._slots = None
+        if slot_dir:
+            try:
+                self._slots = SlotFiles(slot_dir, self.max_concurrent)
+            except (ImportError, OSError) as e:
+                logging.error(f"Generation slots in {slot_dir} unavailable, capping this process only: {e}")
+                self.slot_dir = None
+        # Waiting tickets per client, in the round-robin order clients are served
+        self._waiting = OrderedDict()
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        """Seconds until a new request is likely to get a slot"""
+        with self._lock:
+            return self._retry_after()
+
+    def _retry_after(self):
+        rounds = (self.queued + self.active) / self.max_concurrent
+        return max(1, math.ceil(rounds * self.average_seconds))
+
+    def enter(self, client):
+        """
+        Take a slot, or a place in the queue
+
+        Returns:
+        --------
+        Ticket
+            Already granted when a slot was free, otherwise wait with wait() or position().
+            Raises QueueFull when the request cannot be queued
+        """
+        ticket = Ticket(client)
+        with self._lock:
+            if self.active < self.max_concurrent and not self.queued and self._take_slot(ticket):
+                self._grant(ticket)
+                return ticket
+            waiting = self._waiting.get(client)
+            if waiting is not None and len(waiting) >= self.max_per_client:
+                self.rejected += 1
+                raise QueueFull("Too many queued generations for this client", 429, self._retry_after())
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull("Generation queue is full", 503, self._retry_after())
+            if waiting is None:
+                waiting = self._waiting[client] = deque()
+            waiting.append(ticket)
+            self.queued += 1
+        return ticket
+
+    def _take_slot(self, ticket):
+        """False when other processes hold every shared slot"""
+        if self._slots is None:
+            return True
+        ticket.slot = self._slots.acquire()
+        return ticket.slot is not None
+
+    def _grant(self, ticket):
+        self.active += 1
+        self.admitted += 1
+        ticket.started_at = time.perf_counter()
+        ticket.granted.set()
+
+    def _grant_next(self):
+        while self.active < self.max_concurrent and self._waiting:
+            client, waiting = next(iter(self._waiting.items()))
+            if not self._take_slot(waiting[0]):
+                break
+            ticket = waiting.popleft()
+            self.queued -= 1
+            if waiting:
+                # The client goes to the back of the round
+                self._waiting.move_to_end(client)
+            else:
+                del self._waiting[client]
+            self._grant(ticket)
+
+    def poll(self):
+        """Grant waiting tickets slots that other processes have freed since"""
+        if self._slots is not None:
+            with self._lock:
+                self._grant_next()
+
+    def wait(self, ticket, timeout=None):
+        """True once the ticket is granted, False after timeout seconds"""
+        if self._slots is None:
+            return ticket.granted.wait(timeout)
+        # Releases in other processes do not set the event, look for their slots meanwhile
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while not ticket.granted.is_set():
+            remaining = self.poll_interval if deadline is None else deadline - time.perf_counter()
+            if remaining <= 0:
+                return False
+            if not ticket.granted.wait(min(remaining, self.poll_interval)):
+                self.poll()
+        return True
+
+    def position(self, ticket):
+        """Generations that start before this ticket's under round-robin order, 0 once granted"""
+        with self._lock:
+            if ticket.granted.is_set():
+                return 0
+            waiting = self._waiting.get(ticket.client)
+            if waiting is None or ticket not in waiting:
+                return 0
+            depth = waiting.index(ticket)
+            ahead = depth
+            before = True
+            for client, other in self._waiting.items():
+                if client == ticket.client:
+                    before = False
+                    continue
+                # Clients ahead in the round are served once more before this ticket's turn
+                ahead += min(len(other), depth + 1 if before else depth)
+            return ahead + 1
+
+    def release(self, ticket):
+        """Free the ticket's slot or queue place, safe to call more than once"""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted.is_set():
+                self.active -= 1
+                if ticket.slot is not None:
+                    self._slots.release(ticket.slot)
+                seconds = time.perf_counter() - ticket.started_at
+                self.average_seconds += 0.1 * (seconds - self.average_seconds)
+            else:
+                waiting = self._waiting.get(ticket.client)
+                if waiting is not None and ticket in waiting:
+                    waiting.remove(ticket)
+                    self.queued -= 1
+                    if not waiting:
+                        del self._waiting[ticket.client]
+            self._grant_next()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": self.active,
+                "queued": self.queued,
+                "clients_waiting": len(self._waiting),
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "slot_dir": self.slot_dir,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "average_seconds": round(self.average_seconds, 3)
+            }
@@ -0,0 +1,140 @@
+import json
+import time
+
+
+"""
+Server-Sent Events for streamed chat answers.
+Ollama produces one event per token; SSEStream coalesces tokens that arrive
+within a time window or up to a size budget into one chunk event, keeps the
+text in a list buffer and ends with the done event, optionally without
+repeating the full text the client has already received. The same stream
+works over async iterators for Chatbot/async_proxy.py. Streamers end failed
+streams with a StreamError chunk.
+"""
+
+# Raw UTF-8 keeps events small, chunk events only encode their text and format the rest
+_encode_string = json.JSONEncoder(ensure_ascii=False).encode
+
+
+class StreamError(str):
+    """
+    Last chunk of an Ollama stream that failed or ended before its done message.
+    Sent to clients like any chunk ("Error: ..."), told apart by type so an answer
+    is never judged by its text
+    """
+
+
+def sse_event(event):
+    return f"data: {json.dumps(event, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+
+class SSEStream:
+    def __init__(self, window_ms=50, max_chars=512, full_text=True, done_key='full_response'):
+        """
+        Turns a stream of text chunks into SSE chunk events and a done event
+
+        Parameters:
+        -----------
+        window_ms : float, optional
+            Tokens arriving within this long after the previous event are sent together.
+            The first token is always sent at once, 0 sends one event per token. Default is 50
+        max_chars : int, optional
+            Pending text is sent once it reaches this many characters. Default is 512
+        full_text : bool, optional
+            Repeat the whole answer in the done event. Default is True
+        done_key : str, optional
+            Field of the done event holding the whole answer. Default is 'full_response'
+        """
+        self.window = window_ms / 1000
+        self.max_chars = max_chars
+        self.full_text = full_text
+        self.done_key = done_key
+        self.parts = []
+        self.events_sent = 0
+        self._pending = []
+        self._pending_chars = 0
+        self._last_event = None
+
+    @property
+    def text(self):
+        """Everything streamed so far"""
+        return ''.join(self.parts)
+
+    def _chunk_event(self, pending):
+        self.events_sent += 1
+        return f'data: {{"content":{_encode_string("".join(pending))},"type":"chunk"}}\n\n'
+
+    def _add(self, chunk):
+        """Buffer one chunk, returns the chunk event to send now or None"""
+        if self._last_event is None:
+            self._last_event = time.perf_counter() - self.window
+        self.parts.append(chunk)
+        self._pending.append(chunk)
+        self._pending_chars += len(chunk)
+        now = time.perf_counter()
+        # A held token waits at most until the next one arrives
+        if self._pending_chars >= self.max_chars or now - self._last_event >= self.window:
+            self._last_event = now
+            return self._flush()
+        return None
+
+    def _flush(self):
+        """Chunk event for the held text, or None"""
+        if not self._pending:
+            return None
+        event = self._chunk_event(self._pending)
+        self._pending = []
+        self._pending_chars = 0
+        return event
+
+    def events(self, chunks):
+        """SSE chunk events for chunks followed by the done event"""
+        yield from self.chunk_events(chunks)
+        yield self.done_event()
+
+    def chunk_events(self, chunks):
+        """
+        SSE chunk events, each a str. Pending text is flushed before an exception
+        from chunks propagates, the caller then sends its error event
+        """
+        try:
+            for chunk in chunks:
+                event = self._add(chunk)
+                if event:
+                    yield event
+        except Exception:
+            event = self._flush()
+            if event:
+                yield event
+            raise
+        event = self._flush()
+        if event:
+            yield event
+
+    async def aevents(self, chunks):
+        """events() for an async iterator of chunks"""
+        async for event in self.achunk_events(chunks):
+            yield event
+        yield self.done_event()
+
+    async def achunk_events(self, chunks):
+        """chunk_events() for an async iterator of chunks"""
+        try:
+            async for chunk in chunks:
+                event = self._add(chunk)
+                if event:
+                    yield event
+        except Exception:
+            event = self._flush()
+            if event:
+                yield event
+            raise
+        event = self._flush()
+        if event:
+            yield event
+
+    def done_event(self):
+        event = {'type': 'done'}
+        if self.full_text:
+            event[self.done_key] = self.text
+        return sse_event(event)
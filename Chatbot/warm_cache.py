@@ -0,0 +1,245 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from Chatbot.cache import response_key
+from Chatbot.chatbot import OllamaStreamer
+from Chatbot.streaming import StreamError
+from data import DISEASE_CLASSES
+from fert import fertilizers
+
+
+"""
+Offline generation of chat answers for the questions that follow a detection.
+Question templates are filled in with every disease class and fertilizer,
+answered through OllamaStreamer with bounded concurrency and stored as
+zlib compressed chunk lists in SQLite, together with the temperature and
+max_tokens they were generated with. app.py reads the store (CHAT_ANSWER_STORE)
+before asking Ollama, for requests with the same options only. Run it off
+peak, already stored answers are skipped:
+    python -m Chatbot.warm_cache --store chat_answers.db --concurrency 2
+    CHAT_ANSWER_STORE=chat_answers.db python app.py
+"""
+
+DISEASE_TEMPLATES = (
+    "How do I treat {disease}?",
+    "What causes {disease}?",
+    "How can I prevent {disease}?"
+)
+
+FERTILIZER_TEMPLATES = (
+    "How do I apply {fertilizer} fertilizer?",
+    "Which crops benefit from {fertilizer}?"
+)
+
+
+def answer_key(model, prompt, temperature, max_tokens):
+    """SHA-256 over (model, normalized prompt, temperature, max_tokens), the chat cache's key"""
+    return response_key(model, prompt, temperature, max_tokens)
+
+
+class AnswerStore:
+    def __init__(self, path, readonly=False):
+        """
+        SQLite file of pre-generated answers, one row per (model, normalized prompt, temperature, max_tokens)
+
+        Parameters:
+        -----------
+        path : str
+            Database file, created unless readonly
+        readonly : bool, optional
+            Open for lookups only, as the app does. Default is False
+        """
+        self.path = path
+        self.readonly = readonly
+        self.hits = 0
+        self.misses = 0
+        # sqlite3 connections belong to one thread, opened lazily so none is inherited by forked workers
+        self._local = threading.local()
+        if not readonly:
+            with self._connection() as connection:
+                connection.execute("""
+                    CREATE TABLE IF NOT EXISTS answers (
+                        key TEXT PRIMARY KEY,
+                        model TEXT NOT NULL,
+                        prompt TEXT NOT NULL,
+                        chunks BLOB NOT NULL,
+                        created REAL NOT NULL,
+                        temperature REAL,
+                        max_tokens INTEGER
+                    )""")
+                columns = {row[1] for row in connection.execute("PRAGMA table_info(answers)")}
+                if 'temperature' not in columns:
+                    # Rows of stores written before the options were recorded no longer match any key
+                    connection.execute("ALTER TABLE answers ADD COLUMN temperature REAL")
+                    connection.execute("ALTER TABLE answers ADD COLUMN max_tokens INTEGER")
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.readonly:
+                connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            else:
+                connection = sqlite3.connect(self.path, timeout=30)
+                connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, model, prompt, temperature, max_tokens):
+        """
+        Returns:
+        --------
+        list
+            The chunks stored for the same model, prompt and options, or None
+        """
+        try:
+            row = self._connection().execute(
+                "SELECT chunks FROM answers WHERE key = ?",
+                (answer_key(model, prompt, temperature, max_tokens),)).fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Answer store lookup failed: {e}")
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, model, prompt, temperature, max_tokens, chunks):
+        blob = zlib.compress(json.dumps(list(chunks)).encode('utf-8'), 9)
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO answers (key, model, prompt, chunks, created, temperature, max_tokens) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (answer_key(model, prompt, temperature, max_tokens), model, prompt, blob, time.time(),
+                 float(temperature), max_tokens))
+
+    def __contains__(self, item):
+        """item is (model, prompt, temperature, max_tokens)"""
+        row = self._connection().execute(
+            "SELECT 1 FROM answers WHERE key = ?", (answer_key(*item),)).fetchone()
+        return row is not None
+
+    def stats(self):
+        try:
+            entries, size = self._connection().execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(chunks)), 0) FROM answers").fetchone()
+        except sqlite3.Error:
+            entries, size = None, None
+        return {"entries": entries, "compressed_bytes": size, "hits": self.hits, "misses": self.misses}
+
+
+def build_questions(disease_templates=DISEASE_TEMPLATES, fertilizer_templates=FERTILIZER_TEMPLATES,
+                    include_healthy=False):
+    """
+    Every template filled in with every disease class and fertilizer
+
+    Parameters:
+    -----------
+    disease_templates : sequence of str, optional
+        Formatted with {disease}, the class name as the app sends it, e.g. "Tomato___Late blight"
+    fertilizer_templates : sequence of str, optional
+        Formatted with {fertilizer}, a key of fert.fertilizers, e.g. "10:26:26 NPK"
+    include_healthy : bool, optional
+        Also ask about the healthy classes. Default is False
+    """
+    questions = []
+    for disease in DISEASE_CLASSES:
+        if include_healthy or not disease.endswith('healthy'):
+            questions.extend(template.format(disease=disease) for template in disease_templates)
+    for fertilizer in fertilizers:
+        questions.extend(template.format(fertilizer=fertilizer) for template in fertilizer_templates)
+    return questions
+
+
+def warm(ollama, store, questions, model, temperature=0.7, max_tokens=1000, concurrency=2, refresh=False):
+    """
+    Generate and store an answer for every question
+
+    Parameters:
+    -----------
+    ollama : OllamaStreamer
+    store : AnswerStore
+    questions : list of str
+    model : str
+    temperature : float, optional
+        Stored answers are only served to requests with this temperature. Default is
+        0.7 like the chat endpoints, 0 serves deterministic requests
+    max_tokens : int, optional
+        Default is 1000 like the chat endpoints, served only to requests with the same limit
+    concurrency : int, optional
+        Generations in flight at once, keep it at or below OLLAMA_NUM_PARALLEL. Default is 2
+    refresh : bool, optional
+        Regenerate answers that are already stored. Default is False
+
+    Returns:
+    --------
+    dict
+        Counts of generated, skipped and failed questions
+    """
+    pending = [question for question in questions
+               if refresh or (model, question, temperature, max_tokens) not in store]
+    counts = {"generated": 0, "skipped": len(questions) - len(pending), "failed": 0}
+    start = time.perf_counter()
+
+    def answer(question):
+        chunks = list(ollama.generate_text(model, question, temperature, max_tokens))
+        # OllamaStreamer ends failed streams with a StreamError chunk
+        if not chunks or isinstance(chunks[-1], StreamError):
+            raise RuntimeError(chunks[-1] if chunks else "empty answer")
+        store.put(model, question, temperature, max_tokens, chunks)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(answer, question): question for question in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                future.result()
+                counts["generated"] += 1
+            except Exception as e:
+                counts["failed"] += 1
+                logging.error(f"{futures[future]!r} failed: {e}")
+            if done % 10 == 0 or done == len(pending):
+                print(f"{done}/{len(pending)} answered in {time.perf_counter() - start:.0f}s")
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-generate chat answers for every disease class and fertilizer")
+    parser.add_argument('--store', default=os.environ.get('CHAT_ANSWER_STORE', 'chat_answers.db'))
+    parser.add_argument('--ollama-url', default=os.environ.get('OLLAMA_BASE_URL', "http://localhost:11434"))
+    parser.add_argument('--model', default=os.environ.get('OLLAMA_MODEL', "LeafEye-Mistral7b"))
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--temperature', type=float, default=0.7,
+                        help="Answers are served to requests with this temperature. Default is 0.7 like the app")
+    parser.add_argument('--max-tokens', type=int, default=1000)
+    parser.add_argument('--templates', help="JSON file with \"disease\" and \"fertilizer\" lists of templates")
+    parser.add_argument('--include-healthy', action='store_true')
+    parser.add_argument('--refresh', action='store_true', help="Regenerate stored answers")
+    args = parser.parse_args()
+
+    disease_templates, fertilizer_templates = DISEASE_TEMPLATES, FERTILIZER_TEMPLATES
+    if args.templates:
+        with open(args.templates) as f:
+            templates = json.load(f)
+        disease_templates = templates.get('disease', [])
+        fertilizer_templates = templates.get('fertilizer', [])
+
+    logging.basicConfig(level=logging.WARNING)
+    questions = build_questions(disease_templates, fertilizer_templates, args.include_healthy)
+    store = AnswerStore(args.store)
+    ollama = OllamaStreamer(args.ollama_url, pool_size=args.concurrency, read_timeout=300)
+    counts = warm(ollama, store, questions, args.model, args.temperature, args.max_tokens,
+                  args.concurrency, args.refresh)
+    print(f"{counts['generated']} generated, {counts['skipped']} already stored, {counts['failed']} failed")
+    print(store.stats())
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
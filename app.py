@@ -3,23 +3,34 @@ import necessary libraries
 """
 from pyexpat.errors import messages
 
-from werkzeug.utils import secure_filename
 import os
 import random
 import numpy as np
 import pandas as pd
 import cv2
-import tensorflow as tf
-from preprocessing import preprocess_image
+from preprocessing import initialize_preprocessor, synthetic_leaf, SEGMENTATION_TIERS
+from pipeline import DEFAULT_STAGES, PreprocessingError, build_pipeline
+from workers import PreprocessPool
 from data import DISEASE_CLASSES, DISEASE_RECOMMENDATIONS, DISEASE_DESCRIPTIONS
-import fertRecomm
 from fert import fertilizers
-from flask import Flask, request, Response, jsonify
+from flask import Flask, request, Response, jsonify, g
 from flask_cors import CORS
 import json
-import requests
 import logging
+import multiprocessing
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from Chatbot.chatbot import OllamaStreamer
+from Chatbot.cache import ResponseCache, SemanticCache, request_cache_key
+from Chatbot.warm_cache import AnswerStore
+from Chatbot.streaming import SSEStream, StreamError, sse_event
+from Chatbot.scheduler import GenerationScheduler, QueueFull
+import metrics
+from inference import BatchScheduler, batch_buckets, load_backend
+from storage import UploadStore
+from cache import PredictionCache, PerceptualHashIndex, PERCEPTUAL_HASHES, content_key, decode_thumbnail
+from startup import Subsystems
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
@@ -29,19 +40,160 @@ UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg','webp'}
 app.config['UPLOAD_FOLDER']     = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload
+# Keep a copy of every upload on disk, written off the request path
+app.config['ARCHIVE_UPLOADS'] = os.environ.get('ARCHIVE_UPLOADS', '1') == '1'
+# Archive budget, oldest uploads are evicted in the background
+app.config['UPLOAD_STORE_MAX_MB'] = int(os.environ.get('UPLOAD_STORE_MAX_MB', 1024))
+app.config['UPLOAD_STORE_MAX_AGE_DAYS'] = float(os.environ.get('UPLOAD_STORE_MAX_AGE_DAYS', 30))
+app.config['UPLOAD_STORE_EVICT_INTERVAL'] = float(os.environ.get('UPLOAD_STORE_EVICT_INTERVAL', 600))
+
+# Batch detection: images per request and threads preprocessing them
+app.config['BATCH_MAX_IMAGES'] = int(os.environ.get('BATCH_MAX_IMAGES', 32))
+app.config['PREPROCESS_WORKERS'] = int(os.environ.get('PREPROCESS_WORKERS', 4))
+
+# Background removal: rembg model ('u2net', 'u2netp', 'silueta', 'isnet-general-use', ...)
+# and number of pooled sessions
+app.config['SEGMENTATION_MODEL'] = os.environ.get('SEGMENTATION_MODEL', 'u2net')
+app.config['SEGMENTATION_SESSIONS'] = int(os.environ.get('SEGMENTATION_SESSIONS', 2))
+# Default segmentation tier ('full', 'fast' or 'mask'), requests may pick another with a `tier` field
+app.config['SEGMENTATION_TIER'] = os.environ.get('SEGMENTATION_TIER', 'full')
+app.config['SEGMENTATION_WORKING_SIZE'] = int(os.environ.get('SEGMENTATION_WORKING_SIZE', 512))
+# Preprocessing stages in order, e.g. drop 'segmentation' on overloaded nodes
+app.config['PREPROCESS_STAGES'] = os.environ.get('PREPROCESS_STAGES', ','.join(DEFAULT_STAGES)).split(',')
+# Preprocess in this many worker processes (0 runs the pipeline in the request thread)
+app.config['PREPROCESS_PROCESSES'] = int(os.environ.get('PREPROCESS_PROCESSES', 0))
+
+# Prediction cache keyed by the hash of the uploaded bytes
+app.config['PREDICTION_CACHE_SIZE'] = int(os.environ.get('PREDICTION_CACHE_SIZE', 1024))
+app.config['PREDICTION_CACHE_TTL'] = float(os.environ.get('PREDICTION_CACHE_TTL', 3600))
+
+# Near-duplicate lookup for re-photographed or re-encoded leaves (negative distance disables it)
+app.config['NEAR_DUPLICATE_HASH'] = os.environ.get('NEAR_DUPLICATE_HASH', 'dhash')
+app.config['NEAR_DUPLICATE_MAX_DISTANCE'] = int(os.environ.get('NEAR_DUPLICATE_MAX_DISTANCE', 6))
+# Hashes kept per segmentation tier
+app.config['NEAR_DUPLICATE_INDEX_SIZE'] = int(os.environ.get('NEAR_DUPLICATE_INDEX_SIZE', 200000))
+
+# Micro-batching: concurrent /api/detect requests share one forward pass
+app.config['INFERENCE_MAX_BATCH_SIZE'] = int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 16))
+app.config['INFERENCE_MAX_WAIT_MS'] = float(os.environ.get('INFERENCE_MAX_WAIT_MS', 10))
+
+# Inference backend: 'keras' (full TensorFlow), 'tflite' (interpreter pool),
+# 'onnx' or 'onnx-int8' (onnxruntime, built by `python modelConversion.py onnx`)
+app.config['INFERENCE_BACKEND'] = os.environ.get('INFERENCE_BACKEND', 'keras')
+app.config['MODEL_PATH'] = os.environ.get('MODEL_PATH', 'MobileNetV2.keras')
+app.config['TFLITE_MODEL_PATH'] = os.environ.get('TFLITE_MODEL_PATH', 'MobileNetV2.tflite')
+app.config['ONNX_MODEL_PATH'] = os.environ.get('ONNX_MODEL_PATH', 'MobileNetV2.onnx')
+app.config['ONNX_INT8_MODEL_PATH'] = os.environ.get('ONNX_INT8_MODEL_PATH', 'MobileNetV2.int8.onnx')
+app.config['INFERENCE_WORKERS'] = int(os.environ.get('INFERENCE_WORKERS', 4))
+app.config['INFERENCE_THREADS'] = int(os.environ.get('INFERENCE_THREADS', 1))
+
+# How the model, rembg and fertilizer artifacts are loaded: 'background' (a thread started
+# at import, /api/ready turns 200 once they are warm), 'lazy' (first request) or 'eager'
+app.config['STARTUP_MODE'] = os.environ.get('STARTUP_MODE', 'background')
+
+# Directory the server's worker processes write their metrics to, so /metrics on any worker
+# reports all of them (serve.py sets it for more than one worker), and seconds between writes
+app.config['METRICS_MULTIPROC_DIR'] = os.environ.get('METRICS_MULTIPROC_DIR') or None
+app.config['METRICS_WRITE_INTERVAL'] = float(os.environ.get('METRICS_WRITE_INTERVAL', 5))
+
+# Keep-alive connections to Ollama, connection errors are retried until a response arrives
+app.config['OLLAMA_POOL_SIZE'] = int(os.environ.get('OLLAMA_POOL_SIZE', 16))
+app.config['OLLAMA_CONNECT_TIMEOUT'] = float(os.environ.get('OLLAMA_CONNECT_TIMEOUT', 5))
+app.config['OLLAMA_READ_TIMEOUT'] = float(os.environ.get('OLLAMA_READ_TIMEOUT', 60))
+app.config['OLLAMA_RETRIES'] = int(os.environ.get('OLLAMA_RETRIES', 2))
+
+# Cached chat answers for temperature 0 requests and requests with "cache": true
+app.config['CHAT_CACHE_MAX_MB'] = float(os.environ.get('CHAT_CACHE_MAX_MB', 64))
+app.config['CHAT_CACHE_PATH'] = os.environ.get('CHAT_CACHE_PATH') or None  # e.g. chat_cache.db, shared by all workers
+# Answers pre-generated off peak by `python -m Chatbot.warm_cache`, checked before Ollama
+app.config['CHAT_ANSWER_STORE'] = os.environ.get('CHAT_ANSWER_STORE') or None  # e.g. chat_answers.db
+# Rephrased questions hit by prompt embedding, one Ollama embedding call per cacheable miss
+app.config['CHAT_SEMANTIC_CACHE'] = os.environ.get('CHAT_SEMANTIC_CACHE', '0') == '1'
+app.config['CHAT_EMBED_MODEL'] = os.environ.get('CHAT_EMBED_MODEL', 'nomic-embed-text')
+app.config['CHAT_SEMANTIC_THRESHOLD'] = float(os.environ.get('CHAT_SEMANTIC_THRESHOLD', 0.92))
+app.config['CHAT_SEMANTIC_CACHE_SIZE'] = int(os.environ.get('CHAT_SEMANTIC_CACHE_SIZE', 5000))
+
+# Streamed answers: tokens within the window (or up to the size budget) share one SSE event,
+# 0 sends one event per token. The done event repeats the full text unless disabled
+app.config['CHAT_STREAM_WINDOW_MS'] = float(os.environ.get('CHAT_STREAM_WINDOW_MS', 50))
+app.config['CHAT_STREAM_MAX_CHARS'] = int(os.environ.get('CHAT_STREAM_MAX_CHARS', 512))
+app.config['CHAT_DONE_FULL_TEXT'] = os.environ.get('CHAT_DONE_FULL_TEXT', '1') == '1'
+
+# Admission control: generations sent to Ollama at once (match OLLAMA_NUM_PARALLEL), requests
+# waiting for a slot (round-robin across clients) and how long they may wait. The cap holds for
+# every process sharing CHAT_SLOT_DIR (set by serve.py for its workers), otherwise per process
+app.config['CHAT_MAX_CONCURRENT'] = int(os.environ.get('CHAT_MAX_CONCURRENT', 4))
+app.config['CHAT_SLOT_DIR'] = os.environ.get('CHAT_SLOT_DIR') or None
+app.config['CHAT_MAX_QUEUE'] = int(os.environ.get('CHAT_MAX_QUEUE', 32))
+app.config['CHAT_MAX_QUEUED_PER_CLIENT'] = int(os.environ.get('CHAT_MAX_QUEUED_PER_CLIENT', 4))
+app.config['CHAT_QUEUE_TIMEOUT'] = float(os.environ.get('CHAT_QUEUE_TIMEOUT', 60))
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
 # Ollama configuration
-OLLAMA_BASE_URL = "http://localhost:11434"  # Default Ollama URL
+OLLAMA_BASE_URL = os.environ.get('OLLAMA_BASE_URL', "http://localhost:11434")  # e.g. benchmarks/ollama_stub.py
 DEFAULT_MODEL = "LeafEye-Mistral7b"
 
-# Initialize Ollama streamer
-ollama = OllamaStreamer()
+generation_scheduler = GenerationScheduler(
+    max_concurrent=app.config['CHAT_MAX_CONCURRENT'],
+    max_queue=app.config['CHAT_MAX_QUEUE'],
+    max_per_client=app.config['CHAT_MAX_QUEUED_PER_CLIENT'],
+    slot_dir=app.config['CHAT_SLOT_DIR']
+)
+semantic_cache = None
+if app.config['CHAT_SEMANTIC_CACHE']:
+    semantic_cache = SemanticCache(
+        capacity=app.config['CHAT_SEMANTIC_CACHE_SIZE'],
+        threshold=app.config['CHAT_SEMANTIC_THRESHOLD']
+    )
+
+
+def load_upload_store():
+    # Create uploads directory if it doesn't exist
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    # Archived uploads are stored by content hash, written and evicted by background threads
+    return UploadStore(
+        app.config['UPLOAD_FOLDER'],
+        max_bytes=app.config['UPLOAD_STORE_MAX_MB'] * 1024 * 1024,
+        max_age_seconds=app.config['UPLOAD_STORE_MAX_AGE_DAYS'] * 24 * 3600,
+        evict_interval=app.config['UPLOAD_STORE_EVICT_INTERVAL']
+    )
+
+
+def load_chat_cache():
+    # Opens CHAT_CACHE_PATH (SQLite, shared with the other workers) only in processes that serve chat requests
+    return ResponseCache(
+        max_bytes=app.config['CHAT_CACHE_MAX_MB'] * 1024 * 1024,
+        path=app.config['CHAT_CACHE_PATH']
+    )
+
+
+def load_ollama():
+    # Initialize Ollama streamer
+    return OllamaStreamer(
+        OLLAMA_BASE_URL,
+        pool_size=app.config['OLLAMA_POOL_SIZE'],
+        connect_timeout=app.config['OLLAMA_CONNECT_TIMEOUT'],
+        read_timeout=app.config['OLLAMA_READ_TIMEOUT'],
+        retries=app.config['OLLAMA_RETRIES']
+    )
+
+
+def load_answer_store():
+    """The pre-generated answers, or None when CHAT_ANSWER_STORE is unset or missing"""
+    if not app.config['CHAT_ANSWER_STORE']:
+        return None
+    if not os.path.exists(app.config['CHAT_ANSWER_STORE']):
+        logging.warning(f"Answer store {app.config['CHAT_ANSWER_STORE']} not found, run `python -m Chatbot.warm_cache`")
+        return None
+    return AnswerStore(app.config['CHAT_ANSWER_STORE'], readonly=True)
+
 
-# Create uploads directory if it doesn't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+def archive_upload(filename, image_bytes, key=None):
+    # key is the content hash when the request already computed it
+    if app.config['ARCHIVE_UPLOADS']:
+        upload_store.get().put(image_bytes, filename, key)
 
 
 # Helper function to check allowed file extensions
@@ -52,39 +204,252 @@ def allowed_file(filename):
 
 
 def load_model():
-    print("Loading model...")
-    model_out = tf.keras.models.load_model("MobileNetV2.keras")
-    print("Model loaded")
-    print(model_out.summary())
-    return model_out
+    return load_backend(
+        app.config['INFERENCE_BACKEND'],
+        keras_path=app.config['MODEL_PATH'],
+        tflite_path=app.config['TFLITE_MODEL_PATH'],
+        onnx_path=app.config['ONNX_MODEL_PATH'],
+        onnx_int8_path=app.config['ONNX_INT8_MODEL_PATH'],
+        pool_size=app.config['INFERENCE_WORKERS'],
+        num_threads=app.config['INFERENCE_THREADS'],
+        max_batch_size=app.config['INFERENCE_MAX_BATCH_SIZE']
+    )
+
+
+def load_inference():
+    """Load the backend and warm it with synthetic batches"""
+    model = load_model()
+    # The first predict of each preallocated batch shape pays for tracing or allocation, not a user request
+    for batch_size in getattr(model, 'buckets', batch_buckets(app.config['INFERENCE_MAX_BATCH_SIZE'])):
+        model.predict(np.zeros((batch_size, 224, 224, 3), dtype=np.uint8))
+    return model
+
+
+def start_inference(model):
+    """Per-process batching scheduler around the (possibly preloaded) backend"""
+    # Batches tensors from concurrent requests into single model.predict calls.
+    # Thread safe backends get one batching thread per pooled interpreter.
+    scheduler = BatchScheduler(
+        model.predict,
+        max_batch_size=app.config['INFERENCE_MAX_BATCH_SIZE'],
+        max_wait_ms=app.config['INFERENCE_MAX_WAIT_MS'],
+        workers=app.config['INFERENCE_WORKERS'] if model.thread_safe else 1
+    ).start()
+    scheduler.observers.append(observe_batch)
+    return scheduler
+
+
+preprocess_options = dict(
+    segmentation_model=app.config['SEGMENTATION_MODEL'],
+    session_pool_size=app.config['SEGMENTATION_SESSIONS'],
+    segmentation_tier=app.config['SEGMENTATION_TIER'],
+    working_size=app.config['SEGMENTATION_WORKING_SIZE'],
+    stages=app.config['PREPROCESS_STAGES']
+)
+
+def load_preprocessing():
+    """Build the pipeline (or worker processes) and push a synthetic leaf through every stage"""
+    if app.config['PREPROCESS_PROCESSES'] > 0:
+        # Each worker process builds its own pipeline and rembg sessions, tensors come back via shared memory
+        preprocessor = PreprocessPool(app.config['PREPROCESS_PROCESSES'], preprocess_options)
+        # Every worker warms itself in the pool initializer, ready once all of them have
+        preprocessor.wait_ready()
+    else:
+        # rembg sessions are created and warmed once here, not per request
+        preprocessor = build_pipeline(initialize_preprocessor(**preprocess_options))
+        # Also compiles the numba kernels
+        preprocessor.run(synthetic_leaf())
+    preprocessor.observers.append(lambda stage, seconds, nbytes: stage_latency.labels(stage).observe(seconds))
+    return preprocessor
+
+
+def load_fertilizer_model():
+    # Unpickles the encoders and model and parses the crop dataset on import
+    import fertRecomm
+    return fertRecomm
+
+
+def fork_safe_subsystems():
+    """
+    Subsystems that may be loaded in a master process and shared with forked workers
 
+    TensorFlow and multi-threaded onnxruntime sessions (rembg) start thread pools
+    that do not survive fork(), so only single threaded TFLite/ONNX models qualify;
+    with the keras backend every worker loads its own model (serve.py warns)
+    """
+    names = ['fertilizer']
+    if app.config['INFERENCE_BACKEND'] != 'keras' and app.config['INFERENCE_THREADS'] == 1:
+        names.append('model')
+    return names
+
+
+subsystems = Subsystems()
+# Built in each serving process: they start threads or read files, never in a preloading master
+# or in the spawned preprocessing workers that re-import this module
+upload_store = subsystems.register('uploads', load_upload_store)
+chat_cache = subsystems.register('chat_cache', load_chat_cache)
+answer_store = subsystems.register('answer_store', load_answer_store)
+ollama = subsystems.register('ollama', load_ollama)
+inference_engine = subsystems.register('model', load_inference, start_inference)
+preprocessor = subsystems.register('preprocessing', load_preprocessing)
+fertilizer_model = subsystems.register('fertilizer', load_fertilizer_model)
+
+
+def preprocess_image(image, tier=None):
+    """(tensor or None, whether segmentation fell back), raises PreprocessingError for unreadable images"""
+    overrides = {'segmentation_tier': tier} if tier and tier != app.config['SEGMENTATION_TIER'] else None
+    pipeline_or_pool = preprocessor.get()
+    if isinstance(pipeline_or_pool, PreprocessPool):
+        return pipeline_or_pool.preprocess(image, overrides)
+    config = dict(pipeline_or_pool.config, **overrides) if overrides else None
+    ctx = pipeline_or_pool.run(image, config)
+    return ctx.result, ctx.fallback
+
+# Repeated uploads of the same bytes reuse the earlier prediction
+prediction_cache = PredictionCache(
+    max_entries=app.config['PREDICTION_CACHE_SIZE'],
+    ttl_seconds=app.config['PREDICTION_CACHE_TTL']
+)
+
+# One index per segmentation tier, like the exact cache keys, so a tier never answers with another tier's prediction
+near_duplicates = {
+    tier: PerceptualHashIndex(
+        capacity=app.config['NEAR_DUPLICATE_INDEX_SIZE'],
+        max_distance=app.config['NEAR_DUPLICATE_MAX_DISTANCE']
+    )
+    for tier in SEGMENTATION_TIERS
+}
+perceptual_hash = PERCEPTUAL_HASHES[app.config['NEAR_DUPLICATE_HASH']]
+
+# Shared by batch requests to preprocess their images in parallel
+preprocess_pool = ThreadPoolExecutor(max_workers=app.config['PREPROCESS_WORKERS'],
+                                     thread_name_prefix="preprocess")
+
+# Prometheus metrics served at /metrics
+http_requests = metrics.REGISTRY.counter(
+    'leafeye_http_requests_total', "HTTP requests by endpoint and status", ('endpoint', 'method', 'status'))
+http_latency = metrics.REGISTRY.histogram(
+    'leafeye_http_request_duration_seconds', "Time until the response (or stream) starts", ('endpoint',))
+stage_latency = metrics.REGISTRY.histogram(
+    'leafeye_stage_duration_seconds', "Preprocessing stage and inference batch latency", ('stage',))
+inference_batch_size = metrics.REGISTRY.histogram(
+    'leafeye_inference_batch_size', "Images per forward pass", buckets=(1, 2, 4, 8, 16, 32, 64))
+fertilizer_latency = metrics.REGISTRY.histogram(
+    'leafeye_fertilizer_prediction_seconds', "Fertilizer encoding and prediction latency")
+ollama_ttft = metrics.REGISTRY.histogram(
+    'leafeye_ollama_time_to_first_token_seconds', "Time until Ollama streams the first token", ('model',))
+ollama_token_rate = metrics.REGISTRY.histogram(
+    'leafeye_ollama_tokens_per_second', "Ollama streaming rate after the first token", ('model',),
+    buckets=metrics.RATE_BUCKETS)
+ollama_pool = metrics.REGISTRY.gauge('leafeye_ollama_pool', "Ollama connection pool counters", ('stat',))
+generations = metrics.REGISTRY.gauge('leafeye_ollama_generations', "Generations running and waiting for a slot",
+                                     ('state',))
+generation_queue_wait = metrics.REGISTRY.histogram(
+    'leafeye_ollama_queue_wait_seconds', "Time a generation waited for a slot")
+generation_rejected = metrics.REGISTRY.counter(
+    'leafeye_ollama_rejected_total', "Generations refused by admission control", ('reason',))
+queue_depth = metrics.REGISTRY.gauge('leafeye_queue_depth', "Items waiting in internal queues", ('queue',))
+subsystem_ready = metrics.REGISTRY.gauge('leafeye_subsystem_ready', "1 once a subsystem is loaded and warm",
+                                         ('subsystem',))
+
+# Callbacks raise (and are skipped) until their subsystem has loaded
+queue_depth.set_function(lambda: inference_engine.peek().depth(), 'inference')
+queue_depth.set_function(lambda: upload_store.peek().writer.depth(), 'upload_writer')
+queue_depth.set_function(preprocess_pool._work_queue.qsize, 'batch_preprocess')
+if app.config['PREPROCESS_PROCESSES'] > 0:
+    queue_depth.set_function(lambda: preprocessor.peek().depth(), 'preprocess_processes')
+for state in ('active', 'queued'):
+    generations.set_function(lambda state=state: generation_scheduler.stats()[state], state)
+for stat in ('connections_opened', 'idle', 'requests', 'streaming', 'retried', 'failed'):
+    ollama_pool.set_function(lambda stat=stat: ollama.peek().pool_stats()[stat], stat)
+for name in subsystems.status():
+    subsystem_ready.set_function(lambda name=name: int(subsystems[name].state == 'ready'), name)
+
+# Merges the metrics of every worker process, its writer thread is started per worker by serve.py
+metrics_collector = None
+if app.config['METRICS_MULTIPROC_DIR']:
+    metrics_collector = metrics.MultiProcessCollector(
+        metrics.REGISTRY, app.config['METRICS_MULTIPROC_DIR'], app.config['METRICS_WRITE_INTERVAL'])
+
+
+def observe_batch(batch_size, seconds):
+    stage_latency.labels('inference').observe(seconds)
+    inference_batch_size.observe(batch_size)
+
+
+# Spawned preprocessing workers re-import the main module, only the parent loads subsystems.
+# parent_process() is only set after that import, the worker's name already before it
+if multiprocessing.current_process().name == 'MainProcess':
+    subsystems.start(app.config['STARTUP_MODE'])
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_requests.labels(endpoint, request.method, response.status_code).inc()
+    if 'request_start' in g:
+        http_latency.labels(endpoint).observe(time.perf_counter() - g.request_start)
+    return response
 
-# Global variable for the model
-model = load_model()
 
+# Function to predict disease from an image
 
 
+def requested_tier():
+    """Segmentation tier for this request, honouring an optional `tier` field"""
+    tier = request.values.get('tier') or app.config['SEGMENTATION_TIER']
+    if tier not in SEGMENTATION_TIERS:
+        raise ValueError(f"Unknown segmentation tier '{tier}', expected one of {', '.join(SEGMENTATION_TIERS)}")
+    return tier
 
 
+def predict_disease(image, tier=None):
+    """image is a file path, the encoded upload bytes or an RGB array"""
 
+    preprocessed, fallback = preprocess_image(image, tier)
 
-# Function to predict disease from an image
+    if preprocessed is None:
+        return None
 
+    prediction = inference_engine.get().predict(preprocessed)
 
-def predict_disease(image_path):
+    return format_prediction(prediction, fallback)
 
-    preprocessed = preprocess_image(image_path)
 
-    if preprocessed is None:
-        return None
+def predict_diseases(images, tier=None):
+    """
+    Predict several images with parallel preprocessing and batched inference
+
+    Returns a list aligned with images holding either a prediction dict,
+    None (not a suitable plant image) or the exception raised for that image
+    """
+    def safe_preprocess(image):
+        try:
+            return preprocess_image(image, tier)
+        except Exception as e:
+            return e
 
-    preprocessed = np.expand_dims(preprocessed,axis=0)
-    preprocessed = (preprocessed*255).astype(np.uint8)
-    prediction = model.predict(preprocessed)
+    preprocessed = list(preprocess_pool.map(safe_preprocess, images))
 
+    usable = [i for i, item in enumerate(preprocessed) if not isinstance(item, Exception) and item[0] is not None]
+    futures = inference_engine.get().submit_many([preprocessed[i][0] for i in usable])
 
+    results = [item if isinstance(item, Exception) else None for item in preprocessed]
+    for i, future in zip(usable, futures):
+        try:
+            results[i] = format_prediction(future.result(), preprocessed[i][1])
+        except Exception as e:
+            results[i] = e
+    return results
 
 
+def format_prediction(prediction, fallback=False):
+    """Turn the score vector of one image into the detect response fields, fallback marks a skipped segmentation"""
     mock_prediction_index = np.argmax(prediction)
     confidence = np.max(prediction)
 
@@ -97,7 +462,8 @@ def predict_disease(image_path):
         "disease": predicted_class,
         "confidence": float(confidence),
         "recommendations": recommendations,
-        "description":DISEASE_DESCRIPTIONS[predicted_class]
+        "description":DISEASE_DESCRIPTIONS[predicted_class],
+        "preprocessing_fallback": fallback
     }
 
 
@@ -107,13 +473,22 @@ def recommend_fert():
     if not request.is_json:
         return jsonify({"error": "Request must be JSON"}), 415
     print(data)
-    df = fertRecomm.preprocess_data(data["input"])
+    start = time.perf_counter()
+    fert_model = fertilizer_model.get()
+    df = fert_model.preprocess_data(data["input"])
+    fert = fert_model.predict(df)
+    fertilizer_latency.observe(time.perf_counter() - start)
     link_df = pd.read_csv("project_variables/Crop_English_Links.csv")
     link_df = link_df[link_df["Crop"] == data["input"][1]].reset_index()
     link = link_df["Link"][0]
-    fert = fertRecomm.predict(df)
     return jsonify({"fertilizer": fert, "description": fertilizers[fert], "link": link,"success":True})
 
+def is_fallback(value):
+    """Whether a cached (prediction, distance) pair came from a degraded preprocessing run"""
+    prediction = value[0]
+    return prediction is not None and prediction["preprocessing_fallback"]
+
+
 @app.route('/api/detect', methods=['POST'])
 def detect_disease():
     # Check if the post request has the file part
@@ -137,12 +512,41 @@ def detect_disease():
         }), 400
 
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        image_bytes = file.read()
+        try:
+            tier = requested_tier()
+        except ValueError as e:
+            return jsonify({
+                "success": False,
+                "message": str(e)
+            }), 400
+        # Keys the prediction cache and names the archived upload
+        image_key = content_key(image_bytes)
+
+        def save_and_predict():
+            # Checked before background removal: a close enough earlier photo reuses its prediction
+            image_hash = None
+            duplicates = near_duplicates[tier]
+            if duplicates.max_distance >= 0:
+                thumbnail = decode_thumbnail(image_bytes)
+                if thumbnail is not None:
+                    image_hash = perceptual_hash(thumbnail)
+                    match, distance = duplicates.lookup(image_hash)
+                    if distance is not None:
+                        return match, distance
+
+            archive_upload(file.filename, image_bytes, image_key)
+            prediction = predict_disease(image_bytes, tier)
+            # Predictions made after a segmentation fallback are answered but never reused
+            if image_hash is not None and not is_fallback((prediction, None)):
+                duplicates.add(image_hash, prediction)
+            return prediction, None
 
         try:
-            result = predict_disease(file_path)
+            # Identical uploads (retries, resubmits) skip preprocessing and inference
+            cache_key = f"{tier}:{image_key}"
+            (result, distance), _ = prediction_cache.get_or_compute(
+                cache_key, save_and_predict, cacheable=lambda value: not is_fallback(value))
             if result is None:
                 print("failed 3")
                 return jsonify({
@@ -155,9 +559,17 @@ def detect_disease():
                 "disease": result["disease"],
                 "confidence": result["confidence"],
                 "recommendations": result["recommendations"],
-                "description": result["description"]
+                "description": result["description"],
+                "near_duplicate": distance is not None,
+                "hash_distance": distance,
+                "preprocessing_fallback": result["preprocessing_fallback"]
             })
 
+        except PreprocessingError as e:
+            return jsonify({
+                "success": False,
+                "message": f"Could not process image: {str(e)}"
+            }), 400
         except Exception as e:
             return jsonify({
                 "success": False,
@@ -170,28 +582,251 @@ def detect_disease():
     }), 400
 
 
+class BatchTooLarge(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def collect_batch_uploads():
+    """
+    Read the images of a batch request (multipart list or zip archive) into memory.
+    Zip entries are checked against BATCH_MAX_IMAGES and MAX_CONTENT_LENGTH (per entry
+    and in total, by their declared uncompressed size) before anything is decompressed
+
+    Returns a list of (name, image bytes or None, error message or None),
+    raises BatchTooLarge with the HTTP status to answer
+    """
+    items = []
+    max_images = app.config['BATCH_MAX_IMAGES']
+    max_bytes = app.config['MAX_CONTENT_LENGTH']
+    extracted_bytes = 0
+    for file in request.files.getlist('images') + request.files.getlist('image'):
+        if file.filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(file.stream) as archive:
+                # Directories and non-image entries (e.g. __MACOSX metadata) are skipped, not counted
+                entries = [info for info in archive.infolist()
+                           if not info.is_dir() and allowed_file(os.path.basename(info.filename))]
+                if len(items) + len(entries) > max_images:
+                    raise BatchTooLarge(f"Too many images, at most {max_images} per request", 400)
+                for info in entries:
+                    extracted_bytes += info.file_size
+                    if info.file_size > max_bytes or extracted_bytes > max_bytes:
+                        raise BatchTooLarge(f"Archive contents exceed {max_bytes // (1024 * 1024)}MB", 413)
+                for info in entries:
+                    # ZipExtFile stops at the declared size and checks the CRC, so the limits above hold
+                    items.append((os.path.basename(info.filename), archive.read(info), None))
+        elif file.filename == '':
+            items.append((file.filename, None, "No image selected"))
+        elif not allowed_file(file.filename):
+            items.append((file.filename, None, "File type not allowed"))
+        else:
+            items.append((file.filename, file.read(), None))
+    return items
+
+
+@app.route('/api/detect/batch', methods=['POST'])
+def detect_disease_batch():
+    """
+    Detect diseases for several images in one request
+    Expected multipart fields:
+        images: one or more image files, or zip archives of images
+        tier: optional segmentation tier ('full', 'fast' or 'mask')
+    """
+    try:
+        tier = requested_tier()
+        items = collect_batch_uploads()
+    except zipfile.BadZipFile:
+        return jsonify({
+            "success": False,
+            "message": "Invalid zip archive"
+        }), 400
+    except BatchTooLarge as e:
+        return jsonify({
+            "success": False,
+            "message": str(e)
+        }), e.status
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "message": str(e)
+        }), 400
+
+    if not items:
+        return jsonify({
+            "success": False,
+            "message": "No image file provided"
+        }), 400
+    if len(items) > app.config['BATCH_MAX_IMAGES']:
+        return jsonify({
+            "success": False,
+            "message": f"Too many images, at most {app.config['BATCH_MAX_IMAGES']} per request"
+        }), 400
+
+    images = [image_bytes for _, image_bytes, error in items if error is None]
+    for name, image_bytes, error in items:
+        if error is None:
+            archive_upload(name, image_bytes)
+    predictions = iter(predict_diseases(images, tier))
+
+    results = []
+    for name, _, error in items:
+        result = next(predictions) if error is None else None
+        if error is not None:
+            results.append({"filename": name, "success": False, "message": error})
+        elif isinstance(result, PreprocessingError):
+            results.append({"filename": name, "success": False,
+                            "message": f"Could not process image: {str(result)}"})
+        elif isinstance(result, Exception):
+            results.append({"filename": name, "success": False,
+                            "message": f"Error during disease detection: {str(result)}"})
+        elif result is None:
+            results.append({"filename": name, "success": False,
+                            "message": "Error in detecting disease please upload a suitable plant image"})
+        else:
+            results.append({
+                "filename": name,
+                "success": True,
+                "disease": result["disease"],
+                "confidence": result["confidence"],
+                "recommendations": result["recommendations"],
+                "description": result["description"],
+                "preprocessing_fallback": result["preprocessing_fallback"]
+            })
+
+    return jsonify({
+        "success": any(item["success"] for item in results),
+        "results": results
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    exposition = metrics_collector.expose() if metrics_collector else metrics.REGISTRY.expose()
+    return Response(exposition, content_type=metrics.CONTENT_TYPE)
+
+
 # Health check endpoint
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({
         "status": "healthy",
-        "message": "API is running"
+        "message": "API is running",
+        "prediction_cache": prediction_cache.stats(),
+        "chat_cache": chat_cache.peek().stats() if chat_cache.peek() else chat_cache.status(),
+        "generations": generation_scheduler.stats(),
+        "semantic_cache": semantic_cache.stats() if semantic_cache else None,
+        "answer_store": answer_store.peek().stats() if answer_store.peek() else answer_store.status(),
+        "near_duplicates": {tier: index.stats() for tier, index in near_duplicates.items()},
+        "upload_store": upload_store.peek().stats() if upload_store.peek() else upload_store.status(),
+        "preprocessing": preprocessor.peek().stats() if preprocessor.peek() else preprocessor.status()
     })
 
+
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe, 503 until every subsystem (model, rembg, fertilizer, stores) is loaded and warm"""
+    ready = subsystems.ready()
+    return jsonify({
+        "ready": ready,
+        "subsystems": subsystems.status()
+    }), 200 if ready else 503
+
 @app.route('/health', methods=['GET'])
 def health_check_ollama():
     """Health check endpoint"""
     try:
         # Test Ollama connection
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
+        response = ollama.get().get('/api/tags')
         if response.status_code == 200:
-            return jsonify({"status": "healthy", "ollama": "connected"})
+            return jsonify({"status": "healthy", "ollama": "connected", "pool": ollama.get().pool_stats()})
         else:
             return jsonify({"status": "unhealthy", "ollama": "disconnected"}), 503
     except Exception as e:
         return jsonify({"status": "unhealthy", "error": str(e)}), 503
 
 
+def cached_answer(model, prompt, temperature, max_tokens, cache_key, use_store=True):
+    """
+    Chunks of an answer pre-generated in the answer store (with the same temperature and
+    max_tokens) or found in the chat cache or the semantic cache
+
+    Returns:
+    --------
+    tuple
+        (chunks or None, prompt embedding to store the generated answer under or None)
+    """
+    store = answer_store.get() if use_store else None
+    cached = store.get(model, prompt, temperature, max_tokens) if store else None
+    if cached is None and cache_key:
+        cached = chat_cache.get().get(cache_key)
+    embedding = None
+    if cached is None and cache_key and semantic_cache is not None:
+        try:
+            embedding = ollama.get().embed(app.config['CHAT_EMBED_MODEL'], prompt)
+            cached, _ = semantic_cache.lookup(model, temperature, max_tokens, embedding)
+        except Exception as e:
+            # Without an embedding the request is simply not semantically cached
+            logging.error(f"Prompt embedding failed: {e}")
+    return cached, embedding
+
+
+def generate_answer(model, prompt, temperature, max_tokens, cache_key, embedding=None):
+    """Chunks streamed from Ollama, cached once complete"""
+    chunks = []
+    for chunk in metrics.timed_stream(ollama.get().generate_text(
+            model=model,
+            prompt=prompt,
+            temperature=temperature,
+            max_tokens=max_tokens
+    ), ollama_ttft.labels(model), ollama_token_rate.labels(model)):
+        chunks.append(chunk)
+        yield chunk
+    # OllamaStreamer ends failed streams with a StreamError chunk, whatever the model's text
+    if cache_key and chunks and not isinstance(chunks[-1], StreamError):
+        chat_cache.get().put(cache_key, chunks)
+        if embedding is not None:
+            semantic_cache.add(model, temperature, max_tokens, embedding, chunks)
+
+
+def client_id():
+    """Fairness key of the generation queue: the X-Client-Id header if sent, else the remote address"""
+    return request.headers.get('X-Client-Id') or request.remote_addr
+
+
+def admit_generation():
+    """
+    Ticket for a generation slot
+
+    Returns:
+    --------
+    tuple
+        (ticket, None), or (None, error response) with a Retry-After header when the queue is full
+    """
+    try:
+        return generation_scheduler.enter(client_id()), None
+    except QueueFull as e:
+        generation_rejected.labels(str(e.status)).inc()
+        return None, (jsonify({"success": False, "error": str(e), "retry_after": e.retry_after}), e.status,
+                      {'Retry-After': str(e.retry_after)})
+
+
+def queue_events(ticket):
+    """SSE queue events with the ticket's position until it gets a slot, TimeoutError after CHAT_QUEUE_TIMEOUT"""
+    deadline = ticket.enqueued_at + app.config['CHAT_QUEUE_TIMEOUT']
+    position = None
+    while not ticket.granted.is_set():
+        current = generation_scheduler.position(ticket)
+        if current != position:
+            position = current
+            yield sse_event({'type': 'queue', 'position': position})
+        if time.perf_counter() > deadline:
+            generation_rejected.labels('timeout').inc()
+            raise TimeoutError("Timed out waiting for a generation slot")
+        generation_scheduler.wait(ticket, 0.5)
+    generation_queue_wait.observe(ticket.started_at - ticket.enqueued_at)
+
+
 @app.route('/api/chat/simple', methods=['POST'])
 def simple_chat():
     """
@@ -201,8 +836,13 @@ def simple_chat():
         "prompt": "user prompt",
         "model": "optional_model_name",
         "temperature": 0.7,
-        "max_tokens": 1000
+        "max_tokens": 1000,
+        "cache": "optional, true reuses answers to the same prompt (default only at temperature 0),
+                  false also skips the answers pre-generated by Chatbot/warm_cache.py",
+        "full_text": "optional, false leaves the answer out of the done event"
     }
+    While waiting for a generation slot the stream sends {"type": "queue", "position": n} events,
+    a full queue is answered with 429 (this client) or 503 and Retry-After
     """
     try:
         data = request.get_json()
@@ -218,30 +858,37 @@ def simple_chat():
         model = data.get('model', DEFAULT_MODEL)
         temperature = data.get('temperature', 0.7)
         max_tokens = data.get('max_tokens',1000)
+        cache_key = request_cache_key(data, model, prompt, temperature, max_tokens)
+        use_store = data.get('cache') is not False
+        stream = SSEStream(
+            window_ms=app.config['CHAT_STREAM_WINDOW_MS'],
+            max_chars=app.config['CHAT_STREAM_MAX_CHARS'],
+            full_text=data.get('full_text', app.config['CHAT_DONE_FULL_TEXT'])
+        )
+        cached, embedding = cached_answer(model, prompt, temperature, max_tokens, cache_key, use_store)
+        ticket = None
+        if cached is None:
+            ticket, rejection = admit_generation()
+            if rejection:
+                return rejection
 
         def generate():
             try:
-                full_response = ""
-
-                # Stream the response
-                for chunk in ollama.generate_text(
-                        model=model,
-                        prompt=prompt,
-                        temperature=temperature,
-                        max_tokens=max_tokens
-                ):
-                    full_response += chunk
-                    # Send chunk as Server-Sent Event
-                    yield f"data: {json.dumps({'content': chunk, 'type': 'chunk'})}\n\n"
-
-                # Send completion signal
-                yield f"data: {json.dumps({'type': 'done', 'full_response': full_response})}\n\n"
+                chunks = cached
+                if ticket is not None:
+                    yield from queue_events(ticket)
+                    chunks = generate_answer(model, prompt, temperature, max_tokens, cache_key, embedding)
+                # Stream the response as Server-Sent Events, then the completion signal
+                yield from stream.events(chunks)
 
             except Exception as e:
                 logging.error(f"Error in simple generate function: {e}")
                 yield f"data: {json.dumps({'error': str(e), 'type': 'error'})}\n\n"
+            finally:
+                if ticket is not None:
+                    generation_scheduler.release(ticket)
 
-        return Response(
+        response = Response(
             generate(),
             mimetype='text/plain',
             headers={
@@ -250,6 +897,10 @@ def simple_chat():
                 'X-Accel-Buffering': 'no'
             }
         )
+        if ticket is not None:
+            # Also frees the slot when the client is gone before the stream starts
+            response.call_on_close(lambda: generation_scheduler.release(ticket))
+        return response
 
     except Exception as e:
         logging.error(f"Error in simple chat endpoint: {e}")
@@ -265,7 +916,9 @@ def generate_chat():
         "prompt": "user prompt",
         "model": "optional_model_name",
         "temperature": 0.7,
-        "max_tokens": 1000
+        "max_tokens": 1000,
+        "cache": "optional, true reuses answers to the same prompt (default only at temperature 0),
+                  false also skips the answers pre-generated by Chatbot/warm_cache.py"
     }
     """
     try:
@@ -281,18 +934,28 @@ def generate_chat():
         model = data.get('model', DEFAULT_MODEL)
         temperature = data.get('temperature', 0.7)
         max_tokens = data.get('max_tokens', 1000)
+        cache_key = request_cache_key(data, model, prompt, temperature, max_tokens)
+        use_store = data.get('cache') is not False
+        cached, embedding = cached_answer(model, prompt, temperature, max_tokens, cache_key, use_store)
+        ticket = None
+        if cached is None:
+            ticket, rejection = admit_generation()
+            if rejection:
+                return rejection
 
         try:
-            full_response = ""
+            chunks = cached
+            if ticket is not None:
+                if not generation_scheduler.wait(ticket, app.config['CHAT_QUEUE_TIMEOUT']):
+                    generation_rejected.labels('timeout').inc()
+                    retry_after = generation_scheduler.retry_after()
+                    return jsonify({"success": False, "error": "Timed out waiting for a generation slot",
+                                    "retry_after": retry_after}), 503, {'Retry-After': str(retry_after)}
+                generation_queue_wait.observe(ticket.started_at - ticket.enqueued_at)
+                chunks = generate_answer(model, prompt, temperature, max_tokens, cache_key, embedding)
 
             # Collect all chunks into a complete response
-            for chunk in ollama.generate_text(
-                    model=model,
-                    prompt=prompt,
-                    temperature=temperature,
-                    max_tokens=max_tokens
-            ):
-                full_response += chunk
+            full_response = "".join(chunks)
 
             return jsonify({
                 "success": True,
@@ -307,6 +970,9 @@ def generate_chat():
                 "success": False,
                 "error": f"Error generating text: {str(e)}"
             }), 500
+        finally:
+            if ticket is not None:
+                generation_scheduler.release(ticket)
 
     except Exception as e:
         logging.error(f"Error in generate chat endpoint: {e}")
@@ -319,7 +985,7 @@ def generate_chat():
 if __name__ == '__main__':
     # Check if Ollama is running
     try:
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
+        response = ollama.get().get('/api/tags')
         if response.status_code == 200:
             print("✅ Ollama is running and accessible")
             models = response.json().get('models', [])
@@ -333,4 +999,5 @@ if __name__ == '__main__':
         print(f"❌ Cannot connect to Ollama: {e}")
         print("Make sure Ollama is running with: ollama serve")
     port = int(os.environ.get('PORT', 3000))
+    # Development server, run `python -m serve` in production
     app.run(host='0.0.0.0', port=port, debug=True)
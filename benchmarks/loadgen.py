@@ -0,0 +1,260 @@
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import iter_upload_images
+
+
+"""
+Mixed workload load generator for app.py.
+Concurrent clients send a weighted mix of chat, detection and fertilizer
+requests and the run reports throughput, latency percentiles, error rates
+and, for streamed chat, time to the first SSE event. Without Ollama, run
+against benchmarks/ollama_stub.py:
+    python benchmarks/ollama_stub.py --port 11500 &
+    OLLAMA_BASE_URL=http://localhost:11500 python app.py &
+    python benchmarks/loadgen.py --url http://localhost:3000 --concurrency 16 --duration 60 \\
+        --mix chat_simple=4 chat_generate=1 detect=3 fertilizer=2
+"""
+
+PROMPTS = [
+    "How do I treat early blight on tomato leaves?",
+    "What causes yellow spots on apple leaves?",
+    "Which fertilizer should I use for maize in black soil?",
+    "How often should I water potato plants?",
+    "Is powdery mildew on squash dangerous for the harvest?"
+]
+
+DEFAULT_MIX = ('chat_simple=4', 'chat_generate=1', 'detect=3', 'fertilizer=2')
+
+
+def fertilizer_inputs(path="project_variables/Crop and fertilizer dataset.csv", limit=200):
+    """Rows of the training data in the order /api/fertilizer expects"""
+    inputs = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            inputs.append([row['Soil_color'], row['Crop'], float(row['Nitrogen']), float(row['Phosphorus']),
+                           float(row['Potassium']), float(row['pH']), float(row['Rainfall']),
+                           float(row['Temperature'])])
+            if len(inputs) >= limit:
+                break
+    return inputs
+
+
+class Workload:
+    def __init__(self, base_url, images, fertilizer_rows, max_tokens=200, timeout=120):
+        self.base_url = base_url.rstrip('/')
+        self.images = images
+        self.fertilizer_rows = fertilizer_rows
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+
+    def chat_simple(self, session):
+        """
+        Streamed generation. Returns (ok, ttfb seconds)
+        """
+        start = time.perf_counter()
+        payload = {"prompt": random.choice(PROMPTS), "max_tokens": self.max_tokens}
+        with session.post(f"{self.base_url}/api/chat/simple", json=payload, stream=True,
+                          timeout=self.timeout) as response:
+            if response.status_code != 200:
+                return False, None
+            ttfb = None
+            ok = False
+            for line in response.iter_lines():
+                if not line.startswith(b'data: '):
+                    continue
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                event = json.loads(line[6:])
+                # OllamaStreamer reports upstream failures as an "Error: ..." chunk
+                if event.get('type') == 'error' or event.get('content', '').startswith('Error:'):
+                    return False, ttfb
+                if event.get('type') == 'done':
+                    ok = True
+            return ok, ttfb
+
+    def chat_generate(self, session):
+        payload = {"prompt": random.choice(PROMPTS), "max_tokens": self.max_tokens}
+        response = session.post(f"{self.base_url}/api/chat/generate", json=payload, timeout=self.timeout)
+        body = response.json() if response.status_code == 200 else {}
+        ok = body.get('success', False) and not body.get('response', '').startswith('Error:')
+        return ok, None
+
+    def detect(self, session):
+        name, data = random.choice(self.images)
+        response = session.post(f"{self.base_url}/api/detect", files={'image': (name, data)}, timeout=self.timeout)
+        return response.status_code == 200, None
+
+    def fertilizer(self, session):
+        payload = {"input": random.choice(self.fertilizer_rows)}
+        response = session.post(f"{self.base_url}/api/fertilizer", json=payload, timeout=self.timeout)
+        return response.status_code == 200 and response.json().get('success', False), None
+
+
+class Results:
+    def __init__(self):
+        self.latency = {}
+        self.ttfb = {}
+        self.errors = {}
+        self.error_messages = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, ok, ttfb=None, error=None):
+        with self._lock:
+            self.latency.setdefault(name, []).append(seconds)
+            self.errors[name] = self.errors.get(name, 0) + (0 if ok else 1)
+            if ttfb is not None:
+                self.ttfb.setdefault(name, []).append(ttfb)
+            if error:
+                self.error_messages[error] = self.error_messages.get(error, 0) + 1
+
+
+def percentiles(seconds):
+    values = np.asarray(seconds) * 1000
+    if values.size == 0:
+        return {}
+    return {
+        'p50_ms': float(np.percentile(values, 50)),
+        'p95_ms': float(np.percentile(values, 95)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'max_ms': float(values.max())
+    }
+
+
+def parse_mix(items):
+    mix = {}
+    for item in items:
+        name, _, weight = item.partition('=')
+        mix[name] = float(weight or 1)
+    unknown = set(mix) - {'chat_simple', 'chat_generate', 'detect', 'fertilizer'}
+    if unknown:
+        raise ValueError(f"Unknown workload {', '.join(sorted(unknown))}")
+    return mix
+
+
+def run(workload, mix, concurrency=8, duration=30.0, requests_limit=None, keep_alive=False):
+    """
+    Drive the mix from concurrency client threads until duration seconds or requests_limit requests.
+    Without keep_alive every request opens a new connection: the Flask development server
+    drains the socket after each response and blocks when a client reuses it
+
+    Returns:
+    --------
+    dict
+        Report with per-endpoint counts, error rates, latency and TTFB percentiles
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    results = Results()
+    deadline = time.perf_counter() + duration
+    issued = [0]
+    issued_lock = threading.Lock()
+
+    def client():
+        # The requests module itself opens a new connection for every call
+        session = requests.Session() if keep_alive else requests
+        while time.perf_counter() < deadline:
+            if requests_limit:
+                with issued_lock:
+                    if issued[0] >= requests_limit:
+                        return
+                    issued[0] += 1
+            name = random.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                ok, ttfb = getattr(workload, name)(session)
+                results.record(name, time.perf_counter() - start, ok, ttfb)
+            except Exception as e:
+                results.record(name, time.perf_counter() - start, False, error=f"{name}: {type(e).__name__}")
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    endpoints = {}
+    for name, seconds in results.latency.items():
+        endpoints[name] = {
+            'requests': len(seconds),
+            'throughput_rps': len(seconds) / elapsed,
+            'error_rate': results.errors[name] / len(seconds),
+            'latency': percentiles(seconds),
+        }
+        if name in results.ttfb:
+            endpoints[name]['ttfb'] = percentiles(results.ttfb[name])
+    total = sum(len(seconds) for seconds in results.latency.values())
+    return {
+        'meta': {'base_url': workload.base_url, 'concurrency': concurrency, 'mix': mix, 'keep_alive': keep_alive,
+                 'elapsed_seconds': elapsed, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'total_requests': total,
+        'throughput_rps': total / elapsed if elapsed else 0.0,
+        'error_rate': sum(results.errors.values()) / total if total else 0.0,
+        'endpoints': endpoints,
+        'exceptions': results.error_messages
+    }
+
+
+def print_report(report):
+    print(f"{report['total_requests']} requests in {report['meta']['elapsed_seconds']:.1f}s, "
+          f"{report['throughput_rps']:.1f} req/s, {report['error_rate']:.1%} errors")
+    print(f"{'endpoint':<16}{'req':>7}{'req/s':>8}{'err':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'ttfb p50':>10}{'ttfb p95':>10}")
+    for name, stats in sorted(report['endpoints'].items()):
+        latency, ttfb = stats['latency'], stats.get('ttfb', {})
+        print(f"{name:<16}{stats['requests']:>7}{stats['throughput_rps']:>8.1f}{stats['error_rate']:>7.1%}"
+              f"{latency['p50_ms']:>9.0f}{latency['p95_ms']:>9.0f}{latency['p99_ms']:>9.0f}"
+              f"{ttfb.get('p50_ms', float('nan')):>10.0f}{ttfb.get('p95_ms', float('nan')):>10.0f}")
+    for message, count in sorted(report['exceptions'].items()):
+        print(f"  {count} x {message}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mixed workload load test against app.py")
+    parser.add_argument('--url', default='http://localhost:3000')
+    parser.add_argument('--mix', nargs='+', default=list(DEFAULT_MIX),
+                        help="Weighted endpoints, e.g. chat_simple=4 detect=1")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0, help="Seconds to run")
+    parser.add_argument('--requests', type=int, help="Stop after this many requests")
+    parser.add_argument('--max-tokens', type=int, default=200)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--keep-alive', action='store_true', help="Reuse connections (not with the Flask dev server)")
+    parser.add_argument('--folder', default='uploads', help="Images for /api/detect")
+    parser.add_argument('--limit', type=int, default=100, help="Images to load from --folder")
+    parser.add_argument('--output', help="Write the report as JSON")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    images = []
+    if 'detect' in mix:
+        for path in iter_upload_images(args.folder)[:args.limit]:
+            with open(path, 'rb') as f:
+                images.append((os.path.basename(path), f.read()))
+        if not images:
+            parser.error(f"No images found in {args.folder} for the detect workload")
+    rows = fertilizer_inputs() if 'fertilizer' in mix else []
+
+    workload = Workload(args.url, images, rows, args.max_tokens, args.timeout)
+    report = run(workload, mix, args.concurrency, args.duration, args.requests, args.keep_alive)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
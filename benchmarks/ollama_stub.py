@@ -0,0 +1,238 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+"""
+Stand-in for an Ollama server, for load tests on machines without a GPU.
+Speaks the streaming NDJSON protocol of /api/generate and /api/chat,
+answers /api/tags and /api/embed (bag of words vectors), with a configurable
+token rate, first token latency and injected failures. Point app.py at it with OLLAMA_BASE_URL:
+    python benchmarks/ollama_stub.py --port 11500 --tokens-per-second 30 --error-rate 0.02
+    OLLAMA_BASE_URL=http://localhost:11500 python app.py
+"""
+
+WORDS = ("the leaves show early signs of blight so remove infected foliage water at the base "
+         "and apply a copper based fungicide every seven to ten days while keeping good airflow").split()
+
+
+def embed(text, dim=256):
+    """Hashed bag of words, so rephrasings that share most words get similar vectors"""
+    vector = [0.0] * dim
+    for word in re.findall(r'[a-z0-9]+', text.lower()):
+        vector[zlib.crc32(word.encode('utf-8')) % dim] += 1.0
+    norm = sum(value * value for value in vector) ** 0.5 or 1.0
+    return [value / norm for value in vector]
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+class StubSettings:
+    def __init__(self, tokens_per_second=25.0, first_token_ms=300.0, jitter=0.2, max_tokens=200,
+                 error_rate=0.0, stall_rate=0.0, disconnect_rate=0.0, models=('LeafEye-Mistral7b',)):
+        """
+        Behaviour of the stub server
+
+        Parameters:
+        -----------
+        tokens_per_second : float, optional
+            Streaming rate after the first token, 0 for no delay. Default is 25
+        first_token_ms : float, optional
+            Latency before the first token (prompt evaluation). Default is 300
+        jitter : float, optional
+            Relative random variation of both delays. Default is 0.2
+        max_tokens : int, optional
+            Tokens per answer when the request sets no num_predict. Default is 200
+        error_rate : float, optional
+            Fraction of requests answered with HTTP 500 before streaming. Default is 0
+        stall_rate : float, optional
+            Fraction of requests that wait 30 seconds before the first token (client timeouts). Default is 0
+        disconnect_rate : float, optional
+            Fraction of streams cut off halfway without a done message. Default is 0
+        models : tuple, optional
+            Names listed by /api/tags
+        """
+        self.tokens_per_second = tokens_per_second
+        self.first_token_ms = first_token_ms
+        self.jitter = jitter
+        self.max_tokens = max_tokens
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.disconnect_rate = disconnect_rate
+        self.models = list(models)
+        self.requests = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def delay(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    settings = StubSettings()
+
+    def log_message(self, format, *args):
+        # One line per request would dominate the output under load
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionResetError:
+            # Pooled client connections are reset when the client exits
+            pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self.send_json(200, {"models": [
+                {"name": name, "model": name, "modified_at": now(), "size": 0,
+                 "details": {"format": "gguf", "family": "stub"}}
+                for name in self.settings.models
+            ]})
+        elif self.path in ('/', '/api/version'):
+            self.send_json(200, {"version": "stub"})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError:
+            self.send_json(400, {"error": "invalid JSON"})
+            return
+
+        if self.path == '/api/generate':
+            self.stream(payload, lambda token: {"response": token})
+        elif self.path == '/api/chat':
+            self.stream(payload, lambda token: {"message": {"role": "assistant", "content": token}})
+        elif self.path == '/api/embed':
+            inputs = payload.get('input', '')
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self.send_json(200, {"model": payload.get('model'), "embeddings": [embed(text) for text in inputs]})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def stream(self, payload, make_chunk):
+        settings = self.settings
+        with settings._lock:
+            settings.requests += 1
+            settings.in_flight += 1
+        try:
+            model = payload.get('model', settings.models[0])
+            if random.random() < settings.error_rate:
+                self.send_json(500, {"error": "injected failure"})
+                return
+
+            count = int((payload.get('options') or {}).get('num_predict') or settings.max_tokens)
+            cut_at = count // 2 if random.random() < settings.disconnect_rate else None
+            first_token = 30.0 if random.random() < settings.stall_rate else settings.first_token_ms / 1000
+            interval = 1 / settings.tokens_per_second if settings.tokens_per_second > 0 else 0
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            start = time.perf_counter()
+            settings.delay(first_token)
+            for i in range(count):
+                if i == cut_at:
+                    self.close_connection = True
+                    return
+                if i:
+                    settings.delay(interval)
+                token = WORDS[i % len(WORDS)] + ' '
+                self.write_line(dict(make_chunk(token), model=model, created_at=now(), done=False))
+
+            final = make_chunk('')
+            final.update({
+                "model": model,
+                "created_at": now(),
+                "done": True,
+                "done_reason": "length" if count < settings.max_tokens else "stop",
+                "total_duration": int((time.perf_counter() - start) * 1e9),
+                "eval_count": count
+            })
+            self.write_line(final)
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # Client went away mid stream
+            self.close_connection = True
+        finally:
+            with settings._lock:
+                settings.in_flight -= 1
+
+    def write_line(self, body):
+        data = json.dumps(body).encode('utf-8') + b'\n'
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Load tests open thousands of streams at once
+    request_queue_size = 1024
+
+
+def serve(host='127.0.0.1', port=11500, settings=None):
+    """
+    Start the stub in a background thread
+
+    Returns:
+    --------
+    StubServer
+        Call shutdown() to stop it
+    """
+    handler = type('Handler', (StubHandler,), {'settings': settings or StubSettings()})
+    server = StubServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub Ollama server with configurable latency and failures")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11500)
+    parser.add_argument('--tokens-per-second', type=float, default=25.0)
+    parser.add_argument('--first-token-ms', type=float, default=300.0)
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--max-tokens', type=int, default=200)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--stall-rate', type=float, default=0.0)
+    parser.add_argument('--disconnect-rate', type=float, default=0.0)
+    parser.add_argument('--models', nargs='+', default=['LeafEye-Mistral7b'])
+    args = parser.parse_args()
+
+    settings = StubSettings(args.tokens_per_second, args.first_token_ms, args.jitter, args.max_tokens,
+                            args.error_rate, args.stall_rate, args.disconnect_rate, args.models)
+    server = serve(args.host, args.port, settings)
+    print(f"Stub Ollama listening on http://{args.host}:{args.port}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"requests={settings.requests} in_flight={settings.in_flight}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
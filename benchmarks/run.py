@@ -0,0 +1,256 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference import BatchScheduler, load_backend
+from pipeline import DEFAULT_STAGES, build_pipeline
+from preprocessing import initialize_preprocessor
+from storage import iter_upload_images
+
+
+"""
+Offline benchmark of preprocessing and prediction over the uploads/ corpus.
+Run from the repository root, save the result and diff two runs:
+    python benchmarks/run.py --backend keras --output keras.json
+    python benchmarks/run.py --backend tflite --output tflite.json --baseline keras.json
+    python benchmarks/run.py compare keras.json tflite.json --threshold 0.1
+Exits with status 1 when a run regresses beyond the threshold.
+"""
+
+
+def percentiles(seconds):
+    values = np.asarray(seconds) * 1000
+    if values.size == 0:
+        return {}
+    return {
+        'mean_ms': float(values.mean()),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p95_ms': float(np.percentile(values, 95)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'count': int(values.size)
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if platform.system() == 'Darwin' else peak / 1024
+
+
+def load_corpus(folder, limit=None):
+    paths = iter_upload_images(folder)[:limit] if limit else iter_upload_images(folder)
+    corpus = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            corpus.append(f.read())
+    return corpus
+
+
+def bench_stages(pipeline, corpus):
+    """Every image once through the pipeline, recording each stage and the whole run"""
+    stage_seconds = {}
+    lock = threading.Lock()
+
+    def observer(name, seconds, nbytes):
+        with lock:
+            stage_seconds.setdefault(name, []).append(seconds)
+
+    pipeline.observers.append(observer)
+    tensors, totals = [], []
+    for image_bytes in corpus:
+        start = time.perf_counter()
+        tensor = pipeline.run(image_bytes).result
+        totals.append(time.perf_counter() - start)
+        if tensor is not None:
+            tensors.append(tensor)
+    pipeline.observers.remove(observer)
+    return tensors, {name: percentiles(seconds) for name, seconds in stage_seconds.items()}, percentiles(totals)
+
+
+def bench_end_to_end(pipeline, backend, corpus):
+    seconds = []
+    for image_bytes in corpus:
+        start = time.perf_counter()
+        tensor = pipeline.run(image_bytes).result
+        if tensor is not None:
+            backend.predict(tensor[None])
+        seconds.append(time.perf_counter() - start)
+    return percentiles(seconds)
+
+
+def bench_batch_sizes(backend, tensors, batch_sizes, repeats=3):
+    """Inference only images/sec at each batch size"""
+    results = {}
+    for batch_size in batch_sizes:
+        batches = [np.stack(tensors[i:i + batch_size]) for i in range(0, len(tensors) - batch_size + 1, batch_size)]
+        if not batches:
+            continue
+        backend.predict(batches[0])
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for batch in batches:
+                backend.predict(batch)
+        elapsed = time.perf_counter() - start
+        results[f'batch_{batch_size}'] = repeats * len(batches) * batch_size / elapsed
+    return results
+
+
+def bench_threads(pipeline, backend, corpus, thread_counts, max_batch_size=16, max_wait_ms=10):
+    """End-to-end images/sec with concurrent clients sharing the batching scheduler, as in app.py"""
+    results = {}
+    for threads in thread_counts:
+        scheduler = BatchScheduler(backend.predict, max_batch_size, max_wait_ms,
+                                   workers=threads if backend.thread_safe else 1).start()
+
+        def predict(image_bytes):
+            tensor = pipeline.run(image_bytes).result
+            if tensor is not None:
+                scheduler.predict(tensor)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(predict, corpus))
+        results[f'threads_{threads}'] = len(corpus) / (time.perf_counter() - start)
+        scheduler.stop(1)
+    return results
+
+
+def run(args):
+    corpus = load_corpus(args.folder, args.limit)
+    config = initialize_preprocessor(segmentation_model=args.segmentation_model,
+                                     segmentation_tier=args.tier, stages=args.stages)
+    pipeline = build_pipeline(config)
+    backend = load_backend(args.backend)
+
+    # Warm up JIT kernels, rembg and the model before measuring
+    warm = pipeline.run(corpus[0]).result
+    if warm is not None:
+        backend.predict(warm[None])
+
+    tensors, stages, preprocess = bench_stages(pipeline, corpus)
+    report = {
+        'meta': {
+            'backend': args.backend,
+            'segmentation_tier': args.tier,
+            'segmentation_model': args.segmentation_model,
+            'stages': list(args.stages),
+            'images': len(corpus),
+            'accepted_images': len(tensors),
+            'cpu_count': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'stages': stages,
+        'preprocess': preprocess,
+        'end_to_end': bench_end_to_end(pipeline, backend, corpus),
+        'inference_throughput': bench_batch_sizes(backend, tensors, args.batch_sizes) if tensors else {},
+        'concurrency_throughput': bench_threads(pipeline, backend, corpus, args.threads)
+    }
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
+
+
+def flatten(report):
+    """
+    Comparable numbers of a report
+
+    Returns:
+    --------
+    dict
+        name -> (value, higher_is_better)
+    """
+    values = {}
+    for section in ('preprocess', 'end_to_end'):
+        for key, value in report.get(section, {}).items():
+            if key.endswith('_ms'):
+                values[f'{section}.{key}'] = (value, False)
+    for stage, stats in report.get('stages', {}).items():
+        for key in ('p50_ms', 'p95_ms'):
+            if key in stats:
+                values[f'stages.{stage}.{key}'] = (stats[key], False)
+    for section in ('inference_throughput', 'concurrency_throughput'):
+        for key, value in report.get(section, {}).items():
+            values[f'{section}.{key}'] = (value, True)
+    if 'peak_rss_mb' in report:
+        values['peak_rss_mb'] = (report['peak_rss_mb'], False)
+    return values
+
+
+def compare(baseline, current, threshold, min_delta_ms=1.0):
+    """
+    Print the relative change of every shared number. Latencies that moved
+    by less than min_delta_ms are never flagged, sub-millisecond stages are noise
+
+    Returns:
+    --------
+    list
+        Names that got worse by more than threshold (e.g. 0.1 for 10%)
+    """
+    old, new = flatten(baseline), flatten(current)
+    regressions = []
+    print(f"{'metric':<48}{'baseline':>12}{'current':>12}{'change':>9}")
+    for name in sorted(set(old) & set(new)):
+        (before, higher_is_better), (after, _) = old[name], new[name]
+        change = (after - before) / before if before else 0.0
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > threshold and not (name.endswith('_ms') and abs(after - before) < min_delta_ms):
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<48}{before:>12.2f}{after:>12.2f}{change:>+9.1%}{flag}")
+    return regressions
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        parser = argparse.ArgumentParser(description="Diff two benchmark results")
+        parser.add_argument('command')
+        parser.add_argument('baseline')
+        parser.add_argument('current')
+        parser.add_argument('--threshold', type=float, default=0.1)
+        parser.add_argument('--min-delta-ms', type=float, default=1.0)
+        args = parser.parse_args()
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        return 1 if compare(baseline, current, args.threshold, args.min_delta_ms) else 0
+
+    parser = argparse.ArgumentParser(description="Benchmark preprocessing and prediction over the uploads corpus")
+    parser.add_argument('--folder', default='uploads')
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--backend', default='keras', help="keras, tflite, onnx or onnx-int8")
+    parser.add_argument('--tier', default='full', help="Segmentation tier: full, fast or mask")
+    parser.add_argument('--segmentation-model', default='u2net')
+    parser.add_argument('--stages', nargs='+', default=list(DEFAULT_STAGES))
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4, 8, 16, 32])
+    parser.add_argument('--threads', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--output', help="Write the results as JSON")
+    parser.add_argument('--baseline', help="Earlier results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Allowed relative regression. Default is 10%%")
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help="Ignore latency changes smaller than this")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        return 1 if compare(baseline, report, args.threshold, args.min_delta_ms) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
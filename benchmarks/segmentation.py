@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preprocessing import (SEGMENTATION_TIERS, check_green_percentage, enhance_contrast, initialize_preprocessor,
+                           load_image, remove_background, resize_with_padding)
+from storage import iter_upload_images
+
+
+"""
+Compare the segmentation tiers against the full resolution path.
+Run from the repository root:
+    python benchmarks/segmentation.py --limit 50 --backend keras
+"""
+
+
+def foreground(image):
+    return np.any(image < 250, axis=2)
+
+
+def segment(image, config):
+    """remove_background plus the rest of preprocess_image, timed"""
+    start = time.perf_counter()
+    no_bg = remove_background(image, config)
+    elapsed = time.perf_counter() - start
+    tensor = resize_with_padding(enhance_contrast(no_bg), config)
+    return no_bg, tensor, elapsed
+
+
+def run(folder, tiers, limit=None, working_size=512, segmentation_model='u2net', backend=None):
+    base = initialize_preprocessor(segmentation_model=segmentation_model, working_size=working_size)
+    model = None
+    if backend:
+        from inference import load_backend
+        model = load_backend(backend)
+
+    per_tier = {tier: {'seconds': [], 'iou': [], 'pixel_mae': [], 'agree': []} for tier in tiers}
+    images = 0
+    for image_path in iter_upload_images(folder):
+        image = load_image(image_path)
+        # Same leaf gate as preprocess_image
+        if check_green_percentage(image) < 0.3:
+            continue
+        images += 1
+        reference = None
+        for tier in ['full'] + [tier for tier in tiers if tier != 'full']:
+            no_bg, tensor, elapsed = segment(image, dict(base, segmentation_tier=tier))
+            label = int(np.argmax(model.predict(tensor[None]))) if model else None
+            if tier == 'full':
+                reference = (foreground(no_bg), tensor, label)
+            if tier not in per_tier:
+                continue
+            stats = per_tier[tier]
+            stats['seconds'].append(elapsed)
+            mask = foreground(no_bg)
+            union = np.logical_or(mask, reference[0]).sum()
+            stats['iou'].append(np.logical_and(mask, reference[0]).sum() / union if union else 1.0)
+            stats['pixel_mae'].append(float(np.mean(np.abs(tensor.astype(np.int16) - reference[1]))))
+            if model:
+                stats['agree'].append(label == reference[2])
+        if limit and images >= limit:
+            break
+
+    report = {'images': images, 'working_size': working_size, 'segmentation_model': segmentation_model, 'tiers': {}}
+    for tier, stats in per_tier.items():
+        seconds = np.array(stats['seconds'])
+        report['tiers'][tier] = {
+            'mean_ms': float(seconds.mean() * 1000) if images else None,
+            'p95_ms': float(np.percentile(seconds, 95) * 1000) if images else None,
+            'mask_iou_vs_full': float(np.mean(stats['iou'])) if images else None,
+            'pixel_mae_vs_full': float(np.mean(stats['pixel_mae'])) if images else None,
+            'top1_agreement_vs_full': float(np.mean(stats['agree'])) if stats['agree'] else None
+        }
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Latency and accuracy of segmentation tiers against the full path")
+    parser.add_argument('--folder', default='uploads')
+    parser.add_argument('--tiers', nargs='+', default=list(SEGMENTATION_TIERS), choices=SEGMENTATION_TIERS)
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--working-size', type=int, default=512)
+    parser.add_argument('--segmentation-model', default='u2net')
+    parser.add_argument('--backend', help="Also report top-1 agreement using this inference backend")
+    parser.add_argument('--output', help="Write the report as JSON")
+    args = parser.parse_args()
+
+    report = run(args.folder, args.tiers, args.limit, args.working_size, args.segmentation_model, args.backend)
+    for tier, stats in report['tiers'].items():
+        print(f"{tier:>5}: {stats}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,233 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import cv2
+import numpy as np
+
+
+"""
+In-process caches for disease predictions.
+Results are keyed by the content of the upload, so retries and resubmitted
+photos skip background removal and inference entirely.
+"""
+
+
+def content_key(data):
+    """SHA-256 of the uploaded bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def decode_thumbnail(data):
+    """
+    Decode uploaded bytes straight to a small grayscale image. For JPEG the
+    decoder skips most of the work at 1/8 scale, so this is far cheaper than
+    a full decode and good enough for perceptual hashing
+    """
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+
+
+def _pack_bits(bits):
+    return int(np.packbits(bits.ravel().astype(np.uint8)).view('>u8')[0])
+
+
+def dhash(image):
+    """64-bit difference hash: sign of the horizontal gradient on a 9x8 grayscale image"""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return _pack_bits(small[:, 1:] > small[:, :-1])
+
+
+def phash(image):
+    """64-bit perceptual hash: low frequency DCT coefficients of a 32x32 image against their median"""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    return _pack_bits(low > np.median(low))
+
+
+PERCEPTUAL_HASHES = {'dhash': dhash, 'phash': phash}
+
+
+class PerceptualHashIndex:
+    def __init__(self, capacity=200000, max_distance=6):
+        """
+        Fixed size index of 64-bit image hashes for near-duplicate lookup
+
+        Hashes live in one packed uint64 array (8 bytes per entry) and the
+        oldest entry is overwritten once the index is full.
+
+        Parameters:
+        -----------
+        capacity : int, optional
+            Number of hashes kept. Default is 200000
+        max_distance : int, optional
+            Largest Hamming distance that still counts as the same image. Default is 6
+        """
+        self.capacity = max(1, int(capacity))
+        self.max_distance = int(max_distance)
+        self._hashes = np.zeros(self.capacity, dtype=np.uint64)
+        self._values = [None] * self.capacity
+        self._size = 0
+        self._next = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, image_hash, value):
+        with self._lock:
+            self._hashes[self._next] = np.uint64(image_hash)
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def lookup(self, image_hash):
+        """
+        Returns:
+        --------
+        tuple
+            (value, distance) of the closest stored hash within max_distance, or (None, None)
+        """
+        with self._lock:
+            if self._size:
+                distances = np.bitwise_count(self._hashes[:self._size] ^ np.uint64(image_hash))
+                best = int(np.argmin(distances))
+                if distances[best] <= self.max_distance:
+                    self.hits += 1
+                    return self._values[best], int(distances[best])
+            self.misses += 1
+            return None, None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": self._size,
+                "capacity": self.capacity,
+                "max_distance": self.max_distance,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+class PredictionCache:
+    def __init__(self, max_entries=1024, ttl_seconds=3600):
+        """
+        Bounded LRU cache with expiry and coalescing of concurrent misses
+
+        Parameters:
+        -----------
+        max_entries : int, optional
+            Entries kept before the least recently used one is evicted. Default is 1024
+        ttl_seconds : float, optional
+            Age after which an entry is recomputed, 0 disables expiry. Default is 3600
+        """
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl_seconds)
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _expired(self, stored_at):
+        return self.ttl > 0 and time.monotonic() - stored_at > self.ttl
+
+    def get(self, key):
+        """
+        Returns:
+        --------
+        tuple
+            (found, value)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry[1]):
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_compute(self, key, compute, cacheable=None):
+        """
+        Return the cached value for key, computing it at most once at a time
+
+        Parameters:
+        -----------
+        key : str
+            Content hash of the upload
+        compute : callable
+            Called without arguments on a miss. Exceptions are passed to every
+            waiting caller and nothing is cached
+        cacheable : callable, optional
+            Called with the computed value, a false result hands it to the waiting
+            callers without storing it. Default caches every value
+
+        Returns:
+        --------
+        tuple
+            (value, source) where source is 'hit', 'coalesced' or 'miss'
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[1]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], 'hit'
+            if entry is not None:
+                del self._entries[key]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result(), 'coalesced'
+
+        try:
+            value = compute()
+        except Exception as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            if cacheable is None or cacheable(value):
+                self._store(key, value)
+            del self._inflight[key]
+        future.set_result(value)
+        return value, 'miss'
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0
+            }
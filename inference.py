@@ -0,0 +1,320 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+"""
+Inference scheduling for the leaf disease classifier.
+Requests hand in single preprocessed tensors and the scheduler groups
+whatever arrives within a short window into one batched forward pass.
+"""
+
+
+class BatchScheduler:
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=10, workers=1):
+        """
+        Collect single image tensors from concurrent requests and run them as one batch
+
+        Parameters:
+        -----------
+        predict_fn : callable
+            Function taking a (N, H, W, 3) array and returning (N, num_classes) scores
+        max_batch_size : int, optional
+            Largest batch handed to predict_fn. Default is 16
+        max_wait_ms : float, optional
+            How long the first tensor of a batch waits for company. Default is 10 ms
+        workers : int, optional
+            Number of threads forming and running batches. Only useful when
+            predict_fn is safe to call concurrently (e.g. TFLiteBackend). Default is 1
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.workers = max(1, int(workers))
+        self._queue = queue.Queue()
+        self._threads = []
+        self._stopped = threading.Event()
+        # Called as observer(batch_size, seconds) after every forward pass
+        self.observers = []
+
+    def start(self):
+        if not any(thread.is_alive() for thread in self._threads):
+            self._stopped.clear()
+            self._threads = [
+                threading.Thread(target=self._run, name=f"inference-batcher-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def depth(self):
+        """Number of tensors waiting for the next batch"""
+        return self._queue.qsize()
+
+    def submit(self, tensor):
+        """
+        Queue one image tensor of shape (H, W, 3)
+
+        Returns:
+        --------
+        concurrent.futures.Future
+            Resolves to the score vector for this image
+        """
+        future = Future()
+        self._queue.put((np.asarray(tensor), future))
+        return future
+
+    def predict(self, tensor, timeout=None):
+        """Blocking helper around submit()"""
+        return self.submit(tensor).result(timeout)
+
+    def submit_many(self, tensors):
+        """
+        Queue several image tensors back to back so they land in the same batch(es)
+
+        Returns:
+        --------
+        list of concurrent.futures.Future
+            One future per tensor, in input order
+        """
+        futures = [Future() for _ in tensors]
+        for tensor, future in zip(tensors, futures):
+            self._queue.put((np.asarray(tensor), future))
+        return futures
+
+    def _collect(self):
+        item = self._queue.get()
+        if item is None:
+            return []
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._stopped.set()
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+            futures = [future for _, future in batch]
+            start = time.perf_counter()
+            try:
+                scores = np.asarray(self.predict_fn(np.stack([tensor for tensor, _ in batch])))
+            except Exception as e:
+                logging.error(f"Batched inference failed for {len(batch)} images: {e}")
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for observer in self.observers:
+                observer(len(batch), time.perf_counter() - start)
+            for future, row in zip(futures, scores):
+                future.set_result(row)
+
+
+class KerasBackend:
+    """Runs the full Keras graph. Not safe to call from several threads at once."""
+    name = 'keras'
+    thread_safe = False
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, batch):
+        return self.model.predict(batch, verbose=0)
+
+
+def _load_interpreter_class():
+    # The standalone runtime keeps full TensorFlow out of the process
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        from tensorflow.lite import Interpreter
+    return Interpreter
+
+
+def batch_buckets(max_batch_size):
+    """Batch sizes with their own preallocated interpreter: 1 and max_batch_size"""
+    return sorted({1, max(1, int(max_batch_size))})
+
+
+def _resident_mb():
+    """Resident set size from procfs, None where there is none"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class TFLiteBackend:
+    name = 'tflite'
+    thread_safe = True
+
+    def __init__(self, model_path, pool_size=4, num_threads=1, max_batch_size=16):
+        """
+        Serve predictions from a pool of TFLite interpreters
+
+        Parameters:
+        -----------
+        model_path : str
+            Path to the converted .tflite model
+        pool_size : int, optional
+            Number of interpreter sets, one per inference worker thread. Default is 4
+        num_threads : int, optional
+            CPU threads used by XNNPACK inside each interpreter. Default is 1
+        max_batch_size : int, optional
+            Largest batch of the BatchScheduler. Each set holds two interpreters allocated once,
+            for batch 1 and for max_batch_size, so variable micro-batches never reallocate
+            tensors: batches of at least half max_batch_size are zero padded to it, smaller ones
+            run image by image. Default is 16
+
+        Every interpreter keeps its own packed weights and activation arena, so memory grows
+        with pool_size * (2 * weights + arenas of 1 + max_batch_size images); the growth is
+        logged once the pool is built
+        """
+        Interpreter = _load_interpreter_class()
+        self.model_path = model_path
+        self.buckets = batch_buckets(max_batch_size)
+        self._pool = queue.Queue()
+        before = _resident_mb()
+        for _ in range(max(1, int(pool_size))):
+            interpreters = {}
+            for bucket in self.buckets:
+                # XNNPACK is the default CPU delegate for float models, num_threads sizes its thread pool
+                interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+                input_detail = interpreter.get_input_details()[0]
+                interpreter.resize_tensor_input(input_detail['index'], [bucket, *input_detail['shape'][1:]])
+                interpreter.allocate_tensors()
+                interpreters[bucket] = interpreter
+            self._pool.put(interpreters)
+        after = _resident_mb()
+        if before is not None and after is not None:
+            logging.info(f"TFLite pool of {self._pool.qsize()} x {self.buckets} interpreters "
+                         f"added {after - before:.0f} MB resident memory")
+
+    def _invoke(self, interpreters, batch):
+        count = len(batch)
+        bucket = self.buckets[-1]
+        if count * 2 < bucket:
+            # Padding a small batch to the large bucket would cost more than single passes
+            return np.concatenate([self._invoke_bucket(interpreters[1], batch[index:index + 1], 1)
+                                   for index in range(count)])
+        return self._invoke_bucket(interpreters[bucket], batch, bucket)
+
+    def _invoke_bucket(self, interpreter, batch, bucket):
+        count = len(batch)
+        input_detail = interpreter.get_input_details()[0]
+        output_detail = interpreter.get_output_details()[0]
+        batch = batch.astype(input_detail['dtype'], copy=False)
+        if count < bucket:
+            padded = np.zeros((bucket, *batch.shape[1:]), dtype=batch.dtype)
+            padded[:count] = batch
+            batch = padded
+        interpreter.set_tensor(input_detail['index'], batch)
+        interpreter.invoke()
+        return interpreter.get_tensor(output_detail['index'])[:count].copy()
+
+    def predict(self, batch):
+        batch = np.asarray(batch)
+        interpreters = self._pool.get()
+        try:
+            largest = self.buckets[-1]
+            if len(batch) <= largest:
+                return self._invoke(interpreters, batch)
+            return np.concatenate([self._invoke(interpreters, batch[start:start + largest])
+                                   for start in range(0, len(batch), largest)])
+        finally:
+            self._pool.put(interpreters)
+
+
+class OnnxBackend:
+    """Float or INT8 ONNX model on onnxruntime. InferenceSession.run is thread safe."""
+    name = 'onnx'
+    thread_safe = True
+
+    _DTYPES = {'tensor(float)': np.float32, 'tensor(uint8)': np.uint8}
+
+    def __init__(self, model_path, num_threads=1):
+        import onnxruntime as ort
+
+        self.model_path = model_path
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_dtype = self._DTYPES.get(model_input.type, np.float32)
+
+    def predict(self, batch):
+        batch = np.asarray(batch).astype(self.input_dtype, copy=False)
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+def load_backend(name='keras', keras_path='MobileNetV2.keras', **options):
+    """
+    Build the inference backend selected by configuration
+
+    Parameters:
+    -----------
+    name : str
+        'keras', 'tflite', 'onnx' or 'onnx-int8'
+    keras_path : str
+        Source Keras model, converted on first use by the TFLite backend
+    options : dict
+        Backend specific settings (tflite_path, onnx_path, onnx_int8_path, pool_size, num_threads,
+        max_batch_size)
+
+    Returns:
+    --------
+    object
+        Backend exposing predict(batch) and a thread_safe flag
+    """
+    if name == 'keras':
+        import tensorflow as tf
+        print("Loading model...")
+        model_out = tf.keras.models.load_model(keras_path)
+        print(f"Model loaded ({model_out.count_params()} parameters)")
+        return KerasBackend(model_out)
+    if name == 'tflite':
+        tflite_path = options.get('tflite_path', 'MobileNetV2.tflite')
+        if not os.path.exists(tflite_path):
+            from modelConversion import ensure_tflite_model
+            ensure_tflite_model(keras_path, tflite_path)
+        return TFLiteBackend(
+            tflite_path,
+            pool_size=options.get('pool_size', 4),
+            num_threads=options.get('num_threads', 1),
+            max_batch_size=options.get('max_batch_size', 16)
+        )
+    if name in ('onnx', 'onnx-int8'):
+        # INT8 models go through the accuracy gate in modelConversion.py, so they are never built here
+        onnx_path = options.get('onnx_int8_path' if name == 'onnx-int8' else 'onnx_path',
+                                'MobileNetV2.int8.onnx' if name == 'onnx-int8' else 'MobileNetV2.onnx')
+        if not os.path.exists(onnx_path):
+            raise FileNotFoundError(f"{onnx_path} not found, run: python modelConversion.py onnx")
+        return OnnxBackend(onnx_path, num_threads=options.get('num_threads', 1))
+    raise ValueError(f"Unknown inference backend: {name}")
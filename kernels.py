@@ -0,0 +1,129 @@
+import numpy as np
+from numba import njit
+
+
+"""
+Fused per-pixel kernels for preprocessing.
+Each kernel makes a single pass over a uint8 image without temporary arrays
+and releases the GIL, so concurrent requests can run them in parallel.
+"""
+
+_HSV_SHIFT = 12
+
+# OpenCV's integer lookup tables for 8-bit RGB -> HSV, so results match cv2.cvtColor exactly
+_SDIV_TABLE = np.zeros(256, dtype=np.int32)
+_HDIV_TABLE = np.zeros(256, dtype=np.int32)
+for _i in range(1, 256):
+    _SDIV_TABLE[_i] = int(round((255 << _HSV_SHIFT) / _i))
+    _HDIV_TABLE[_i] = int(round((180 << _HSV_SHIFT) / (6.0 * _i)))
+
+
+@njit(cache=True, nogil=True)
+def _green_count(image, sdiv_table, hdiv_table, h_low, h_high, s_low, v_low):
+    rows, cols = image.shape[0], image.shape[1]
+    half = 1 << (_HSV_SHIFT - 1)
+    count = 0
+    for y in range(rows):
+        for x in range(cols):
+            r = np.int32(image[y, x, 0])
+            g = np.int32(image[y, x, 1])
+            b = np.int32(image[y, x, 2])
+            v = max(r, g, b)
+            if v < v_low:
+                continue
+            diff = v - min(r, g, b)
+            s = (diff * sdiv_table[v] + half) >> _HSV_SHIFT
+            if s < s_low:
+                continue
+            if v == r:
+                h = g - b
+            elif v == g:
+                h = b - r + 2 * diff
+            else:
+                h = r - g + 4 * diff
+            h = (h * hdiv_table[diff] + half) >> _HSV_SHIFT
+            if h < 0:
+                h += 180
+            if h_low <= h <= h_high:
+                count += 1
+    return count
+
+
+def green_ratio(image, lower=(20, 30, 30), upper=(100, 255, 255)):
+    """
+    Fraction of pixels inside an HSV range, same result as
+    cv2.inRange(cv2.cvtColor(image, cv2.COLOR_RGB2HSV), lower, upper)
+
+    Parameters:
+    -----------
+    image : numpy.ndarray
+        uint8 RGB image
+    lower, upper : tuple, optional
+        OpenCV HSV bounds (H in 0-180). Upper S and V bounds must be 255
+
+    Returns:
+    --------
+    float
+        Green pixel fraction between 0 and 1
+    """
+    count = _green_count(image, _SDIV_TABLE, _HDIV_TABLE, lower[0], upper[0], lower[1], lower[2])
+    return count / (image.shape[0] * image.shape[1])
+
+
+@njit(cache=True, nogil=True)
+def _composite(image, mask, out):
+    rows, cols = mask.shape
+    for y in range(rows):
+        for x in range(cols):
+            m = np.int32(mask[y, x])
+            if m == 255:
+                out[y, x, 0] = image[y, x, 0]
+                out[y, x, 1] = image[y, x, 1]
+                out[y, x, 2] = image[y, x, 2]
+            elif m == 0:
+                out[y, x, 0] = 255
+                out[y, x, 1] = 255
+                out[y, x, 2] = 255
+            else:
+                white = 255 * (255 - m)
+                for c in range(3):
+                    out[y, x, c] = (np.int32(image[y, x, c]) * m + white) // 255
+    return out
+
+
+def composite_on_white(image, mask, out=None):
+    """
+    Blend image onto white using a 0-255 mask in one pass
+
+    Parameters:
+    -----------
+    image : numpy.ndarray
+        uint8 image with at least 3 channels, extra channels (alpha) are ignored
+    mask : numpy.ndarray
+        uint8 single channel mask, 255 keeps the image and 0 gives white
+    out : numpy.ndarray, optional
+        uint8 (H, W, 3) array to write into, allocated if not given
+
+    Returns:
+    --------
+    numpy.ndarray
+        uint8 RGB image
+    """
+    if out is None:
+        out = np.empty((mask.shape[0], mask.shape[1], 3), dtype=np.uint8)
+    return _composite(image, mask, out)
+
+
+@njit(cache=True, nogil=True)
+def _count_below(image, threshold):
+    flat = image.reshape(-1)
+    count = 0
+    for i in range(flat.size):
+        if flat[i] < threshold:
+            count += 1
+    return count
+
+
+def non_white_ratio(image, threshold=250):
+    """Fraction of channel values below threshold, same as np.sum(image < threshold) / image.size"""
+    return _count_below(np.ascontiguousarray(image), threshold) / image.size
@@ -0,0 +1,398 @@
+import atexit
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+
+"""
+Minimal Prometheus metrics.
+Counters and histograms keep one shard of values per thread, so recording
+never takes a lock; shards are only summed when /metrics is scraped.
+Under several server processes each one writes its values to a shared
+directory and MultiProcessCollector merges them, so any worker answers
+/metrics for all of them.
+"""
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Child:
+    """Values of one label set, sharded per thread"""
+
+    def __init__(self, width):
+        self.width = width
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def shard(self):
+        thread_id = threading.get_ident()
+        shard = self._shards.get(thread_id)
+        if shard is None:
+            # Only the first record of a thread takes the lock
+            with self._lock:
+                shard = self._shards.setdefault(thread_id, [0] * self.width)
+        return shard
+
+    def totals(self):
+        with self._lock:
+            shards = list(self._shards.values())
+        totals = [0] * self.width
+        for shard in shards:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _width(self):
+        return 1
+
+    def labels(self, *values, **kwargs):
+        key = tuple(str(v) for v in values) if values else tuple(str(kwargs[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._bind(_Child(self._width())))
+        return child
+
+    def _bind(self, child):
+        return child
+
+    def values(self):
+        """{label values: totals} of this process"""
+        return {key: child.totals() for key, child in self._items()}
+
+    def _samples(self, values):
+        raise NotImplementedError
+
+    def expose(self, values=None):
+        """Exposition lines for values(), or for values merged from several processes"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples(self.values() if values is None else values))
+        return lines
+
+    def _items(self):
+        with self._lock:
+            return list(self._children.items())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _bind(self, child):
+        def inc(amount=1):
+            child.shard()[0] += amount
+        child.inc = inc
+        return child
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self, values):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(totals[0])}"
+                for key, totals in values.items()]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _width(self):
+        # One slot per bucket, then +Inf, sum and count
+        return len(self.buckets) + 3
+
+    def _bind(self, child):
+        buckets = self.buckets
+        size = len(buckets)
+
+        def observe(value):
+            shard = child.shard()
+            shard[bisect.bisect_left(buckets, value)] += 1
+            shard[size + 1] += value
+            shard[size + 2] += 1
+
+        child.observe = observe
+        return child
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self, values):
+        lines = []
+        size = len(self.buckets)
+        for key, totals in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), totals[:size + 1]):
+                cumulative += count
+                le = f'le="{_format_value(float(bound)) if bound != float("inf") else "+Inf"}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(float(totals[size + 1]))}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {totals[size + 2]}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Value read from a callback at scrape time, e.g. a queue depth. Summed over processes when merged"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._callbacks = {}
+
+    def set_function(self, fn, *values):
+        with self._lock:
+            self._callbacks[tuple(str(v) for v in values)] = fn
+
+    def values(self):
+        with self._lock:
+            callbacks = list(self._callbacks.items())
+        values = {}
+        for key, fn in callbacks:
+            try:
+                values[key] = [fn()]
+            except Exception:
+                continue
+        return values
+
+    def _samples(self, values):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(totals[0])}"
+                for key, totals in values.items()]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def values(self):
+        """{metric name: {label values: totals}} of this process"""
+        return {metric.name: metric.values() for metric in self.metrics()}
+
+    def expose(self, values=None):
+        """All metrics in the Prometheus text exposition format, from values() unless given"""
+        lines = []
+        for metric in self.metrics():
+            lines.extend(metric.expose(None if values is None else values.get(metric.name, {})))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _merge(into, values, kinds=None):
+    """Add {name: {labels: totals}} values into another such dict, optionally only metrics of some kinds"""
+    for name, children in values.items():
+        if kinds is not None and kinds.get(name) not in ('counter', 'histogram'):
+            continue
+        merged = into.setdefault(name, {})
+        for key, totals in children.items():
+            if key in merged and len(merged[key]) == len(totals):
+                merged[key] = [a + b for a, b in zip(merged[key], totals)]
+            else:
+                merged[key] = list(totals)
+    return into
+
+
+class MultiProcessCollector:
+    DEAD = 'dead.json'
+
+    def __init__(self, registry, directory, interval=5.0):
+        """
+        Metrics of every server process, merged through files in a shared directory
+
+        Every process writes its values to directory/<pid>.json, every interval
+        seconds and whenever it answers a scrape. Counters and histograms are
+        summed over all processes; those of exited processes are folded into
+        dead.json by mark_dead() so totals never go backwards. Gauges are
+        summed over the live processes only.
+
+        Parameters:
+        -----------
+        registry : Registry
+        directory : str
+            Created if missing, must be empty (see clear()) when the server starts
+        interval : float, optional
+            Seconds between writes, the staleness of other processes' values. Default is 5
+        """
+        self.registry = registry
+        self.directory = directory
+        self.interval = float(interval)
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def clear(directory):
+        """Remove the files of a previous server run"""
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith('.json') or name.endswith('.tmp'):
+                os.remove(os.path.join(directory, name))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _write(self, name, values):
+        # Readers only ever see a whole file, os.replace is atomic
+        temporary = self._path(f".{name}.{os.getpid()}.tmp")
+        with open(temporary, 'w') as f:
+            json.dump({metric: [[list(key), totals] for key, totals in children.items()]
+                       for metric, children in values.items()}, f, default=float)
+        os.replace(temporary, self._path(name))
+
+    def _read(self, name):
+        try:
+            with open(self._path(name)) as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+        return {metric: {tuple(key): totals for key, totals in children} for metric, children in data.items()}
+
+    def _locked(self, exclusive):
+        """flock on directory/.lock, shared for reading and exclusive while folding in a dead process"""
+        # Only needed under a multi-process server, which is Unix only
+        import fcntl
+        lock = open(self._path('.lock'), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return lock
+
+    def write(self):
+        """Write this process's values now"""
+        try:
+            self._write(f"{os.getpid()}.json", self.registry.values())
+        except OSError as e:
+            logging.error(f"Could not write metrics to {self.directory}: {e}")
+
+    def start(self):
+        """Begin writing every interval seconds, call it in each worker after the fork"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write_loop, name="metrics-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.write)
+        return self
+
+    def _write_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+    def mark_dead(self, pid):
+        """Fold the counters and histograms of an exited process into dead.json, drop its gauges"""
+        kinds = {metric.name: metric.kind for metric in self.registry.metrics()}
+        with self._locked(True):
+            values = self._read(f"{pid}.json")
+            if values:
+                self._write(self.DEAD, _merge(self._read(self.DEAD), values, kinds))
+            try:
+                os.remove(self._path(f"{pid}.json"))
+            except FileNotFoundError:
+                pass
+
+    def values(self):
+        """Values of every process, this one's read live"""
+        own = self.registry.values()
+        merged = {}
+        with self._locked(False):
+            for name in os.listdir(self.directory):
+                if name.endswith('.json') and name != f"{os.getpid()}.json":
+                    _merge(merged, self._read(name))
+        return _merge(merged, own)
+
+    def expose(self):
+        """All processes' metrics in the Prometheus text exposition format"""
+        self.write()
+        return self.registry.expose(self.values())
+
+
+def timed_stream(chunks, ttft, token_rate):
+    """
+    Pass a token stream through while recording time to first token and tokens per second
+
+    Parameters:
+    -----------
+    chunks : iterable
+        Token chunks, e.g. from OllamaStreamer.generate_text
+    ttft, token_rate : histogram children
+        Receive the seconds until the first chunk and chunks per second after it
+    """
+    start = time.perf_counter()
+    first = None
+    count = 0
+    for chunk in chunks:
+        if first is None:
+            first = time.perf_counter()
+            ttft.observe(first - start)
+        count += 1
+        yield chunk
+    if first is not None and count > 1:
+        elapsed = time.perf_counter() - first
+        if elapsed > 0:
+            token_rate.observe((count - 1) / elapsed)
+
+
+async def timed_astream(chunks, ttft, token_rate):
+    """timed_stream for async iterators, e.g. AsyncOllamaStreamer.generate_text"""
+    start = time.perf_counter()
+    first = None
+    count = 0
+    async for chunk in chunks:
+        if first is None:
+            first = time.perf_counter()
+            ttft.observe(first - start)
+        count += 1
+        yield chunk
+    if first is not None and count > 1:
+        elapsed = time.perf_counter() - first
+        if elapsed > 0:
+            token_rate.observe((count - 1) / elapsed)
@@ -1,6 +1,253 @@
+import argparse
+import os
+
+import numpy as np
 import tensorflow as tf
-model_out = tf.keras.models.load_model("MobileNetV2.keras")
-print("Model loaded")
-print(model_out.summary())
 
-model_out.save('MobileNetV2.h5')
\ No newline at end of file
+KERAS_MODEL_PATH = "MobileNetV2.keras"
+TFLITE_MODEL_PATH = "MobileNetV2.tflite"
+ONNX_MODEL_PATH = "MobileNetV2.onnx"
+ONNX_INT8_MODEL_PATH = "MobileNetV2.int8.onnx"
+CALIBRATION_FOLDER = "uploads"
+
+
+def load_keras_model(model_path=KERAS_MODEL_PATH):
+    model_out = tf.keras.models.load_model(model_path)
+    print("Model loaded")
+    return model_out
+
+
+def convert_to_h5(model, output_path='MobileNetV2.h5'):
+    model.save(output_path)
+    return output_path
+
+
+def convert_to_tflite(model, output_path=TFLITE_MODEL_PATH):
+    """
+    Convert the Keras classifier to a TFLite flatbuffer
+
+    Parameters:
+    -----------
+    model : tf.keras.Model
+        Loaded classifier
+    output_path : str, optional
+        Where the .tflite file is written
+
+    Returns:
+    --------
+    str
+        Path of the written model
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    tflite_model = converter.convert()
+    with open(output_path, 'wb') as f:
+        f.write(tflite_model)
+    print(f"TFLite model written to {output_path} ({len(tflite_model) / 1e6:.1f} MB)")
+    return output_path
+
+
+def ensure_tflite_model(keras_path=KERAS_MODEL_PATH, output_path=TFLITE_MODEL_PATH):
+    """Convert once and reuse the file on later starts"""
+    if not os.path.exists(output_path) or os.path.getmtime(output_path) < os.path.getmtime(keras_path):
+        convert_to_tflite(load_keras_model(keras_path), output_path)
+    return output_path
+
+
+def convert_to_onnx(model, output_path=ONNX_MODEL_PATH, opset=13):
+    """
+    Export the Keras classifier to ONNX with a dynamic batch dimension
+
+    Parameters:
+    -----------
+    model : tf.keras.Model
+        Loaded classifier
+    output_path : str, optional
+        Where the .onnx file is written
+    opset : int, optional
+        ONNX opset version. Default is 13
+
+    Returns:
+    --------
+    str
+        Path of the written model
+    """
+    try:
+        import tf2onnx
+    except ImportError as e:
+        # Kept out of requirements.txt, its protobuf pin conflicts with the serving environment
+        raise ImportError("tf2onnx is missing, install requirements-conversion.txt") from e
+
+    input_shape = model.inputs[0].shape
+    spec = (tf.TensorSpec((None, *input_shape[1:]), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(model, input_signature=spec, opset=opset, output_path=output_path)
+    print(f"ONNX model written to {output_path}")
+    return output_path
+
+
+def load_calibration_tensors(folder=CALIBRATION_FOLDER, limit=None):
+    """
+    Run the images of a folder through the serving preprocessing
+
+    Parameters:
+    -----------
+    folder : str, optional
+        Folder of uploaded images. Default is uploads/
+    limit : int, optional
+        Only use the first `limit` usable images
+
+    Returns:
+    --------
+    numpy.ndarray
+        (N, 224, 224, 3) uint8 tensors exactly as predict_disease sends them to the model
+    """
+    from preprocessing import preprocess_image
+    from storage import iter_upload_images
+
+    tensors = []
+    for image_path in iter_upload_images(folder):
+        preprocessed = preprocess_image(image_path)
+        if preprocessed is None:
+            continue
+        tensors.append(preprocessed)
+        if limit and len(tensors) >= limit:
+            break
+    print(f"Loaded {len(tensors)} calibration images from {folder}")
+    return np.stack(tensors)
+
+
+class UploadsCalibrationReader:
+    """Feeds preprocessed upload tensors to the onnxruntime static quantizer"""
+
+    def __init__(self, tensors, input_name, batch_size=8):
+        self.input_name = input_name
+        self.batches = iter([
+            tensors[i:i + batch_size].astype(np.float32)
+            for i in range(0, len(tensors), batch_size)
+        ])
+
+    def get_next(self):
+        batch = next(self.batches, None)
+        return None if batch is None else {self.input_name: batch}
+
+    def rewind(self):
+        pass
+
+
+def quantize_onnx_int8(onnx_path, tensors, output_path=ONNX_INT8_MODEL_PATH):
+    """
+    Build a static INT8 (QDQ) variant of an ONNX model
+
+    Parameters:
+    -----------
+    onnx_path : str
+        Float ONNX model
+    tensors : numpy.ndarray
+        Calibration tensors from load_calibration_tensors()
+    output_path : str, optional
+        Where the quantized model is written
+
+    Returns:
+    --------
+    str
+        Path of the quantized model
+    """
+    import onnxruntime as ort
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    prepared_path = onnx_path.replace('.onnx', '.prep.onnx')
+    quant_pre_process(onnx_path, prepared_path)
+    input_name = ort.InferenceSession(prepared_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    quantize_static(
+        prepared_path,
+        output_path,
+        UploadsCalibrationReader(tensors, input_name),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True
+    )
+    os.remove(prepared_path)
+    print(f"INT8 ONNX model written to {output_path}")
+    return output_path
+
+
+def top1_agreement(reference_predict, candidate_predict, tensors, batch_size=16):
+    """
+    Fraction of images where two models pick the same class
+
+    Parameters:
+    -----------
+    reference_predict, candidate_predict : callable
+        Functions mapping an (N, 224, 224, 3) batch to (N, num_classes) scores
+    tensors : numpy.ndarray
+        Images to compare on
+
+    Returns:
+    --------
+    float
+        Top-1 agreement between 0 and 1
+    """
+    matches = 0
+    for i in range(0, len(tensors), batch_size):
+        batch = tensors[i:i + batch_size]
+        reference = np.argmax(reference_predict(batch), axis=1)
+        candidate = np.argmax(candidate_predict(batch), axis=1)
+        matches += int(np.sum(reference == candidate))
+    return matches / max(1, len(tensors))
+
+
+def build_onnx_models(model, tensors, min_agreement=0.98,
+                      onnx_path=ONNX_MODEL_PATH, int8_path=ONNX_INT8_MODEL_PATH):
+    """
+    Export to ONNX, quantize to INT8 and only keep the quantized model if it
+    agrees with the Keras model on at least `min_agreement` of the corpus
+
+    Returns:
+    --------
+    dict
+        Agreement of each exported model against Keras and whether INT8 was accepted
+    """
+    from inference import OnnxBackend
+
+    convert_to_onnx(model, onnx_path)
+    quantize_onnx_int8(onnx_path, tensors, int8_path)
+
+    keras_predict = lambda batch: model.predict(batch, verbose=0)
+    report = {
+        'images': len(tensors),
+        'onnx_agreement': top1_agreement(keras_predict, OnnxBackend(onnx_path).predict, tensors),
+        'int8_agreement': top1_agreement(keras_predict, OnnxBackend(int8_path).predict, tensors),
+        'min_agreement': min_agreement
+    }
+    report['int8_accepted'] = report['int8_agreement'] >= min_agreement
+    print(f"Top-1 agreement with Keras over {report['images']} images: "
+          f"onnx={report['onnx_agreement']:.4f} int8={report['int8_agreement']:.4f}")
+    if not report['int8_accepted']:
+        print(f"INT8 model rejected (below {min_agreement:.2%}), removing {int8_path}")
+        os.remove(int8_path)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the MobileNetV2 classifier to other formats")
+    parser.add_argument('target', nargs='?', default='h5', choices=['h5', 'tflite', 'onnx'])
+    parser.add_argument('--model', default=KERAS_MODEL_PATH)
+    parser.add_argument('--output')
+    parser.add_argument('--calibration-folder', default=CALIBRATION_FOLDER)
+    parser.add_argument('--calibration-limit', type=int)
+    parser.add_argument('--min-agreement', type=float, default=0.98,
+                        help="Top-1 agreement with Keras required to accept the INT8 model")
+    args = parser.parse_args()
+
+    model_out = load_keras_model(args.model)
+    print(model_out.summary())
+    if args.target == 'h5':
+        convert_to_h5(model_out, args.output or 'MobileNetV2.h5')
+    elif args.target == 'tflite':
+        convert_to_tflite(model_out, args.output or TFLITE_MODEL_PATH)
+    else:
+        tensors = load_calibration_tensors(args.calibration_folder, args.calibration_limit)
+        report = build_onnx_models(model_out, tensors, args.min_agreement,
+                                   onnx_path=args.output or ONNX_MODEL_PATH)
+        raise SystemExit(0 if report['int8_accepted'] else 1)
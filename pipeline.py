@@ -0,0 +1,243 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from preprocessing import (check_green_percentage, describe_source, enhance_contrast, initialize_preprocessor,
+                           load_image, non_white_ratio, remove_background, resize_with_padding)
+
+
+"""
+Staged preprocessing pipeline.
+Every step of preprocess_image is a Stage object working on a shared
+PipelineContext, so stages can reuse each other's intermediates, be timed
+individually and be switched off per deployment. Only recoverable stages
+(segmentation) fall back to the working image on an error, any other failing
+stage, e.g. decoding bytes that are not an image, raises PreprocessingError.
+"""
+
+DEFAULT_STAGES = ('decode', 'leaf_gate', 'segmentation', 'contrast', 'resize', 'tensor')
+
+
+class PreprocessingError(ValueError):
+    """A stage without a fallback failed, the image cannot be predicted"""
+
+
+class PipelineContext:
+    def __init__(self, source, config):
+        self.source = source
+        self.config = config
+        # Named intermediates shared between stages. 'image' is the working image
+        self.data = {}
+        self.result = None
+        self.stopped = False
+        self.error = None
+        # True once a recoverable stage failed and was skipped, the result is then degraded
+        self.fallback = False
+        # (stage name, seconds, bytes of new arrays)
+        self.timings = []
+        # Finer timings reported by a stage, e.g. rembg and matting inside segmentation
+        self.substages = {}
+
+    def get(self, name, default=None):
+        return self.data.get(name, default)
+
+    def put(self, name, value):
+        self.data[name] = value
+
+    @property
+    def image(self):
+        return self.data['image']
+
+    @image.setter
+    def image(self, value):
+        self.data['image'] = value
+
+    def stop(self, result=None):
+        """End the pipeline early with result"""
+        self.result = result
+        self.stopped = True
+
+
+class Stage:
+    name = 'stage'
+    # An error in a recoverable stage skips it and keeps the working image
+    recoverable = False
+
+    def run(self, ctx):
+        raise NotImplementedError
+
+
+class DecodeStage(Stage):
+    name = 'decode'
+
+    def run(self, ctx):
+        ctx.put('rgb', load_image(ctx.source))
+        ctx.image = ctx.get('rgb')
+
+
+class LeafGateStage(Stage):
+    """Reject images that do not look like a plant"""
+    name = 'leaf_gate'
+
+    def __init__(self, min_green=0.3):
+        self.min_green = min_green
+
+    def run(self, ctx):
+        green_percentage = check_green_percentage(ctx.image)
+        ctx.put('green_percentage', green_percentage)
+        if green_percentage < self.min_green:
+            ctx.stop(None)
+
+
+class SegmentationStage(Stage):
+    """Background removal, falling back to the original image when the result is (almost) empty"""
+    name = 'segmentation'
+    recoverable = True
+
+    def run(self, ctx):
+        no_bg_image = remove_background(ctx.image, ctx.config, ctx.get('green_percentage'), ctx.substages)
+        ctx.put('no_bg', no_bg_image)
+        # Check if the result is mostly empty (failed segmentation
+        if non_white_ratio(no_bg_image) >= 0.01:
+            ctx.image = no_bg_image
+
+
+class ContrastStage(Stage):
+    name = 'contrast'
+
+    def run(self, ctx):
+        ctx.image = enhance_contrast(ctx.image)
+
+
+class ResizeStage(Stage):
+    name = 'resize'
+
+    def run(self, ctx):
+        ctx.image = resize_with_padding(ctx.image, ctx.config)
+
+
+class TensorStage(Stage):
+    """Final model input: contiguous uint8 (H, W, 3), the model takes 0-255 values"""
+    name = 'tensor'
+
+    def run(self, ctx):
+        ctx.stop(np.ascontiguousarray(ctx.image, dtype=np.uint8))
+
+
+STAGES = {
+    'decode': DecodeStage,
+    'leaf_gate': LeafGateStage,
+    'segmentation': SegmentationStage,
+    'contrast': ContrastStage,
+    'resize': ResizeStage,
+    'tensor': TensorStage
+}
+
+
+def _array_bytes(data, seen):
+    return sum(value.nbytes for value in data.values() if isinstance(value, np.ndarray) and id(value) not in seen)
+
+
+class Pipeline:
+    def __init__(self, stages=DEFAULT_STAGES, config=None):
+        """
+        Ordered list of preprocessing stages
+
+        Parameters:
+        -----------
+        stages : iterable, optional
+            Stage names from STAGES or Stage instances. 'decode' must come first
+            for sources that are not already RGB arrays. Default is DEFAULT_STAGES
+        config : dict, optional
+            Preprocessing configuration from initialize_preprocessor()
+        """
+        self.stages = [STAGES[stage]() if isinstance(stage, str) else stage for stage in stages]
+        self.config = config if config is not None else initialize_preprocessor()
+        # Called as observer(stage_name, seconds, nbytes) after every stage
+        self.observers = []
+        self._totals = {stage.name: [0, 0.0, 0] for stage in self.stages}
+        self._lock = threading.Lock()
+
+    @property
+    def stage_names(self):
+        return [stage.name for stage in self.stages]
+
+    def run(self, source, config=None):
+        """
+        Run every stage on one image
+
+        Parameters:
+        -----------
+        source : str, bytes or numpy.ndarray
+            Path, encoded bytes or RGB array
+        config : dict, optional
+            Overrides the pipeline config for this image (e.g. another segmentation tier)
+
+        Returns:
+        --------
+        PipelineContext
+            ctx.result holds the tensor (or None for rejected images), ctx.timings the per-stage cost
+            and ctx.fallback whether a recoverable stage was skipped. Raises PreprocessingError
+            when any other stage fails
+        """
+        ctx = PipelineContext(source, config or self.config)
+        if isinstance(source, np.ndarray):
+            ctx.put('rgb', source)
+            ctx.image = source
+
+        for stage in self.stages:
+            seen = {id(value) for value in ctx.data.values()}
+            start = time.perf_counter()
+            try:
+                stage.run(ctx)
+            except Exception as e:
+                ctx.error = f"{stage.name}: {e}"
+                print(f"Preprocessing error for {describe_source(source)} in stage {stage.name}: {e}")
+                if not stage.recoverable:
+                    self._record(ctx, stage.name, time.perf_counter() - start, 0)
+                    raise PreprocessingError(ctx.error) from e
+                ctx.fallback = True
+            self._record(ctx, stage.name, time.perf_counter() - start, _array_bytes(ctx.data, seen))
+            for name, seconds in ctx.substages.items():
+                self._record(ctx, name, seconds, 0)
+            ctx.substages.clear()
+            if ctx.stopped:
+                break
+
+        if not ctx.stopped:
+            # Pipelines without a tensor stage still hand back their working image
+            ctx.result = ctx.get('image')
+        return ctx
+
+    def _record(self, ctx, name, seconds, nbytes):
+        ctx.timings.append((name, seconds, nbytes))
+        with self._lock:
+            totals = self._totals.setdefault(name, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += nbytes
+        for observer in self.observers:
+            try:
+                observer(name, seconds, nbytes)
+            except Exception as e:
+                logging.error(f"Pipeline observer failed: {e}")
+
+    def stats(self):
+        """Per-stage run count, mean milliseconds and mean bytes allocated"""
+        with self._lock:
+            return {
+                name: {
+                    "runs": runs,
+                    "mean_ms": seconds / runs * 1000 if runs else 0.0,
+                    "mean_bytes": nbytes / runs if runs else 0
+                }
+                for name, (runs, seconds, nbytes) in self._totals.items()
+            }
+
+
+def build_pipeline(config=None, stages=None):
+    """Pipeline with the stage list from config['stages'] (or DEFAULT_STAGES)"""
+    config = config if config is not None else initialize_preprocessor()
+    return Pipeline(stages or config.get('stages', DEFAULT_STAGES), config)
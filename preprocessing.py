@@ -1,6 +1,12 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
 import numpy as np
 import cv2
-from rembg import remove
+
+from kernels import composite_on_white, green_ratio, non_white_ratio
 
 
 """
@@ -9,14 +15,61 @@ first the target size is initialized
 
 def check_green_percentage(image):
     # Check if the image is predominantly green (likely a close-up of a leaf)
-    hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
-    lower_green = np.array([20, 30, 30])
-    upper_green = np.array([100, 255, 255])
-    green_mask = cv2.inRange(hsv, lower_green, upper_green)
-    green_percentage = np.sum(green_mask > 0) / (image.shape[0] * image.shape[1])
-    return green_percentage
-
-def initialize_preprocessor(target_size=(224, 224)):
+    # Single pass equivalent of cv2.inRange on the HSV image, without the HSV and mask copies
+    return green_ratio(image, lower=(20, 30, 30), upper=(100, 255, 255))
+
+class SessionPool:
+    def __init__(self, model_name='u2net', size=2, warm_up=True):
+        """
+        Thread-safe pool of rembg sessions for one segmentation model
+
+        Parameters:
+        -----------
+        model_name : str, optional
+            rembg model, e.g. 'u2net', 'u2netp', 'silueta', 'isnet-general-use'. Default is 'u2net'
+        size : int, optional
+            Number of sessions, i.e. concurrent background removals. Default is 2
+        warm_up : bool, optional
+            Run a dummy image through every session so the first request does not pay for it
+        """
+        # rembg pulls in onnxruntime, imported only once a pool is actually built
+        from rembg import new_session, remove
+
+        self.model_name = model_name
+        self._sessions = queue.Queue()
+        for _ in range(max(1, int(size))):
+            session = new_session(model_name)
+            if warm_up:
+                remove(np.full((64, 64, 3), 255, dtype=np.uint8), session=session)
+            self._sessions.put(session)
+
+    @contextmanager
+    def session(self):
+        session = self._sessions.get()
+        try:
+            yield session
+        finally:
+            self._sessions.put(session)
+
+
+_session_pools = {}
+_session_pools_lock = threading.Lock()
+
+
+def get_session_pool(model_name='u2net', size=2, warm_up=True):
+    """Create the session pool for a model and size once and share it between configs"""
+    key = (model_name, size)
+    with _session_pools_lock:
+        pool = _session_pools.get(key)
+        if pool is None:
+            print(f"Loading rembg model {model_name} ({size} sessions)...")
+            pool = SessionPool(model_name, size, warm_up)
+            _session_pools[key] = pool
+        return pool
+
+
+def initialize_preprocessor(target_size=(224, 224), segmentation_model='u2net', session_pool_size=2, warm_up=True,
+                            segmentation_tier='full', working_size=512, stages=None):
     """
     Initialize preprocessing configuration
 
@@ -24,6 +77,20 @@ def initialize_preprocessor(target_size=(224, 224)):
     -----------
     target_size : tuple, optional
         Desired output image size (width, height). Default is (224, 224)
+    segmentation_model : str, optional
+        rembg model used for background removal. 'u2netp' is much lighter
+        than the default 'u2net'. Default is 'u2net'
+    session_pool_size : int, optional
+        rembg sessions in the pool, configs with the same model and size share one pool. Default is 2
+    warm_up : bool, optional
+        Warm new sessions with a dummy image. Default is True
+    segmentation_tier : str, optional
+        'full', 'fast' (matting at working_size) or 'mask' (no matting). Default is 'full'
+    working_size : int, optional
+        Longest image side used by the 'fast' and 'mask' tiers. Default is 512
+    stages : list, optional
+        Pipeline stage names, e.g. without 'segmentation' on overloaded nodes.
+        Default is every stage (see pipeline.DEFAULT_STAGES)
 
     Returns:
     --------
@@ -31,96 +98,187 @@ def initialize_preprocessor(target_size=(224, 224)):
         Configuration dictionary for preprocessing
     """
     return {
-        'target_size': target_size
+        'target_size': target_size,
+        'segmentation_model': segmentation_model,
+        'segmentation_tier': segmentation_tier,
+        'working_size': working_size,
+        'stages': stages or ['decode', 'leaf_gate', 'segmentation', 'contrast', 'resize', 'tensor'],
+        'session_pool': get_session_pool(segmentation_model, session_pool_size, warm_up)
     }
 
 
-def remove_background(image, config=None):
+SEGMENTATION_TIERS = ('full', 'fast', 'mask')
+
+
+class _TimedSession:
+    """Session proxy measuring the segmentation network apart from the rest of rembg.remove"""
+
+    def __init__(self, session):
+        self._session = session
+        self.predict_seconds = 0.0
+
+    def predict(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._session.predict(*args, **kwargs)
+        finally:
+            self.predict_seconds += time.perf_counter() - start
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+def run_rembg(image, config, alpha_matting=True, timings=None):
     """
-    Remove background using rembg with enhanced parameters and segment the main leaf.
+    Run rembg on an RGB image with the pooled session of the configured model
 
     Parameters:
     -----------
-    image : numpy.ndarray
-        Input image to process in RGB format
-    config : dict, optional
-        Preprocessing configuration
+    timings : dict, optional
+        Receives 'rembg' (segmentation network) and 'matting' (alpha matting
+        and mask post-processing) seconds
 
     Returns:
     --------
     numpy.ndarray
-        Processed image with the background removed and focused on the main leaf
+        RGBA output of rembg
     """
-    try:
-
-        green_percentage = check_green_percentage(image)
-
-        # If image is almost entirely green (>90%), skip rembg
-        if green_percentage > 0.9999:
-            final_image = image.copy()
-            return final_image
-
-        # For regular images, use rembg with carefully tuned parameters
-        image_copy = image.copy()
+    from rembg import remove
 
+    with config['session_pool'].session() as session:
+        timed_session = _TimedSession(session) if timings is not None else session
+        start = time.perf_counter()
         # Remove background with more conservative settings to avoid cutting the leaf
         output = remove(
-            image_copy,
-            alpha_matting=True,
+            image,
+            session=timed_session,
+            alpha_matting=alpha_matting,
             alpha_matting_foreground_threshold=240,  # Higher threshold to include more of the leaf
             alpha_matting_background_threshold=10,   # Lower threshold for better background separation
             alpha_matting_erode_size=5,             # Reduced erosion to preserve leaf edges
             post_process_mask=True
         )
+        if timings is not None:
+            timings['rembg'] = timed_session.predict_seconds
+            timings['matting'] = time.perf_counter() - start - timed_session.predict_seconds
+        return output
 
-        """
-        the output of the rembg function has an alpha channel
-        the model needs an rbg image the following steps seperates the rgn from the alpha
-        and finds the leaf edge and adds it to the white background
-        """
 
-        # Separate RGB and alpha channels
-        output_rgb = output[:, :, :3]
-        alpha_channel = output[:, :, 3]
+def refine_mask(alpha_channel):
+    """
+    Turn the rembg alpha channel into a filled binary mask of the leaf and its spots
+
+    Parameters:
+    -----------
+    alpha_channel : numpy.ndarray
+        Alpha channel returned by rembg
+
+    Returns:
+    --------
+    numpy.ndarray
+        uint8 mask with 255 on the leaf and 0 elsewhere
+    """
+    # Threshold the alpha channel to create a binary mask with a lower threshold to keep more of the leaf
+    _, binary_mask = cv2.threshold(alpha_channel, 50, 255, cv2.THRESH_BINARY)
 
+    # Apply morphological operations to clean up the mask
+    kernel = np.ones((3, 3), np.uint8)
+    binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_CLOSE, kernel, iterations=2)
 
-        # Threshold the alpha channel to create a binary mask with a lower threshold to keep more of the leaf
-        _, binary_mask = cv2.threshold(alpha_channel, 50, 255, cv2.THRESH_BINARY)
+    # Find contours in the binary mask
+    contours, _ = cv2.findContours(binary_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-        # Apply morphological operations to clean up the mask
-        kernel = np.ones((3, 3), np.uint8)
-        binary_mask = cv2.morphologyEx(binary_mask, cv2.MORPH_CLOSE, kernel, iterations=2)
+    if len(contours) == 0:
+        # If no contours found, use the original binary mask
+        return binary_mask
 
-        # Find contours in the binary mask
-        contours, _ = cv2.findContours(binary_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # Find the largest contour by area
+    largest_contour = max(contours, key=cv2.contourArea)
 
-        if len(contours) == 0:
-            # If no contours found, use the original binary mask
-            refined_mask = binary_mask
-        else:
-            # Find the largest contour by area
-            largest_contour = max(contours, key=cv2.contourArea)
+    # Create a refined mask from the largest contour
+    refined_mask = np.zeros_like(binary_mask)
+    cv2.drawContours(refined_mask, [largest_contour], -1, color=255, thickness=-1)
 
-            # Create a refined mask from the largest contour
-            refined_mask = np.zeros_like(binary_mask)
-            cv2.drawContours(refined_mask, [largest_contour], -1, color=255, thickness=-1)
+    # If there are other contours that are disease spots, preserve them
+    for contour in contours:
+        if contour is not largest_contour:
+            cv2.drawContours(refined_mask, [contour], -1, color=255, thickness=-1)
 
-            # If there are other contours that are disease spots, preserve them
-            for contour in contours:
-                if contour is not largest_contour:
-                    cv2.drawContours(refined_mask, [contour], -1, color=255, thickness=-1)
+    return refined_mask
 
-        # Convert the single channel mask to a 3-channel mask
-        refined_mask_3 = cv2.merge([refined_mask, refined_mask, refined_mask])
-        mask_norm = refined_mask_3.astype(np.float32) / 255.0
 
-        # Create a white background image
-        white_background = np.ones_like(output_rgb, dtype=np.uint8) * 255
+def downscale_to(image, max_side):
+    """Shrink so the longest side is at most max_side, returns (image, scaled)"""
+    h, w = image.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1:
+        return image, False
+    return cv2.resize(image, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA), True
 
-        # Composite the output_rgb using the refined mask
-        final_image = (output_rgb * mask_norm + white_background * (1 - mask_norm)).astype(np.uint8)
 
-        return final_image
+def remove_background(image, config=None, green_percentage=None, timings=None):
+    """
+    Remove background using rembg with enhanced parameters and segment the main leaf.
+
+    The segmentation tier in the config decides how much work is done:
+    'full' runs rembg and alpha matting on the full resolution image,
+    'fast' runs both on an image capped at config['working_size'] and
+    upsamples only the mask, 'mask' does the same but skips alpha matting.
+
+    Parameters:
+    -----------
+    image : numpy.ndarray
+        Input image to process in RGB format
+    config : dict, optional
+        Preprocessing configuration
+    green_percentage : float, optional
+        Result of check_green_percentage(image) if the caller already has it
+    timings : dict, optional
+        Filled with the rembg and matting seconds, see run_rembg()
+
+    Returns:
+    --------
+    numpy.ndarray
+        Processed image with the background removed and focused on the main leaf
+    """
+    try:
+
+        if green_percentage is None:
+            green_percentage = check_green_percentage(image)
+
+        # If image is almost entirely green (>90%), skip rembg
+        if green_percentage > 0.9999:
+            final_image = image.copy()
+            return final_image
+
+        if config is None:
+            config = initialize_preprocessor()
+        tier = config.get('segmentation_tier', 'full')
+
+        if tier == 'full':
+            # For regular images, use rembg with carefully tuned parameters
+            output = run_rembg(image.copy(), config, timings=timings)
+
+            """
+            the output of the rembg function has an alpha channel
+            the model needs an rbg image the following steps seperates the rgn from the alpha
+            and finds the leaf edge and adds it to the white background
+            """
+            # The kernel reads only the RGB channels of the RGBA output
+            return composite_on_white(output, refine_mask(output[:, :, 3]))
+
+        if tier not in SEGMENTATION_TIERS:
+            raise ValueError(f"Unknown segmentation tier: {tier}")
+
+        # Segment (and matte) a small copy, the final image is 224x224 anyway
+        working, scaled = downscale_to(image, config.get('working_size', 512))
+        output = run_rembg(working if scaled else working.copy(), config, alpha_matting=(tier == 'fast'),
+                           timings=timings)
+        mask = refine_mask(output[:, :, 3])
+        if scaled:
+            # Linear upsampling keeps the leaf edge soft instead of blocky
+            mask = cv2.resize(mask, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_LINEAR)
+        return composite_on_white(image, mask)
     except Exception as e:
         print(f"Background removal error: {e}")
         # On failure, return the original image but with increased contrast
@@ -203,63 +361,74 @@ def resize_with_padding(image, config):
     return canvas
 
 
-def preprocess_image(image_path, config=None):
+def load_image(image_source):
     """
-    Full preprocessing pipeline for a single image
+    Load an image as an RGB array from a path, encoded bytes or an array
 
     Parameters:
     -----------
-    image_path : str
-        Path to input image
-    config : dict, optional
-        Preprocessing configuration
+    image_source : str, bytes or numpy.ndarray
+        Path to an image file, the encoded file contents (e.g. an upload
+        read into memory) or an already decoded RGB array
 
     Returns:
     --------
     numpy.ndarray
-        Preprocessed image ready for neural network input
+        Image in RGB format
     """
-    # Use default configuration if not provided
-    if config is None:
-        config = initialize_preprocessor()
-
-    try:
-        # Read the image in BGR and convert to RGB
-        image = cv2.imread(image_path)
+    if isinstance(image_source, np.ndarray):
+        return image_source
+    if isinstance(image_source, (bytes, bytearray, memoryview)):
+        image = cv2.imdecode(np.frombuffer(image_source, np.uint8), cv2.IMREAD_COLOR)
         if image is None:
-            raise ValueError(f"Could not read image: {image_path}")
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            raise ValueError("Could not decode image bytes")
+    else:
+        image = cv2.imread(image_source)
+        if image is None:
+            raise ValueError(f"Could not read image: {image_source}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
-        #Check if image actually has leaf:
-        if check_green_percentage(image)<0.3:
-            return None
-        # Remove the background and segment the leaf
-        no_bg_image = remove_background(image)
 
-        # Check if the result is mostly empty (failed segmentation
-        non_white_pixels = np.sum(no_bg_image < 250) / no_bg_image.size
-        if non_white_pixels < 0.01:  # If less than 1% non-white pixels
-            enhanced_image = enhance_contrast(image)  # Fall back to original image
-        else:
-            enhanced_image = enhance_contrast(no_bg_image)
+def describe_source(image_source):
+    if isinstance(image_source, str):
+        return image_source
+    return f"<{type(image_source).__name__} image>"
 
-        # Resize with padding
-        final_image = resize_with_padding(enhanced_image, config)
 
-        # Normalize image for neural network input (values between 0 and 1)
-        normalized_image = final_image.astype(np.float32) / 255.0
+def synthetic_leaf(size=512):
+    """
+    Green ellipse on a light background, passes the leaf gate so warm-up runs every stage
 
-        return normalized_image
+    Returns:
+    --------
+    numpy.ndarray
+        uint8 RGB image of size x size
+    """
+    image = np.full((size, size, 3), 235, dtype=np.uint8)
+    cv2.ellipse(image, (size // 2, size // 2), (size * 9 // 20, size * 3 // 10), 30, 0, 360, (60, 140, 50), -1)
+    return image
 
-    except Exception as e:
-        print(f"Preprocessing error for {image_path}: {e}")
-        # In case of any error, attempt basic preprocessing
-        try:
-            # Read and resize the image
-            image = cv2.imread(image_path)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            image = cv2.resize(image, config['target_size'])
-            return image.astype(np.float32) / 255.0
-        except:
-            # If all else fails, return zeros with the right shape
-            return np.zeros((*config['target_size'], 3), dtype=np.float32)
+
+def preprocess_image(image_source, config=None):
+    """
+    Full preprocessing pipeline for a single image
+
+    Parameters:
+    -----------
+    image_source : str, bytes or numpy.ndarray
+        Path to input image, encoded image bytes or an RGB array
+    config : dict, optional
+        Preprocessing configuration
+
+    Returns:
+    --------
+    numpy.ndarray
+        Preprocessed uint8 image (0-255) ready for neural network input
+    """
+    # Use default configuration if not provided
+    if config is None:
+        config = initialize_preprocessor()
+
+    # The stages (decode, leaf gate, segmentation, contrast, resize, tensor) live in pipeline.py
+    from pipeline import build_pipeline
+    return build_pipeline(config).run(image_source).result
@@ -0,0 +1,177 @@
+import argparse
+import logging
+import os
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+
+"""
+Production server: gunicorn with the app preloaded in the master process.
+Fork-safe subsystems (fertilizer artifacts, single threaded TFLite/ONNX models)
+are loaded once before the workers are forked, so their read-only memory is
+shared copy-on-write instead of being duplicated per worker. Everything that
+starts threads or opens files (upload store, chat cache) is started in each
+worker after the fork. All workers share CHAT_CACHE_PATH, a SQLite file that
+serializes their writes, and the generation slots in --chat-slot-dir, so
+CHAT_MAX_CONCURRENT caps the Ollama generations of all workers together. With several workers they write their metrics to a
+shared directory (--metrics-dir, a temporary one by default) and /metrics
+on any worker reports the sum over all of them.
+    python -m serve --workers 4 --threads 8
+    INFERENCE_BACKEND=onnx python -m serve --max-worker-memory-mb 1500
+Keep INFERENCE_THREADS at 1 so N workers do not oversubscribe N cores.
+The default keras backend is not fork-safe: every worker would load its own
+TensorFlow model, so it runs one worker unless --workers says otherwise, and
+the master warns whenever the model cannot be preloaded for several workers.
+"""
+
+
+def resident_memory_mb():
+    """Current resident set size of this process"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError):
+        # No procfs (macOS): peak RSS is the closest available number
+        import resource
+        import platform
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if platform.system() == 'Darwin' else peak / 1024
+
+
+class LeafEyeServer(BaseApplication):
+    def __init__(self, options, preload=None, startup_mode='background', max_worker_memory_mb=0, metrics_dir=None,
+                 slot_dir=None):
+        """
+        gunicorn application serving app.app
+
+        Parameters:
+        -----------
+        options : dict
+            gunicorn settings, e.g. bind, workers, threads, max_requests
+        preload : list, optional
+            Subsystems loaded in the master. Default is app.fork_safe_subsystems()
+        startup_mode : str, optional
+            How each worker loads the remaining subsystems: 'background', 'lazy' or 'eager'
+        max_worker_memory_mb : float, optional
+            A worker above this RSS finishes its current requests and is replaced, 0 disables
+        metrics_dir : str, optional
+            Directory the workers merge their metrics through, emptied on start. None keeps
+            metrics per process
+        slot_dir : str, optional
+            Directory of the generation slots the workers share. None caps generations per worker
+        """
+        self.options = options
+        self.preload = preload
+        self.startup_mode = startup_mode
+        self.max_worker_memory_mb = max_worker_memory_mb
+        self.metrics_dir = metrics_dir
+        self.slot_dir = slot_dir
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set('preload_app', True)
+        self.cfg.set('post_fork', self.post_fork)
+        self.cfg.set('post_request', self.post_request)
+        self.cfg.set('child_exit', self.child_exit)
+
+    def load(self):
+        # Nothing may start threads in the master, workers begin loading in post_fork
+        os.environ['STARTUP_MODE'] = 'lazy'
+        if self.metrics_dir:
+            import metrics
+            # Counters of a previous run's workers must not be added to this one's
+            metrics.MultiProcessCollector.clear(self.metrics_dir)
+            os.environ['METRICS_MULTIPROC_DIR'] = self.metrics_dir
+        if self.slot_dir:
+            os.environ['CHAT_SLOT_DIR'] = self.slot_dir
+        import app as leafeye
+        preload = leafeye.fork_safe_subsystems() if self.preload is None else self.preload
+        workers = self.cfg.workers
+        if 'model' not in preload and workers > 1:
+            logging.warning(
+                f"The {leafeye.app.config['INFERENCE_BACKEND']} model (INFERENCE_THREADS="
+                f"{leafeye.app.config['INFERENCE_THREADS']}) is not fork-safe, each of the {workers} workers "
+                f"loads its own copy. Use INFERENCE_BACKEND=tflite or onnx with INFERENCE_THREADS=1 to share "
+                f"one, or fewer workers")
+        leafeye.subsystems.preload(preload)
+        return leafeye.app
+
+    def post_fork(self, server, worker):
+        import app as leafeye
+        leafeye.app.config['STARTUP_MODE'] = self.startup_mode
+        leafeye.subsystems.start(self.startup_mode)
+        if leafeye.metrics_collector:
+            leafeye.metrics_collector.start()
+
+    def child_exit(self, server, worker):
+        import app as leafeye
+        if leafeye.metrics_collector:
+            leafeye.metrics_collector.mark_dead(worker.pid)
+
+    def post_request(self, worker, req, environ, resp):
+        if self.max_worker_memory_mb and resident_memory_mb() > self.max_worker_memory_mb:
+            logging.warning(f"Worker {worker.pid} above {self.max_worker_memory_mb} MB, restarting it")
+            # Graceful: in-flight requests complete, then the arbiter forks a replacement
+            worker.alive = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the LeafEye API with gunicorn")
+    parser.add_argument('--bind', default=os.environ.get('SERVER_BIND', f"0.0.0.0:{os.environ.get('PORT', 3000)}"))
+    parser.add_argument('--workers', type=int, default=os.environ.get('SERVER_WORKERS'),
+                        help="Worker processes. Default is one per core, one for INFERENCE_BACKEND=keras")
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('SERVER_THREADS', 8)),
+                        help="Request threads per worker, they share one batching scheduler. Default is 8")
+    parser.add_argument('--max-requests', type=int, default=int(os.environ.get('SERVER_MAX_REQUESTS', 10000)),
+                        help="Replace a worker after this many requests, 0 disables. Default is 10000")
+    parser.add_argument('--max-requests-jitter', type=int,
+                        default=int(os.environ.get('SERVER_MAX_REQUESTS_JITTER', 1000)))
+    parser.add_argument('--max-worker-memory-mb', type=float,
+                        default=float(os.environ.get('SERVER_MAX_WORKER_MEMORY_MB', 0)),
+                        help="Replace a worker whose RSS exceeds this, 0 disables")
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('SERVER_TIMEOUT', 120)))
+    parser.add_argument('--graceful-timeout', type=int, default=int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30)))
+    parser.add_argument('--preload', nargs='*',
+                        help="Subsystems loaded in the master (model, preprocessing, fertilizer). "
+                             "Default is whatever is fork-safe for the configured backend")
+    parser.add_argument('--metrics-dir', default=os.environ.get('METRICS_MULTIPROC_DIR'),
+                        help="Directory the workers share their metrics through. "
+                             "Default is a temporary directory when there is more than one worker")
+    parser.add_argument('--chat-slot-dir', default=os.environ.get('CHAT_SLOT_DIR'),
+                        help="Directory of the Ollama generation slots shared by the workers, give the async "
+                             "proxy the same one. Default is a temporary directory when there is more than one worker")
+    parser.add_argument('--startup-mode', default=os.environ.get('STARTUP_MODE', 'background'),
+                        choices=('background', 'lazy', 'eager'))
+    args = parser.parse_args()
+    if args.workers is None:
+        # TensorFlow cannot be shared with forked workers and already spreads one process over the cores
+        keras = os.environ.get('INFERENCE_BACKEND', 'keras') == 'keras'
+        args.workers = 1 if keras else os.cpu_count() or 1
+    metrics_dir = args.metrics_dir
+    if metrics_dir is None and args.workers > 1:
+        metrics_dir = tempfile.mkdtemp(prefix='leafeye-metrics-')
+    slot_dir = args.chat_slot_dir
+    if slot_dir is None and args.workers > 1:
+        slot_dir = tempfile.mkdtemp(prefix='leafeye-slots-')
+
+    options = {
+        'bind': args.bind,
+        'workers': args.workers,
+        'worker_class': 'gthread',
+        'threads': args.threads,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests_jitter,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'keepalive': 5,
+        'accesslog': '-'
+    }
+    LeafEyeServer(options, args.preload, args.startup_mode, args.max_worker_memory_mb, metrics_dir,
+                  slot_dir).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+
+
+"""
+Deferred loading of the heavy subsystems (model, rembg, fertilizer artifacts).
+Each subsystem is loaded once, either by a background thread started with the
+app or by the first request that needs it, and reports its state so a
+readiness probe can tell a warm process from one that is still loading.
+A subsystem may also be preloaded in a server master process: only its loader
+runs there, the per-process start step (threads) runs in each forked worker.
+"""
+
+PENDING = 'pending'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class Subsystem:
+    def __init__(self, name, loader, start=None):
+        """
+        One lazily loaded part of the app
+
+        Parameters:
+        -----------
+        name : str
+            Name reported by the readiness probe, e.g. 'model'
+        loader : callable
+            Builds (and warms) the subsystem, its return value is handed out by get()
+        start : callable, optional
+            Called with the loader's result in every process that uses it and returns
+            the value handed out instead, e.g. to start threads that do not survive fork()
+        """
+        self.name = name
+        self.loader = loader
+        self.start = start
+        self.state = PENDING
+        self.error = None
+        self.seconds = None
+        self._value = None
+        self._loaded = None
+        self._preloaded = False
+        self._lock = threading.Lock()
+
+    def preload(self):
+        """Run only the loader, e.g. in a master process before workers are forked"""
+        with self._lock:
+            if not self._preloaded:
+                start = time.perf_counter()
+                self._loaded = self.loader()
+                self._preloaded = True
+                self.seconds = time.perf_counter() - start
+                logging.info(f"{self.name} preloaded in {self.seconds:.1f}s")
+
+    def load(self):
+        """Run the loader unless another thread already did (callers wait for it), a failed load is retried"""
+        with self._lock:
+            if self.state == READY:
+                return self._value
+            self.state = LOADING
+            start = time.perf_counter()
+            try:
+                loaded = self._loaded if self._preloaded else self.loader()
+                self._value = self.start(loaded) if self.start else loaded
+            except Exception as e:
+                self.state = FAILED
+                self.error = str(e)
+                logging.error(f"Loading {self.name} failed: {e}")
+                raise RuntimeError(f"{self.name} failed to load: {e}") from e
+            finally:
+                self.seconds = time.perf_counter() - start
+            self.state = READY
+            self.error = None
+            logging.info(f"{self.name} ready in {self.seconds:.1f}s")
+            return self._value
+
+    def get(self):
+        """The loaded subsystem, loading it in this thread on first use"""
+        if self.state == READY:
+            return self._value
+        return self.load()
+
+    def peek(self):
+        """The loaded subsystem or None, never triggers a load"""
+        return self._value if self.state == READY else None
+
+    def status(self):
+        status = {"state": self.state}
+        if self.seconds is not None:
+            status["seconds"] = round(self.seconds, 3)
+        if self.error:
+            status["error"] = self.error
+        return status
+
+
+class Subsystems:
+    def __init__(self):
+        self._subsystems = {}
+        self._thread = None
+
+    def register(self, name, loader, start=None):
+        subsystem = Subsystem(name, loader, start)
+        self._subsystems[name] = subsystem
+        return subsystem
+
+    def __getitem__(self, name):
+        return self._subsystems[name]
+
+    def preload(self, names):
+        """Run the loaders of the named subsystems in this process, see Subsystem.preload"""
+        for name in names:
+            self._subsystems[name].preload()
+
+    def load_all(self):
+        """Load every subsystem in registration order, failures are recorded and skipped"""
+        for subsystem in self._subsystems.values():
+            try:
+                subsystem.get()
+            except RuntimeError:
+                continue
+
+    def start(self, mode='background'):
+        """
+        Begin loading
+
+        Parameters:
+        -----------
+        mode : str, optional
+            'background' loads everything in a daemon thread, 'eager' loads before
+            returning and 'lazy' waits for the first request of each subsystem.
+            Default is 'background'
+        """
+        if mode == 'eager':
+            self.load_all()
+        elif mode == 'background':
+            self._thread = threading.Thread(target=self.load_all, name="subsystem-loader", daemon=True)
+            self._thread.start()
+        elif mode != 'lazy':
+            raise ValueError(f"Unknown startup mode: {mode}")
+        return self
+
+    def ready(self):
+        return all(subsystem.state == READY for subsystem in self._subsystems.values())
+
+    def status(self):
+        return {name: subsystem.status() for name, subsystem in self._subsystems.items()}
@@ -0,0 +1,232 @@
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+
+
+"""
+Disk storage for uploaded images.
+Archiving is done by a background thread so file writes, hashing and
+duplicate checks never add to the latency of a detection request.
+"""
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+
+def iter_upload_images(folder='uploads'):
+    """
+    Every image below folder, including the content-addressed shards of
+    UploadStore, in a stable order
+    """
+    paths = []
+    for root, _, files in os.walk(folder):
+        paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+class BackgroundWriter:
+    def __init__(self, max_pending=256):
+        """
+        Write files from a single background thread
+
+        Parameters:
+        -----------
+        max_pending : int, optional
+            Writes waiting at most. When the queue is full new writes are
+            dropped rather than blocking the request. Default is 256
+        """
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.skipped = 0
+        self._start()
+        # Threads do not survive fork(), e.g. into preloaded server workers
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self.max_pending)
+        self._thread = threading.Thread(target=self._run, name="upload-writer", daemon=True)
+        self._thread.start()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def submit(self, path, data, skip_existing=False):
+        """
+        Queue bytes to be written to path
+
+        Parameters:
+        -----------
+        path : str or callable
+            Destination, or a function of data returning it, called on the writer thread
+        data : bytes
+        skip_existing : bool, optional
+            Leave an existing file at path alone and count it in skipped. Default is False
+
+        Returns:
+        --------
+        bool
+            False if the write was dropped
+        """
+        try:
+            self._queue.put_nowait((path, data, skip_existing))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logging.warning(f"Upload archive queue full, not saving {path if isinstance(path, str) else 'upload'}")
+            return False
+
+    def flush(self):
+        """Block until every queued write is on disk"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            path, data, skip_existing = self._queue.get()
+            try:
+                if callable(path):
+                    path = path(data)
+                if skip_existing and os.path.exists(path):
+                    self.skipped += 1
+                    continue
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                # Write then rename so readers never see a partial file
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'wb') as out:
+                    out.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logging.error(f"Could not archive upload {path}: {e}")
+            finally:
+                self._queue.task_done()
+
+
+class UploadStore:
+    def __init__(self, root='uploads', max_bytes=1024 ** 3, max_age_seconds=30 * 24 * 3600,
+                 evict_interval=600, writer=None):
+        """
+        Content-addressed archive of uploads with a size and age budget
+
+        Files are named by the SHA-256 of their bytes and sharded as
+        root/ab/cd/abcd....jpg, so identical uploads are stored once and
+        different images can never overwrite each other. Only these sharded
+        files are ever evicted; anything else in root is left alone.
+
+        Parameters:
+        -----------
+        root : str, optional
+            Base folder. Default is uploads
+        max_bytes : int, optional
+            Total size of stored files kept, oldest evicted first. Default is 1 GB
+        max_age_seconds : float, optional
+            Files older than this are evicted, 0 keeps them forever. Default is 30 days
+        evict_interval : float, optional
+            Seconds between background eviction passes. Default is 600
+        writer : BackgroundWriter, optional
+            Writer used for new files, one is created if not given
+        """
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self.max_age = float(max_age_seconds)
+        self.evict_interval = float(evict_interval)
+        self.writer = writer or BackgroundWriter()
+        self.evicted = 0
+        self._start_evictor()
+        os.register_at_fork(after_in_child=self._start_evictor)
+
+    def _start_evictor(self):
+        self._evictor = threading.Thread(target=self._evict_loop, name="upload-evictor", daemon=True)
+        self._evictor.start()
+
+    def path_for(self, key, extension):
+        return os.path.join(self.root, key[:2], key[2:4], f"{key}{extension}")
+
+    def put(self, data, filename='', key=None):
+        """
+        Queue an upload for archiving. Hashing (unless key is given) and the
+        duplicate check run on the writer thread, the caller never touches the disk
+
+        Parameters:
+        -----------
+        data : bytes
+            Encoded image
+        filename : str, optional
+            Client file name, only its extension is kept
+        key : str, optional
+            SHA-256 hex digest of data if the caller already has it (cache.content_key)
+
+        Returns:
+        --------
+        bool
+            False if the write was dropped
+        """
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in IMAGE_EXTENSIONS:
+            extension = '.bin'
+        if key is not None:
+            path = self.path_for(key, extension)
+        else:
+            def path(content):
+                return self.path_for(hashlib.sha256(content).hexdigest(), extension)
+        return self.writer.submit(path, data, skip_existing=True)
+
+    def _stored_files(self):
+        files = []
+        for shard in os.scandir(self.root):
+            if not (shard.is_dir() and len(shard.name) == 2):
+                continue
+            for root, _, names in os.walk(shard.path):
+                for name in names:
+                    if name.endswith('.tmp'):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        """
+        Delete expired files, then the oldest ones until the store fits max_bytes
+
+        Returns:
+        --------
+        int
+            Number of files deleted
+        """
+        files = sorted(self._stored_files())
+        total = sum(size for _, size, _ in files)
+        cutoff = time.time() - self.max_age if self.max_age > 0 else None
+        deleted = 0
+        for mtime, size, path in files:
+            if not ((cutoff is not None and mtime < cutoff) or total > self.max_bytes):
+                break
+            try:
+                os.remove(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.evicted += deleted
+        return deleted
+
+    def _evict_loop(self):
+        while True:
+            try:
+                deleted = self.evict()
+                if deleted:
+                    logging.info(f"Evicted {deleted} archived uploads from {self.root}")
+            except OSError as e:
+                logging.error(f"Upload eviction failed: {e}")
+            time.sleep(self.evict_interval)
+
+    def stats(self):
+        return {
+            "pending_writes": self.writer.depth(),
+            "dropped_writes": self.writer.dropped,
+            "duplicates": self.writer.skipped,
+            "evicted": self.evicted
+        }
@@ -0,0 +1,159 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+"""
+Preprocessing in separate processes.
+rembg, PyMatting, CLAHE and the contour work are CPU bound and hold the
+GIL, so each worker process runs its own pipeline. Workers receive the
+encoded image and write the finished tensor into a slot of one shared
+memory block, so tensors are never pickled on the way back. Every worker
+warms its pipeline in the pool initializer, before it takes any image.
+"""
+
+# Per worker process state, set by _init_worker
+_worker = {}
+
+
+def _init_worker(options, shm_name, slot_shape, ready):
+    from preprocessing import initialize_preprocessor, synthetic_leaf
+    from pipeline import build_pipeline
+
+    # Spawned workers share the parent's resource tracker, the parent unlinks the block on close()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    config = initialize_preprocessor(**options)
+    _worker['shm'] = shm
+    slot_count = shm.size // int(np.prod(slot_shape))
+    _worker['slots'] = np.ndarray((slot_count, *slot_shape), dtype=np.uint8, buffer=shm.buf)
+    _worker['config'] = config
+    _worker['pipeline'] = build_pipeline(config)
+    try:
+        # Loads the rembg sessions and compiles the numba kernels before the first real image
+        _worker['pipeline'].run(synthetic_leaf())
+    except Exception as e:
+        # A raising initializer would make the pool respawn the worker forever
+        logging.error(f"Preprocessing worker {os.getpid()} warm-up failed: {e}")
+    ready.put(os.getpid())
+
+
+def _preprocess_into_slot(source, slot, overrides):
+    """
+    Runs in a worker: preprocess one image and write it to shared memory
+
+    Returns:
+    --------
+    tuple
+        (status, timings, error) with status 'ok', 'fallback' (segmentation failed and was
+        skipped) or 'rejected'. PreprocessingError propagates to the caller
+    """
+    config = dict(_worker['config'], **overrides) if overrides else None
+    ctx = _worker['pipeline'].run(source, config)
+    if ctx.result is None:
+        return 'rejected', ctx.timings, ctx.error
+    _worker['slots'][slot] = ctx.result
+    return 'fallback' if ctx.fallback else 'ok', ctx.timings, ctx.error
+
+
+class PreprocessPool:
+    def __init__(self, processes=2, options=None, slots=None, target_size=(224, 224)):
+        """
+        Pool of preprocessing processes returning tensors through shared memory
+
+        Parameters:
+        -----------
+        processes : int, optional
+            Worker processes, each with its own rembg sessions. Default is 2
+        options : dict, optional
+            Keyword arguments for initialize_preprocessor() in every worker
+        slots : int, optional
+            Tensors that can be in flight at once. Default is 2 per process
+        target_size : tuple, optional
+            Tensor height and width. Default is (224, 224)
+        """
+        self.options = dict(options or {}, target_size=target_size)
+        self.slot_shape = (*target_size, 3)
+        slot_count = slots or 2 * processes
+        self._shm = shared_memory.SharedMemory(create=True, size=slot_count * int(np.prod(self.slot_shape)))
+        self._slots = np.ndarray((slot_count, *self.slot_shape), dtype=np.uint8, buffer=self._shm.buf)
+        self._free = queue.Queue()
+        for slot in range(slot_count):
+            self._free.put(slot)
+        # Spawned workers never inherit the parent's TensorFlow state. Unlike ProcessPoolExecutor,
+        # Pool starts every worker now (and replaces one that dies), so each runs the warm-up
+        context = multiprocessing.get_context('spawn')
+        self._ready = context.Queue()
+        self._pool = context.Pool(
+            processes,
+            initializer=_init_worker,
+            initargs=(self.options, self._shm.name, self.slot_shape, self._ready)
+        )
+        self.processes = processes
+        # Called as observer(stage_name, seconds, nbytes) for every stage a worker ran
+        self.observers = []
+        self._closed = threading.Event()
+        atexit.register(self.close)
+
+    def wait_ready(self, timeout=None):
+        """Block until every worker has warmed its pipeline, raises queue.Empty after timeout seconds"""
+        for _ in range(self.processes):
+            self._ready.get(timeout=timeout)
+        return self
+
+    def depth(self):
+        """Slots currently holding an image in flight"""
+        return self._slots.shape[0] - self._free.qsize()
+
+    def preprocess(self, source, overrides=None):
+        """
+        Preprocess one image in a worker process
+
+        Parameters:
+        -----------
+        source : str, bytes or numpy.ndarray
+            Path, encoded bytes or RGB array
+        overrides : dict, optional
+            Config values changed for this image, e.g. {'segmentation_tier': 'fast'}
+
+        Returns:
+        --------
+        tuple
+            (uint8 tensor or None if the image is not a suitable plant image, whether a
+            recoverable stage fell back). Raises PreprocessingError for undecodable images
+        """
+        slot = self._free.get()
+        try:
+            status, timings, error = self._pool.apply(_preprocess_into_slot, (source, slot, overrides))
+            if error:
+                logging.warning(f"Preprocessing fell back after error in {error}")
+            for name, seconds, nbytes in timings:
+                for observer in self.observers:
+                    observer(name, seconds, nbytes)
+            if status == 'rejected':
+                return None, False
+            return self._slots[slot].copy(), status == 'fallback'
+        finally:
+            self._free.put(slot)
+
+    def stats(self):
+        return {
+            "processes": self.processes,
+            "in_flight": self.depth()
+        }
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        # Finishes the images in flight before the shared memory goes away
+        self._pool.close()
+        self._pool.join()
+        self._slots = None
+        self._shm.close()
+        self._shm.unlink()